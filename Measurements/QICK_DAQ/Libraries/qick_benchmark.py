@@ -0,0 +1,305 @@
+import numpy as np
+import sys, os, json, time, datetime, platform, threading, contextlib
+import qick
+from qick import *
+from qick_helpers import *
+from qick_oneToneSweep import oneToneSweep
+
+#----------------------------------------------------------------------
+#
+# qick_benchmark.py
+# Oct 2024
+#
+# Throughput benchmarks for the sweep engine in qick_oneToneSweep.py.
+# Runs a few canonical sweeps and reports points/sec plus where the
+# time went: program construction, compile, pulse load, remote call
+# overhead, acquisition and result transfer.
+#
+#    results = run_benchmarks(soc, soccfg, outfile="/data/bench/today.json",
+#                             baseline="/data/bench/baseline.json")
+#
+# soc can be a real board (QickSoc or Pyro proxy) or a simSoc from
+# qick_simulator.py.  Running this file benchmarks a simSoc:
+#
+#    python qick_benchmark.py [scale] [baseline.json]
+#
+#----------------------------------------------------------------------
+
+## Canonical workloads: name -> sweep axes, x axis first.  Each axis is (sweepVarName, start, stop, npts, forceInt)
+benchmark_workloads = {
+    "freq_1D"      : [("res_freq", 7340, 7360, 600, False)],
+    "freq_gain_2D" : [("res_freq", 7340, 7360, 600, False), ("res_gain", 1000, 30000, 15, True)],
+    "time_1D"      : [("res_length_us", 0.05, 2.0, 10000, False)],
+}
+
+## Measurement settings the workloads run with (channels come from qick_helpers)
+benchmark_cfg = {
+    "res_freq"           : 7350,
+    "res_gain"           : 6000,
+    "res_phase"          : 0,
+    "res_length_us"      : 2,
+    "res_pulse_style"    : "const",
+    "readout_length_us"  : 2,
+    "adc_trig_offset_us" : 0.5,
+    "relax_delay_us"     : 1,
+    "reps"               : 100,
+    "soft_avgs"          : 1,
+}
+
+## Stages the time is split into.  build/compile are on the PC, the rest is spent in soc calls
+benchmark_stages = ["build", "compile", "load", "remote", "acquisition", "transfer"]
+
+## Which stage each soc method belongs to (the tProc v1 sequence in qick's config_all/acquire)
+## poll_data waits for the shots as well as fetching them, so it counts as acquisition
+soc_call_stages = {
+    "start_src"          : "load",
+    "stop_tproc"         : "load",
+    "load_envelope"      : "load",
+    "load_pulse_data"    : "load",
+    "load_weights"       : "load",
+    "set_nyquist"        : "load",
+    "set_mixer_freq"     : "load",
+    "configure_readout"  : "load",
+    "config_mux_gen"     : "load",
+    "config_mux_readout" : "load",
+    "load_bin_program"   : "load",
+    "reload_mem"         : "load",
+    "get_accumulated"    : "transfer",
+    "get_decimated"      : "transfer",
+}
+
+
+## Time spent per stage during one workload
+## Soc calls each cost `ping` seconds of round trip, which is moved from their stage into "remote".
+## A simSoc keeps its own per-stage account, which is used for its acquire calls instead.
+class stageProfile:
+    def __init__(self, ping=0.0):
+        self.ping   = ping
+        self.times  = {stage : 0.0 for stage in benchmark_stages}
+        self.ncalls = 0
+        self.lock   = threading.Lock()
+
+    def add(self, stage, t):
+        with self.lock:
+            self.times[stage] += t
+
+    ## Books one soc call that took t seconds
+    def add_call(self, name, t, sim_stages=None):
+        with self.lock:
+            self.ncalls += 1
+            if sim_stages is not None:
+                for stage in sim_stages:
+                    self.times[stage] += sim_stages[stage]
+                ## Whatever the simulator didn't account for is building the results
+                self.times["transfer"] += max(t - sum(sim_stages.values()), 0)
+                return
+            remote = min(self.ping, t)
+            self.times["remote"] += remote
+            self.times[soc_call_stages.get(name, "acquisition")] += t - remote
+
+
+## Hands every soc call through, timing it into a stageProfile
+class timedSoc:
+    def __init__(self, soc, profile):
+        self._soc     = soc
+        self._profile = profile
+
+    def __getitem__(self, key):
+        return self._soc[key]
+
+    def __getattr__(self, name):
+        attr = getattr(self._soc, name)
+        if not callable(attr):
+            return attr
+        soc = self._soc
+        profile = self._profile
+        def timed_call(*args, **kwargs):
+            sim = getattr(soc, "stage_times", None)
+            before = dict(sim) if sim is not None else None
+            t = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                t = time.perf_counter() - t
+                sim_stages = None if sim is None else {stage : sim[stage] - before[stage] for stage in sim}
+                profile.add_call(name, t, sim_stages)
+        return timed_call
+
+
+## Times program construction and compile for every v1 program made inside the with block
+## (the methods are patched on the qick base classes, so cached and prefetched builds are caught too)
+## qick compiles at the end of __init__, so nested calls are booked to their own stage and taken out of the outer one
+@contextlib.contextmanager
+def profile_programs(profile):
+    patched = []
+    local   = threading.local()
+    def timed(func, stage):
+        def wrapper(self, *args, **kwargs):
+            if not hasattr(local, "stack"):
+                local.stack = []
+            local.stack.append(0.0)
+            t = time.perf_counter()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                t = time.perf_counter() - t
+                nested = local.stack.pop()
+                profile.add(stage, t - nested)
+                if len(local.stack) > 0:
+                    local.stack[-1] += t
+        return wrapper
+    for prog_class in [AveragerProgram, RAveragerProgram, NDAveragerProgram]:
+        patched.append((prog_class, "__init__", prog_class.__dict__["__init__"]))
+        prog_class.__init__ = timed(prog_class.__dict__["__init__"], "build")
+    compile_class = QickProgram
+    patched.append((compile_class, "compile", compile_class.__dict__["compile"]))
+    compile_class.compile = timed(compile_class.__dict__["compile"], "compile")
+    try:
+        yield profile
+    finally:
+        for prog_class, name, func in patched:
+            setattr(prog_class, name, func)
+
+
+## Round trip of one cheap soc call [s], median of n tries (0 for a simSoc, which has no separate calls)
+def measure_ping(soc, n=20):
+    if getattr(soc, "is_simulated", False):
+        return 0.0
+    times = []
+    for i in range(n):
+        t = time.perf_counter()
+        soc.start_src("internal")
+        times.append(time.perf_counter() - t)
+    return float(np.median(times))
+
+
+## Runs one workload and returns its results dict
+## scale      = fraction of the canonical number of points to take (e.g. 0.1 for a quick check)
+## datapath   = if given, the data is saved there, so the h5 write is part of the timing
+## sweep_opts = passed to do_soft_1D/2D_measurement (use_cache, prefetch, hard_sweep, executor, stream_data...)
+def run_workload(name, soc, soccfg, axes=None, scale=1.0, ping=0.0, datapath=None, meas_cfg=None, **sweep_opts):
+    if axes is None:
+        axes = benchmark_workloads[name]
+    meas = oneToneSweep()
+    meas.set_metadata("benchmark", [0], name)
+    meas.set_hw_cfg(transmission_ch, None, ro_ch)
+    meas.meas_cfg.update(benchmark_cfg if meas_cfg is None else meas_cfg)
+    npts = 1
+    for n, (sweepVarName, start, stop, axis_npts, forceInt) in enumerate(axes):
+        axis_npts = max(int(round(axis_npts*scale)), 2)
+        npts *= axis_npts
+        meas.set_soft_sweep_vals(axis_npts, start, stop, sweepVarName, sweep_num=n+1)
+
+    profile = stageProfile(ping)
+    with profile_programs(profile):
+        t = time.perf_counter()
+        if len(axes) == 1:
+            meas.do_soft_1D_measurement(timedSoc(soc, profile), soccfg, datapath=datapath, save_data=datapath is not None,
+                                        forceInt=axes[0][4], **sweep_opts)
+        else:
+            meas.do_soft_2D_measurement(timedSoc(soc, profile), soccfg, datapath=datapath, save_data=datapath is not None,
+                                        x_forceInt=axes[0][4], y_forceInt=axes[1][4], **sweep_opts)
+        wall = time.perf_counter() - t
+    if "xi" not in meas.meas_data:
+        print("Error: workload", name, "didn't run")
+        return None
+
+    ## Stage times are busy time, so with prefetch builds overlap the acquisitions and can add up to more than wall
+    stages = {stage : profile.times[stage] for stage in benchmark_stages}
+    return {
+        "npts"           : npts,
+        "wall"           : wall,
+        "points_per_sec" : npts/wall,
+        "stages"         : stages,
+        "other"          : wall - sum(stages.values()),
+        "soc_calls"      : profile.ncalls,
+        "sweep_opts"     : {key : val for key, val in sweep_opts.items() if key != "executor"},
+    }
+
+
+## Runs the workloads and returns (and optionally saves) the results, compared against a baseline if one is given
+## workloads = list of names in benchmark_workloads (default all)
+## baseline  = results dict or path of a saved results JSON
+## tolerance = fractional drop in points/sec that counts as a regression
+def run_benchmarks(soc, soccfg, workloads=None, scale=1.0, outfile=None, baseline=None, tolerance=0.1, datapath=None, **sweep_opts):
+    if workloads is None:
+        workloads = list(benchmark_workloads.keys())
+    ping = measure_ping(soc)
+    results = {
+        "timestamp"    : datetime.datetime.now().isoformat(timespec="seconds"),
+        "host"         : platform.node(),
+        "python"       : platform.python_version(),
+        "qick_version" : qick.__version__,
+        "board"        : soccfg["board"],
+        "simulated"    : bool(getattr(soc, "is_simulated", False)),
+        "scale"        : scale,
+        "ping"         : ping,
+        "workloads"    : {},
+    }
+    if results["simulated"]:
+        results["sim_settings"] = {key : getattr(soc, key) for key in ["call_latency", "shot_time", "load_time", "transfer_time"]}
+    for name in workloads:
+        print("Running benchmark", name)
+        result = run_workload(name, soc, soccfg, scale=scale, ping=ping, datapath=datapath, **sweep_opts)
+        if result is not None:
+            results["workloads"][name] = result
+    print_benchmark(results)
+
+    if baseline is not None:
+        if isinstance(baseline, str):
+            baseline = load_benchmark(baseline)
+        results["regressions"] = compare_to_baseline(results, baseline, tolerance)
+    if outfile is not None:
+        save_benchmark(results, outfile)
+    return results
+
+
+## Prints points/sec and the stage split of every workload
+def print_benchmark(results):
+    print("%-14s %8s %9s %10s" % ("workload", "npts", "wall [s]", "pts/sec") + "".join(" %11s" % stage for stage in benchmark_stages + ["other"]))
+    for name, result in results["workloads"].items():
+        times = [result["stages"][stage] for stage in benchmark_stages] + [result["other"]]
+        print("%-14s %8d %9.2f %10.1f" % (name, result["npts"], result["wall"], result["points_per_sec"]) + "".join(" %11.3f" % t for t in times))
+
+
+## Compares points/sec to a baseline run, prints the table, and returns the workloads that got slower than tolerance allows
+## Runs at different scales aren't comparable, so that is only warned about
+def compare_to_baseline(results, baseline, tolerance=0.1):
+    if baseline.get("scale") != results.get("scale"):
+        print("Warning: baseline was taken at scale", baseline.get("scale"), "and this run at", results.get("scale"))
+    regressions = {}
+    print("%-14s %12s %12s %8s" % ("workload", "baseline", "now", "ratio"))
+    for name, result in results["workloads"].items():
+        if name not in baseline["workloads"]:
+            print("%-14s %12s %12.1f" % (name, "-", result["points_per_sec"]))
+            continue
+        old = baseline["workloads"][name]["points_per_sec"]
+        ratio = result["points_per_sec"]/old
+        flag = ""
+        if ratio < 1 - tolerance:
+            flag = "  REGRESSION"
+            regressions[name] = {"baseline" : old, "now" : result["points_per_sec"], "ratio" : ratio}
+        print("%-14s %12.1f %12.1f %8.2f%s" % (name, old, result["points_per_sec"], ratio, flag))
+    return regressions
+
+
+def save_benchmark(results, filepath):
+    with open(filepath, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Saved benchmark results to", filepath)
+
+def load_benchmark(filepath):
+    with open(filepath, "r") as f:
+        return json.load(f)
+
+
+## Benchmarks a simulated board with a Pyro-like call latency; exits 1 if anything regressed against the baseline
+if __name__ == "__main__":
+    from qick_simulator import simSoc, resonatorModel
+    scale    = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    baseline = sys.argv[2] if len(sys.argv) > 2 else None
+    model = resonatorModel([{"f0" : 7348.5, "gamma" : 0.08, "depth" : 0.8}], noise=2, seed=0)
+    soc = simSoc(model, call_latency=0.002, load_time=0.001)
+    outfile = "benchmark_%s.json" % datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    results = run_benchmarks(soc, soc, scale=scale, outfile=outfile, baseline=baseline)
+    sys.exit(1 if results.get("regressions") else 0)
@@ -0,0 +1,162 @@
+import numpy as np
+import os, glob
+import h5py
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from qick_data import read_item
+from qick_catalog import dataCatalog, series_time
+
+#----------------------------------------------------------------------
+#
+# qick_bulkload.py
+# Oct 2024
+#
+# Loads the same datasets from many files (e.g. a night of frequency
+# scans) into one stacked (files x points) array per dataset, reading
+# the files on a pool of processes.
+#
+#    TL = load_stack(os.path.join(datapath, "*TL.h5"), datasets=["meas_data/Ivals", "meas_data/Qvals"])
+#    plt.imshow(TL["amps"], aspect="auto", origin="lower")
+#    plt.plot(TL["t_hours"], TL["amps"][:, 120])
+#
+#    cat = dataCatalog(datapath); cat.update()
+#    CB = load_stack(cat, meas_type="*CB", device="C11", start="20240513_180000")
+#
+# Every stack is allocated once, in shared memory, and the workers
+# read each file's dataset straight into its row, so nothing but the
+# file names and series goes through the pool's pipes.  Processes
+# rather than threads, since h5py only lets one thread read at a time.
+# Rows are sorted by time; files that can't be read (or whose datasets
+# have a different shape than the first file's) are left as NaN rows
+# and listed in "errors".
+#
+#----------------------------------------------------------------------
+
+## I/Q dataset pairs that also get stacked amplitudes and phases
+iq_pairs = [("xi", "xq"), ("Ivals", "Qvals")]
+
+## Below this many files, the pool costs more to start than it saves
+min_pool_files = 16
+
+## Stacks datasets from many files
+## files      = list of filepaths, a glob pattern ("**" matches any depth), dataCatalog.find results, or a dataCatalog (then filters are passed to find)
+## datasets   = paths inside the files, e.g. "meas_data/xi"
+## processes  = size of the pool (default: one per core), 0 to read in this process
+## Returns {dataset name (the last part of the path): (files x ...) array, "amps"/"phases" for I/Q pairs,
+##          "files", "series", "timestamps" (unix), "t_hours" (since the first file), "errors": {filepath: why}}
+def load_stack(files, datasets=("meas_data/xi", "meas_data/xq"), processes=None, **filters):
+    filepaths = select_files(files, **filters)
+    if len(filepaths) == 0:
+        print("Error: no files to load")
+        return None
+
+    ## Shapes and dtypes come from the first file that has all the datasets
+    layout = None
+    for filepath in filepaths:
+        try:
+            with h5py.File(filepath, "r") as f:
+                layout = {name : (f[name].shape, np.result_type(f[name].dtype, float)) for name in datasets}
+            break
+        except (OSError, KeyError):
+            continue
+    if layout is None:
+        print("Error: none of the", len(filepaths), "files have all of", list(datasets))
+        return None
+
+    blocks = {}
+    try:
+        for name, (shape, dtype) in layout.items():
+            nbytes = max(int(np.prod((len(filepaths),) + shape))*dtype.itemsize, 1)
+            blocks[name] = shared_memory.SharedMemory(create=True, size=nbytes)
+            np.ndarray((len(filepaths),) + shape, dtype, buffer=blocks[name].buf)[...] = np.nan
+        spec = {name : (blocks[name].name, (len(filepaths),) + shape, dtype.str) for name, (shape, dtype) in layout.items()}
+
+        ## Contiguous runs of files per task, a few tasks per worker so a slow disk doesn't leave the others idle
+        rows = list(enumerate(filepaths))
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if processes == 0 or len(filepaths) < min_pool_files:
+            results = load_rows(spec, rows)
+        else:
+            ntasks = min(4*processes, len(rows))
+            tasks = [rows[k*len(rows)//ntasks:(k+1)*len(rows)//ntasks] for k in range(ntasks)]
+            results = []
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                for task_results in pool.map(load_rows, [spec]*len(tasks), tasks):
+                    results += task_results
+
+        stack = {name.split("/")[-1] : np.ndarray(shape, np.dtype(dtype), buffer=blocks[name].buf).copy() for name, (block, shape, dtype) in spec.items()}
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+
+    series = [None]*len(filepaths)
+    errors = {}
+    for row, row_series, error in results:
+        series[row] = row_series
+        if error is not None:
+            errors[filepaths[row]] = error
+    if len(errors) > 0:
+        print("Warning: couldn't load", len(errors), "of", len(filepaths), "files, their rows are NaN (see \"errors\")")
+
+    ## Timestamps from the series, or from the filename for files that don't say (series-first names)
+    timestamps = np.array([series_time(s) if series_time(s) is not None else series_time(os.path.basename(fp)[:15])
+                           for s, fp in zip(series, filepaths)], dtype=float)
+    order = np.argsort(timestamps, kind="stable")
+    if np.any(order != np.arange(len(order))):
+        stack = {key : value[order] for key, value in stack.items()}
+        timestamps = timestamps[order]
+        filepaths = [filepaths[k] for k in order]
+        series = [series[k] for k in order]
+
+    for [I, Q] in iq_pairs:
+        if I in stack and Q in stack:
+            z = stack[I] + 1j*stack[Q]
+            stack["amps"] = np.abs(z)
+            stack["phases"] = np.angle(z)
+            break
+    stack.update(files=filepaths, series=series, timestamps=timestamps, errors=errors,
+                 t_hours=(timestamps - np.nanmin(timestamps))/3600 if np.any(np.isfinite(timestamps)) else timestamps)
+    return stack
+
+## The filepaths to load, from any of the forms load_stack takes
+def select_files(files, **filters):
+    if isinstance(files, dataCatalog):
+        files = files.find(**filters)
+    elif len(filters) > 0:
+        print("Warning: filters", list(filters.keys()), "only apply when loading from a dataCatalog, ignoring them")
+    if isinstance(files, str):
+        return sorted(glob.glob(files, recursive=True))
+    return [f["filepath"] if isinstance(f, dict) else f for f in files]
+
+## Worker: reads each (row, filepath)'s datasets into its row of the shared stacks
+## Returns [(row, series, error or None)]
+def load_rows(spec, rows):
+    blocks = {name : shared_memory.SharedMemory(name=block) for name, (block, shape, dtype) in spec.items()}
+    stacks = {name : np.ndarray(shape, np.dtype(dtype), buffer=blocks[name].buf) for name, (block, shape, dtype) in spec.items()}
+    results = []
+    try:
+        for row, filepath in rows:
+            series = None
+            error = None
+            try:
+                with h5py.File(filepath, "r") as f:
+                    if "meta" in f and "series" in f["meta"]:
+                        series = read_item(f["meta"]["series"], "series")
+                    for name, stack in stacks.items():
+                        dset = f[name]
+                        if dset.shape != stack.shape[1:]:
+                            raise ValueError("%s has shape %s, not %s" % (name, dset.shape, stack.shape[1:]))
+                        if dset.size > 0:
+                            dset.read_direct(stack, dest_sel=np.s_[row])
+            except Exception as err:
+                error = "%s: %s" % (type(err).__name__, err)
+                for stack in stacks.values():
+                    stack[row] = np.nan
+            results.append((row, series, error))
+    finally:
+        del stacks
+        for block in blocks.values():
+            block.close()
+    return results
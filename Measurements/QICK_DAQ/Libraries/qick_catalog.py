@@ -0,0 +1,288 @@
+import numpy as np
+import os, time, datetime, json, sqlite3
+import h5py
+from qick_data import read_item
+
+#----------------------------------------------------------------------
+#
+# qick_catalog.py
+# Oct 2024
+#
+# SQLite index of every measurement file under a data directory, so
+# notebooks can pick their files with one query instead of listdir +
+# suffix matching + opening each candidate.
+#
+#    cat = dataCatalog("c:\\...\\Data")
+#    cat.update()                                   ## only (re)reads new or changed files
+#    scans = cat.find(meas_type="*CB", device="C11", start="20240513_000000", stop="20240514_120000")
+#    for scan in scans:
+#        d = read_H5(scan["dir"], scan["filename"], QICKdata, lazy=True)
+#
+# Indexed: QICKdata .h5 files (this library's and the older
+# Measurements/qick_data.py ones, monitor files too) and VNA .npz files
+# from RS_VNA/VNA_funcs.write_file.  Per file: series, timestamp (from
+# the series), device, qubits, meas_type, config_hash, sweep type and
+# variables, the channels, every scalar cfg entry, and the shape and
+# dtype of every data array.  None of the data itself is read.
+#
+#----------------------------------------------------------------------
+
+catalog_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    path        TEXT PRIMARY KEY,   -- relative to the catalog root
+    kind        TEXT,               -- "qick" or "vna"
+    mtime       REAL,
+    size        INTEGER,
+    series      TEXT,
+    timestamp   REAL,               -- unix time of the series (file mtime if the series doesn't parse)
+    device      TEXT,
+    qubits      TEXT,               -- json list
+    meas_type   TEXT,
+    config_hash TEXT,
+    sweep_type  TEXT,
+    x_var       TEXT,
+    y_var       TEXT,
+    res_ch      INTEGER,
+    qu_ch       INTEGER,
+    ro_ch       INTEGER,
+    cfg         TEXT,               -- json dict of every scalar meta/cfg entry
+    error       TEXT                -- why the file couldn't be read (it's retried on the next update)
+);
+CREATE TABLE IF NOT EXISTS datasets (
+    path  TEXT,
+    name  TEXT,                     -- e.g. "meas_data/xi", or "TL/meas_data/xi" in a monitor file
+    shape TEXT,                     -- json list
+    dtype TEXT,
+    PRIMARY KEY (path, name)
+);
+CREATE INDEX IF NOT EXISTS files_time ON files (timestamp);
+CREATE INDEX IF NOT EXISTS files_type ON files (meas_type, device);
+"""
+
+## Extensions the catalog picks up, and what kind of file they are
+catalog_kinds = {".h5" : "qick", ".npz" : "vna"}
+
+## Groups that only hold settings, not data (their entries go in cfg, not datasets)
+cfg_groups = ["meta", "hw_cfg", "meas_cfg", "rfb_cfg"]
+
+
+## Index of the measurement files under root, kept in an SQLite file (root/qick_catalog.sqlite by default)
+class dataCatalog:
+    def __init__(self, root, db_path=None):
+        self.root = os.path.abspath(root)
+        self.db_path = db_path if db_path is not None else os.path.join(self.root, "qick_catalog.sqlite")
+        self.db = sqlite3.connect(self.db_path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(catalog_schema)
+
+    def close(self):
+        self.db.close()
+
+    ## Walks the tree and indexes every file that's new or changed (by mtime and size) since the last update,
+    ## and forgets files that are gone.  Returns (indexed, unchanged, removed)
+    def update(self, verbose=True):
+        known = {row["path"] : (row["mtime"], row["size"]) for row in self.db.execute("SELECT path, mtime, size FROM files")}
+        seen = set()
+        nindexed = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                kind = catalog_kinds.get(os.path.splitext(filename)[1].lower())
+                if kind is None:
+                    continue
+                filepath = os.path.join(dirpath, filename)
+                path = os.path.relpath(filepath, self.root)
+                stat = os.stat(filepath)
+                seen.add(path)
+                if known.get(path) == (stat.st_mtime, stat.st_size):
+                    continue
+                self.index_file(path, kind, stat)
+                nindexed += 1
+                if verbose:
+                    print("Indexed", nindexed, "files", end="\r")
+        removed = [path for path in known if path not in seen]
+        for path in removed:
+            self.db.execute("DELETE FROM files WHERE path=?", (path,))
+            self.db.execute("DELETE FROM datasets WHERE path=?", (path,))
+        self.db.commit()
+        if verbose:
+            print("Catalog of", self.root + ":", nindexed, "indexed,", len(seen) - nindexed, "unchanged,", len(removed), "removed")
+        return nindexed, len(seen) - nindexed, len(removed)
+
+    ## Reads one file's metadata into the tables.  Files that can't be read (e.g. still being written) are kept with
+    ## their error and mtime -1, so the next update tries them again
+    def index_file(self, path, kind, stat):
+        filepath = os.path.join(self.root, path)
+        try:
+            if kind == "qick":
+                [info, datasets] = index_h5(filepath)
+            else:
+                [info, datasets] = index_npz(filepath)
+            mtime = stat.st_mtime
+        except Exception as error:
+            [info, datasets] = [{"error" : "%s: %s" % (type(error).__name__, error)}, {}]
+            mtime = -1
+        if info.get("timestamp") is None:
+            info["timestamp"] = stat.st_mtime
+        info.update(path=path, kind=kind, mtime=mtime, size=stat.st_size)
+        columns = list(info.keys())
+        self.db.execute("INSERT OR REPLACE INTO files (%s) VALUES (%s)" % (", ".join(columns), ", ".join("?"*len(columns))), [info[key] for key in columns])
+        self.db.execute("DELETE FROM datasets WHERE path=?", (path,))
+        self.db.executemany("INSERT INTO datasets VALUES (?, ?, ?, ?)", [(path, name, json.dumps(shape), dtype) for name, (shape, dtype) in datasets.items()])
+        return
+
+    ## Files matching every filter given, oldest first, as dicts of the files columns plus the full filepath,
+    ## its dir and filename (ready for read_H5), and qubits and cfg decoded
+    ## meas_type, device, series = exact, or glob patterns ("*CB", "freq_*")
+    ## start, stop  = times (datetime, "YYYYMMDD_HHMMSS" or unix time), inclusive
+    ## kind         = "qick" or "vna"
+    ## qubit        = files that include this qubit
+    ## dataset      = files that have this dataset, e.g. "meas_data/xi" (with its shape in the result's "shape")
+    ## cfg          = {key: value} that scalar meta/cfg entries have to equal, e.g. {"res_ch": 6, "reps": 1000}
+    def find(self, meas_type=None, device=None, series=None, start=None, stop=None, kind=None, qubit=None, config_hash=None, dataset=None, cfg=None, errors=False):
+        query = "SELECT files.*%s FROM files%s WHERE 1" % ((", datasets.shape AS shape", " JOIN datasets ON datasets.path = files.path AND datasets.name = ?") if dataset is not None else ("", ""))
+        args = [dataset] if dataset is not None else []
+        for column, value in [("meas_type", meas_type), ("device", device), ("series", series)]:
+            if value is not None:
+                query += " AND files.%s GLOB ?" % column
+                args.append(value)
+        for column, value in [("kind", kind), ("config_hash", config_hash)]:
+            if value is not None:
+                query += " AND files.%s = ?" % column
+                args.append(value)
+        if start is not None:
+            query += " AND files.timestamp >= ?"
+            args.append(to_unix_time(start))
+        if stop is not None:
+            query += " AND files.timestamp <= ?"
+            args.append(to_unix_time(stop))
+        for key, value in (cfg or {}).items():
+            query += " AND json_extract(files.cfg, ?) = ?"
+            args += ["$." + key, value]
+        if not errors:
+            query += " AND files.error IS NULL"
+        query += " ORDER BY files.timestamp"
+
+        rows = []
+        for row in self.db.execute(query, args):
+            row = dict(row)
+            row["qubits"] = json.loads(row["qubits"]) if row["qubits"] else []
+            row["cfg"] = json.loads(row["cfg"]) if row["cfg"] else {}
+            if "shape" in row:
+                row["shape"] = tuple(json.loads(row["shape"]))
+            if qubit is not None and not any(same_qubit(q, qubit) for q in row["qubits"]):
+                continue
+            row["filepath"] = os.path.join(self.root, row["path"])
+            row["dir"] = os.path.dirname(row["filepath"])
+            row["filename"] = os.path.basename(row["filepath"])
+            rows.append(row)
+        return rows
+
+    ## {dataset name: (shape, dtype)} of one file (path relative to the root, or a row from find)
+    def datasets(self, path):
+        if isinstance(path, dict):
+            path = path["path"]
+        return {row["name"] : (tuple(json.loads(row["shape"])), row["dtype"]) for row in self.db.execute("SELECT * FROM datasets WHERE path=?", (path,))}
+
+    ## Files that couldn't be read on the last update, as {path: error}
+    def errors(self):
+        return {row["path"] : row["error"] for row in self.db.execute("SELECT path, error FROM files WHERE error IS NOT NULL")}
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+
+## Metadata of a QICKdata h5 file: [files row values, {dataset name: (shape, dtype)}]
+## Only the small settings groups are read; data arrays are only looked at for their shape
+def index_h5(filepath):
+    with h5py.File(filepath, "r") as f:
+        settings = {}
+        for group in cfg_groups:
+            if group in f:
+                settings[group] = {item : read_item(f[group][item], item) for item in f[group]}
+        meta = settings.get("meta", {})
+        hw_cfg = settings.get("hw_cfg", {})
+        meas_data = f["meas_data"] if "meas_data" in f else {}
+        sweep_vars = {}
+        for axis in ["x", "y"]:
+            key = axis+"_sweepVarName"
+            if key in meas_data and meas_data[key].size == 1:
+                sweep_vars[axis] = read_item(meas_data[key], key)
+
+        datasets = {}
+        def add_dataset(name, obj):
+            if isinstance(obj, h5py.Dataset) and name.split("/")[0] not in cfg_groups:
+                datasets[name] = (list(obj.shape), str(obj.dtype))
+        f.visititems(add_dataset)
+
+    cfg = {}
+    for group in ["meas_cfg", "rfb_cfg", "hw_cfg", "meta"]:
+        cfg.update({key : json_value(value) for key, value in settings.get(group, {}).items() if is_scalar(value)})
+    info = {"series"      : meta.get("series"),
+            "timestamp"   : series_time(meta.get("series")),
+            "device"      : json_value(meta.get("device")),
+            "qubits"      : json.dumps(json_value(np.atleast_1d(meta["qubits"]).tolist())) if "qubits" in meta else None,
+            "meas_type"   : json_value(meta.get("meas_type")),
+            "config_hash" : json_value(meta.get("config_hash")),
+            "sweep_type"  : json_value(meta.get("sweep_type")),
+            "x_var"       : json_value(sweep_vars.get("x")),
+            "y_var"       : json_value(sweep_vars.get("y")),
+            "res_ch"      : json_value(hw_cfg.get("res_ch")),
+            "qu_ch"       : json_value(hw_cfg.get("qu_ch")),
+            "ro_ch"       : json_value(hw_cfg.get("ro_ch")),
+            "cfg"         : json.dumps(cfg),
+            "error"       : None}
+    return [info, datasets]
+
+## Metadata of a VNA .npz (VNA_funcs.write_file: one pickled dict saved as "data", in <series>_<label>.npz)
+## meas_type is the label.  The scans are small, so the dict is just loaded
+def index_npz(filepath):
+    with np.load(filepath, allow_pickle=True) as readin:
+        data = readin["data"].item()
+    series = data.get("series")
+    name = os.path.splitext(os.path.basename(filepath))[0]
+    label = name[len(series)+1:] if series and name.startswith(series+"_") else name
+    datasets = {key : (list(np.shape(value)), str(np.asarray(value).dtype)) for key, value in data.items() if not is_scalar(value)}
+    info = {"series"    : series,
+            "timestamp" : series_time(series),
+            "meas_type" : label,
+            "cfg"       : json.dumps({key : json_value(value) for key, value in data.items() if is_scalar(value)}),
+            "error"     : None}
+    return [info, datasets]
+
+## Unix time of a "YYYYMMDD_HHMMSS" series (None if it isn't one)
+def series_time(series):
+    try:
+        return datetime.datetime.strptime(series, '%Y%m%d_%H%M%S').timestamp()
+    except (TypeError, ValueError):
+        return None
+
+## Unix time of a datetime, a "YYYYMMDD_HHMMSS" string, or a number that already is one
+def to_unix_time(t):
+    if isinstance(t, datetime.datetime):
+        return t.timestamp()
+    if isinstance(t, str):
+        unix_time = series_time(t)
+        if unix_time is None:
+            print("Error: times are datetimes, unix times or YYYYMMDD_HHMMSS strings, not", t)
+        return unix_time
+    return float(t)
+
+## Qubits get saved as strings or as floats (["1"] comes back as [1.0]), so compare them as numbers when they are
+def same_qubit(a, b):
+    try:
+        return float(a) == float(b)
+    except (TypeError, ValueError):
+        return str(a) == str(b)
+
+def is_scalar(value):
+    return np.ndim(value) == 0
+
+## Plain python version of a value read from a file, for json and sqlite
+def json_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    if isinstance(value, list):
+        return [json_value(v) for v in value]
+    return value
@@ -41,12 +41,13 @@ class QICKdata:
     ## If you are reading in from a file, overwrite the series argument
     ## Otherwise, leave blank and let it self-populate
     def __init__(self, series=None):
-        ## HM: don't delete the clear statements! they fix the memory allocation bug
-        self.meta.clear()
-        self.hw_cfg.clear()
-        self.rfb_cfg.clear()
-        self.meas_cfg.clear()
-        self.meas_data.clear()
+        ## Every measurement gets its own dictionaries.  (The class-level ones used to be cleared here instead,
+        ## which wiped any other measurement still alive, e.g. one running on a second board)
+        self.meta      = {}
+        self.hw_cfg    = {}
+        self.rfb_cfg   = {}
+        self.meas_cfg  = {}
+        self.meas_data = {}
         if series is None:
             series = str(datetime.datetime.now().strftime('%Y%m%d_%H%M%S'))
         self.meta["series"] = series
@@ -79,17 +80,20 @@ class QICKdata:
         return
 
     ## Dumps everything in the class into an h5 file
-    def write_H5(self, datapath):
+    ## Numbers keep their own dtype (ints, bools, complex...).  Datasets big enough to be worth it are chunked and
+    ## compressed with compression ("gzip", "lzf" or None, see storage_options).  compact_iq=True stores the IQ data
+    ## (iq_keys, and anything complex in meas_data) in single precision: float32, or complex64 = float32 pairs
+    def write_H5(self, datapath, compression="gzip", compact_iq=False):
         
         ## Follow filepath.  If filpath doesn't exist, make it exist
         if not os.path.exists(datapath):
             print("Datapath doesn't exist yet. Making new datapath")
             os.makedirs(datapath)
-        os.chdir(datapath)
         filename = self.meta["series"]+"_"+self.meta["meas_type"]+".h5"
         print("Saving data as:", filename)
 
-        with h5py.File(filename, "w") as f:
+        ## No chdir: sweeps on other boards may be saving from other threads
+        with h5py.File(os.path.join(datapath, filename), "w") as f:
             
             ## Make a group for each of the 5 dictionaries
             G_meta      = f.create_group("meta")
@@ -103,28 +107,249 @@ class QICKdata:
             
             ## Iterate through dictionaries, record each variable into the corresponding group
             for i, dict in enumerate(dicts_list):
-                for dset in dict:
-                    if dict[dset] is None:
-                        continue
-                    elif (isinstance(dict[dset], str)): 
-                        groups_list[i].create_dataset(dset, data=np.array([dict[dset]], dtype='S'))
-                    elif (isinstance(dict[dset],int)):
-                        groups_list[i].create_dataset(dset, data=np.array([dict[dset]]))
-                    else:
-                        groups_list[i].create_dataset(dset, data=np.array(dict[dset]).astype(float))       
+                compact_keys = compact_iq_keys(dict) if (compact_iq and dict is self.meas_data) else ()
+                write_dict_to_group(groups_list[i], dict, compression=compression, compact_keys=compact_keys)
+            label_sweep_axes(G_meas_data, self.meas_data)
             f.close()
         return
+
+    ## Opens an h5 file that a sweep can stream its data into as it runs (see H5streamWriter)
+    ## Everything already in the class is written up front, and the datasets in stream_shapes are preallocated
+    def open_H5_stream(self, datapath, stream_shapes, swmr=True):
+        return H5streamWriter(self, datapath, stream_shapes, swmr=swmr)
+
+    ## Reopens the stream file of an interrupted sweep so the sweep can pick up where it stopped
+    ## The file has to come from this same measurement: its config_hash (set by the sweep before it
+    ## opens the stream) and the shapes of its streamed datasets have to match.  The series is taken from the file.
+    ## Returns (writer, {dataset name: data so far, NaN where missing}), or (None, None) if the file can't be resumed
+    def resume_H5_stream(self, filepath, stream_shapes, swmr=True):
+        if not os.path.exists(filepath):
+            print("Error: can't resume, file not found:", filepath)
+            return None, None
+        [file_meta, previous] = read_H5_stream(filepath, stream_shapes.keys())
+        if file_meta.get("config_hash") != self.meta.get("config_hash"):
+            print("Error: can't resume", os.path.basename(filepath))
+            print("the config or sweep values are different from the ones it was taken with")
+            return None, None
+        for key in stream_shapes:
+            if key not in previous or previous[key].shape != tuple(stream_shapes[key]):
+                print("Error: can't resume", os.path.basename(filepath))
+                print("dataset", key, "is missing or the wrong shape")
+                return None, None
+        if file_meta["series"] != self.meta["series"]:
+            print("Resuming series", file_meta["series"])
+            self.meta["series"] = file_meta["series"]
+
+        ## The file is rewritten from scratch (so it doesn't matter if the crash left it locked for writing), next to the
+        ## old one, which is only replaced once the new one has everything in it
+        writer = H5streamWriter(self, os.path.dirname(filepath), stream_shapes, swmr=swmr, initial=previous, previous_file=filepath)
+        return writer, previous
+
+
+## meas_data entries that hold IQ data, and can be stored in single precision (see write_H5's compact_iq)
+iq_keys = ["xi", "xq", "output_decimated", "decimated_snapshots", "shot_mean_i", "shot_mean_q", "raw_shots_i", "raw_shots_q"]
+
+## Smallest dataset that gets chunked and compressed.  Below this the chunk index costs more than compression saves
+min_compress_bytes = 16*1024
+## Size chunks aim for: big enough for the compressor to work well, small enough that reading a slice stays cheap
+chunk_bytes = 256*1024
+
+## Records each variable of a dictionary into an h5 group
+## Numbers keep their dtype (anything that isn't a number array is saved as floats, as it always was)
+## compression  = "gzip", "lzf" or None, for the datasets big enough to be worth it (see storage_options)
+## compact_keys = entries to store in single precision (float32, complex64)
+def write_dict_to_group(group, dict, skip=(), compression=None, compact_keys=()):
+    for dset in dict:
+        if dict[dset] is None or dset in skip:
+            continue
+        elif (isinstance(dict[dset], str)): 
+            group.create_dataset(dset, data=np.array([dict[dset]], dtype='S'))
+        elif (isinstance(dict[dset],int)):
+            group.create_dataset(dset, data=np.array([dict[dset]]))
+        elif (np.array(dict[dset]).dtype.kind == 'U') and not is_numeric_strings(dict[dset]):
+            group.create_dataset(dset, data=np.array(dict[dset], dtype='S'))    ## lists of names, e.g. sweep_axes
+        else:
+            data = np.asarray(dict[dset])
+            if data.dtype.kind not in "biufc":
+                data = data.astype(float)
+            if dset in compact_keys and data.dtype.kind in "fc":
+                data = data.astype(np.complex64 if data.dtype.kind == "c" else np.float32)
+            group.create_dataset(dset, data=data, **storage_options(data, compression))
+    return
+
+## IQ entries of meas_data that compact_iq stores in single precision: the iq_keys, plus every complex array
+def compact_iq_keys(meas_data):
+    return [key for key in meas_data if key in iq_keys or np.asarray(meas_data[key]).dtype.kind == "c"]
+
+## create_dataset arguments for storing data: nothing for small datasets, otherwise chunks (see chunk_shape) with
+## the byte shuffle filter (which is what makes float data compress, ADC values especially) and the compressor
+## compression = "gzip" (level 4: smaller files) or "lzf" (faster, a bit bigger).  Both come with every h5py
+def storage_options(data, compression="gzip"):
+    if compression is None or data.ndim == 0 or data.nbytes < min_compress_bytes:
+        return {}
+    opts = {"chunks" : chunk_shape(data.shape, data.dtype.itemsize), "shuffle" : True}
+    if compression == "gzip":
+        opts.update(compression="gzip", compression_opts=4)
+    elif compression == "lzf":
+        opts["compression"] = "lzf"
+    else:
+        print("Warning: unknown compression", compression, "- options are gzip, lzf or None.  Saving uncompressed")
+        return {}
+    return opts
+
+## Chunk shape of about chunk_bytes: whole rows along the last axes, as many as fit
+## e.g. a (200, 400) float map is stored in (81, 400) blocks, so any row or full map read only inflates what it needs
+def chunk_shape(shape, itemsize, target=chunk_bytes):
+    chunk = [1]*len(shape)
+    room = max(target // itemsize, 1)
+    for k in reversed(range(len(shape))):
+        if room < 1:
+            break
+        chunk[k] = int(max(1, min(shape[k], room)))
+        room //= max(shape[k], 1)
+    return tuple(chunk)
+
+## True if every string in a list reads as a number (like qubits=["1", "2"], which is saved as floats)
+def is_numeric_strings(vals):
+    try:
+        np.array(vals).astype(float)
+    except ValueError:
+        return False
+    return True
+
+## Labels the dimensions of xi/xq with the sweep axes of an N-D sweep (see qick_ndSweep.py)
+## Each sweepVals_<name> dataset becomes an HDF5 dimension scale, so h5py/xarray see which axis is which
+def label_sweep_axes(group, meas_data):
+    if "sweep_axes" not in meas_data:
+        return
+    names = meas_data["sweep_axes"]
+    if isinstance(names, str):
+        names = [names]
+    for k, name in enumerate(names):
+        if "sweepVals_"+name not in group:
+            continue
+        scale = group["sweepVals_"+name]
+        scale.make_scale(name)
+        for key in ["xi", "xq"]:
+            if key in group and group[key].ndim == len(names):
+                group[key].dims[k].label = name
+                group[key].dims[k].attach_scale(scale)
+    return
+
+
+## Writes a sweep into its h5 file while it's running, so a crash only loses the points in flight
+## stream_shapes = {dataset name: full shape} for the meas_data entries that get filled in as the sweep runs.
+## These are preallocated as chunked, resizable datasets full of NaN.  With swmr=True the file is in
+## single-writer/multiple-reader mode, so notebooks can open it with h5py.File(fn, "r", swmr=True) and watch it fill up.
+## initial = {dataset name: array} to prefill the streamed datasets with (used when resuming)
+## previous_file = the file being resumed.  Every meas_data entry in it that isn't streamed or in the class (e.g. snapshots
+## the first run saved) is copied across.  The new file is built under a temporary name and only moved over the old
+## one when it's complete, so a crash while resuming still leaves the old file
+class H5streamWriter:
+    def __init__(self, dataclass, datapath, stream_shapes, swmr=True, initial=None, previous_file=None):
+        if not os.path.exists(datapath):
+            print("Datapath doesn't exist yet. Making new datapath")
+            os.makedirs(datapath)
+        self.dataclass = dataclass
+        self.filename = dataclass.meta["series"]+"_"+dataclass.meta["meas_type"]+".h5"
+        self.filepath = os.path.join(datapath, self.filename)
+        self.stream_keys = list(stream_shapes.keys())
+        print("Streaming data to:", self.filename)
+
+        build_path = self.filepath if previous_file is None else self.filepath+".resuming"
+        self.f = h5py.File(build_path, "w", libver="latest")
+        groups = {"meta" : dataclass.meta, "hw_cfg" : dataclass.hw_cfg, "meas_cfg" : dataclass.meas_cfg, "meas_data" : dataclass.meas_data}
+        for name in groups:
+            write_dict_to_group(self.f.create_group(name), groups[name], skip=self.stream_keys)
+
+        ## Preallocate everything that will be streamed
+        for key in self.stream_keys:
+            shape = tuple(stream_shapes[key])
+            self.f["meas_data"].create_dataset(key, shape=shape, maxshape=(None,)*len(shape), chunks=True,
+                                                  dtype=float, fillvalue=np.nan)
+            if initial is not None and key in initial:
+                self.f["meas_data"][key][...] = initial[key]
+
+        ## Carry over what else the interrupted run had saved, then swap the new file in
+        self.carried = []
+        if previous_file is not None:
+            with open_stream_file(previous_file) as old:
+                for key in old["meas_data"]:
+                    if key not in self.f["meas_data"]:
+                        old.copy(old["meas_data"][key], self.f["meas_data"], name=key)
+                        self.carried.append(key)
+            self.f.close()
+            os.replace(build_path, self.filepath)
+            self.f = h5py.File(self.filepath, "r+", libver="latest")
+
+        ## No new objects can be made once SWMR is on
+        if swmr:
+            self.f.swmr_mode = True
+        self.f.flush()
+        return
+
+    ## Writes one block of streamed data and flushes it to disk
+    ## index = numpy-style index into the preallocated datasets, e.g. (slice(None), i) for column i of a 2D map
+    ## Set flush=False to batch up several small writes (nothing is guaranteed on disk until the next flush)
+    def write(self, index, flush=True, **arrays):
+        for key in arrays:
+            self.f["meas_data"][key][index] = arrays[key]
+        if flush:
+            self.f.flush()
+        return
+
+    ## Closes the stream.  Anything in meas_data that wasn't written yet (e.g. output_decimated) gets added now,
+    ## along with any meta entries that were set while the sweep was running.  Entries carried over from the resumed
+    ## file are replaced by this run's, if it has them
+    def close(self):
+        self.f.close()
+        with h5py.File(self.filepath, "a") as f:
+            for key in self.carried:
+                if key in self.dataclass.meas_data:
+                    del f["meas_data"][key]
+            for name, dict in [("meta", self.dataclass.meta), ("meas_data", self.dataclass.meas_data)]:
+                new_items = {key : dict[key] for key in dict if key not in f[name]}
+                write_dict_to_group(f[name], new_items, skip=self.stream_keys, compression="gzip")
+        print("Saved data as:", self.filename)
+        return
     
 
+## Reads the meta group and the given meas_data datasets out of a (possibly half written) stream file
+## A writer that died without closing leaves the file flagged as open, so it's read in SWMR mode
+## Returns [meta dict, {dataset name: array}]
+def read_H5_stream(filepath, stream_keys):
+    with open_stream_file(filepath) as f:
+        meta = {}
+        for item in f["meta"]:
+            readin = f["meta"][item][()]
+            if isinstance(readin, np.ndarray) and readin.ndim == 1 and len(readin)==1 and item!="qubits":
+                [readin] = readin
+            if type(readin) == np.bytes_:
+                readin = readin.decode("utf-8")
+            meta[item] = readin
+        data = {key : f["meas_data"][key][()] for key in stream_keys if key in f["meas_data"]}
+    return [meta, data]
+
+
+## Opens a stream file for reading, in SWMR mode if it's still (or was left) flagged as open for writing
+def open_stream_file(filepath):
+    try:
+        return h5py.File(filepath, "r", libver="latest", swmr=True)
+    except OSError:
+        return h5py.File(filepath, "r")
+
+
 ## Reads in an H5, populates class
 ## Arguments: datapath, filename, class to populate
-def read_H5(datapath, filename, dataclass, debug=False):
+## lazy=True parses meta and the cfgs but leaves the big meas_data entries on disk (see lazy_dataset): they're read
+## when they're used, and only as much as gets sliced.  meta_only=True doesn't look at meas_data at all
+def read_H5(datapath, filename, dataclass, debug=False, lazy=False, meta_only=False):
     if not os.path.exists(datapath):
         exit("Error: invalid datapath")
-    os.chdir(datapath)
     print("Reading from filepath", datapath)
+    filepath = os.path.join(datapath, filename)
 
-    with h5py.File(filename, 'r') as f:
+    with h5py.File(filepath, 'r') as f:
         ## Get series number
         _sers = f["meta"]["series"][0].decode('UTF-8')
         if(debug): print("opening file with series:", _sers)
@@ -143,24 +368,99 @@ def read_H5(datapath, filename, dataclass, debug=False):
                 
         ## Iterate through groups, look at items
         for group in groups:
+            if group == "meas_data" and meta_only:
+                setattr(d, group, {})
+                continue
             items = [i for i in f[group]]
             values = []
             ## Iterate through items, import them
             for item in items:
                 if(debug): print(item)
-                readin = f[group][item][()]
-                ## Fix formatting of scalar quantities
-                if (type(readin) != np.float64):
-                    if (len(readin)==1 and item!="qubits"):
-                        [readin] = readin
-                ## Fix formatting of strings
-                if (type(readin) == np.bytes_):
-                    readin = readin.decode("utf-8")
-                values.append(readin)
+                dataset = f[group][item]
+                if lazy and group == "meas_data" and dataset.nbytes >= min_compress_bytes:
+                    values.append(lazy_dataset(filepath, dataset))
+                else:
+                    values.append(read_item(dataset, item))
             ## Save item to dataclass  
             dictionary = dict(zip(items, values))
             if debug: print(dictionary)
             setattr(d, group, dictionary)
 
         f.close()
-    return d
\ No newline at end of file
+    return d
+
+## Reads one dataset the way read_H5 stores it in the class: one element arrays become scalars, bytes become str
+def read_item(dataset, item):
+    readin = dataset[()]
+    ## Fix formatting of scalar quantities (saved as one element arrays; true scalars come back as is)
+    if isinstance(readin, np.ndarray) and readin.ndim == 1:
+        if (len(readin)==1 and item!="qubits"):
+            [readin] = readin
+    ## Fix formatting of strings
+    if (type(readin) == np.bytes_):
+        readin = readin.decode("utf-8")
+    elif isinstance(readin, np.ndarray) and readin.dtype.kind == 'S':
+        readin = [name.decode("utf-8") for name in readin]
+    return readin
+
+## A big meas_data entry, left on disk: a read-only np.memmap for contiguous, uncompressed datasets (a normal numpy
+## array that the OS pages in as it's used), otherwise an h5Array that reads the slices it's indexed with
+## A memmap keeps the file mapped (and, on Windows, locked against being overwritten or deleted) until it and every
+## view of it are gone: del the entry, or use load_lazy to swap everything for in-memory copies
+def lazy_dataset(filepath, dataset):
+    offset = dataset.id.get_offset()
+    if dataset.chunks is None and dataset.compression is None and offset is not None and dataset.dtype.kind in "biufc":
+        return np.memmap(filepath, mode="r", dtype=dataset.dtype, shape=dataset.shape, offset=offset)
+    return h5Array(filepath, dataset.name, dataset.shape, dataset.dtype)
+
+## Reads every lazy meas_data entry of a read_H5(..., lazy=True) measurement into memory, which unmaps the file
+## (as long as nothing else still holds a slice of a memmap).  Returns the measurement
+def load_lazy(d):
+    for key, value in d.meas_data.items():
+        if isinstance(value, (np.memmap, h5Array)):
+            d.meas_data[key] = np.array(value)
+    return d
+
+
+## A dataset in an h5 file, read only when it's used, and only as much as it's sliced: a[10:20] reads ten rows
+## The file is only opened for each read, so any number of these can be kept without holding files open.
+## Numpy functions and arithmetic (np.abs(a), a + 1j*b, ...) read the whole thing and work on that, and so do
+## ndarray attributes and methods it doesn't have itself (a.T, a.max(), a.mean(axis=0), a.copy(), ...)
+class h5Array(np.lib.mixins.NDArrayOperatorsMixin):
+    def __init__(self, filepath, name, shape, dtype):
+        self.filepath = filepath
+        self.name     = name
+        self.shape    = tuple(shape)
+        self.dtype    = np.dtype(dtype)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return "h5Array(%s:%s, shape=%s, dtype=%s)" % (os.path.basename(self.filepath), self.name, self.shape, self.dtype)
+
+    def __getitem__(self, index):
+        with h5py.File(self.filepath, "r") as f:
+            return f[self.name][index]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[()]
+        return data if dtype is None else data.astype(dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = [np.asarray(x) if isinstance(x, h5Array) else x for x in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    ## Only called for attributes h5Array doesn't have: reads the whole dataset and takes it from that
+    def __getattr__(self, attr):
+        if attr.startswith("_") or attr in ["filepath", "name", "shape", "dtype"]:
+            raise AttributeError(attr)
+        return getattr(self[()], attr)
@@ -11,6 +11,7 @@
 #
 #----------------------------------------------------------------------
 import numpy as np
+import weakref
 
 ## ADC and DAC mapping
 transmission_ch = 6   ## DAC
@@ -18,62 +19,214 @@ chargebias_ch   = 4   ## DAC
 ro_ch           = 1   ## ADC
 
 
-## This is just Ryan's function, but with a different variable naming convention
+## Acquires a program on a real QickSoc, or on a simulated one (see qick_simulator.py)
+## The simulator can't run tProc binaries, so it's handed the program itself
+def acquire_prog(prog, soc, **kwargs):
+        if getattr(soc, "is_simulated", False):
+                return soc.acquire(prog, **kwargs)
+        return prog.acquire(soc, **kwargs)
+
+def acquire_decimated_prog(prog, soc, **kwargs):
+        if getattr(soc, "is_simulated", False):
+                return soc.acquire_decimated(prog, **kwargs)
+        return prog.acquire_decimated(soc, **kwargs)
+
+## Runs an AveragerProgram and yields its single shots one round (soft_avg) at a time, instead of averaging them
+## Each round is [(I, Q) per readout], reps shots long and normalized to the readout window like acquire's output,
+## so memory only ever holds reps shots however many rounds there are
+def stream_shots_prog(prog, soc, load_pulses=True):
+        if getattr(soc, "is_simulated", False):
+                yield from soc.stream_shots(prog, load_pulses=load_pulses)
+                return
+        prog.acquire(soc, load_pulses=load_pulses, progress=False, step_rounds=True)
+        while True:
+                more = prog.finish_round()
+                shots = []
+                for i, (ch, ro) in enumerate(prog.ro_chs.items()):
+                        raw = prog.get_raw()[i].reshape((-1, 2))/ro['length'] - prog.soccfg['readouts'][ch]['iq_offset']
+                        shots.append((raw[:, 0], raw[:, 1]))
+                yield shots
+                if not more:
+                        break
+                prog.prepare_round()
+
+
+## Which generator's clock each _us parameter is converted with: key -> hw_cfg channel key (None = tProc clock)
+## Keys that aren't listed go by their prefix (time_var_prefixes), and anything else uses the resonator channel,
+## so new _us parameters get converted without touching this file
+## delay is a sync_all/sync wait between the two tones, so it's counted by the tProc
+time_var_channels = {
+        "adc_trig_offset_us" : "res_ch",
+        "readout_length_us"  : "res_ch",
+        "relax_delay_us"     : "res_ch",
+        "delay_us"           : None,
+}
+time_var_prefixes = {
+        "qu_"    : "qu_ch",
+        "laser_" : "laser_ch",
+        "res_"   : "res_ch",
+}
+
+## Returns the hw_cfg channel key whose clock a _us parameter is counted in
+def time_var_channel(key):
+        if key in time_var_channels:
+                return time_var_channels[key]
+        for prefix in time_var_prefixes:
+                if key.startswith(prefix):
+                        return time_var_prefixes[prefix]
+        return "res_ch"
+
+## Fabric clock of every generator (and the tProc clock), read out of soccfg once and kept for as long as soccfg is
+## A soccfg that can't be weakly referenced (e.g. a plain dict) is read every time
+_clock_cache = weakref.WeakKeyDictionary()
+def get_gen_clocks(soccfg):
+        try:
+                return _clock_cache[soccfg]
+        except (KeyError, TypeError):
+                pass
+        clocks = {ch : gen['f_fabric'] for ch, gen in enumerate(soccfg['gens'])}
+        clocks[None] = soccfg['tprocs'][0]['f_time']
+        try:
+                _clock_cache[soccfg] = clocks
+        except TypeError:
+                pass
+        return clocks
+
+## Same rounding as soccfg.us2cycles, but for a whole array at once
+## gen_ch=None counts in tProc clock ticks.  Scalars come back as int, arrays as an int array
+def us2cycles_vec(soccfg, us, gen_ch=None):
+        cycles = np.round(np.asarray(us, dtype=float)*get_gen_clocks(soccfg)[gen_ch]).astype(int)
+        if cycles.ndim == 0:
+                return int(cycles)
+        return cycles
+
+## Converts every *_us entry of meas_cfg into clock ticks, in the clock of the channel that plays it (see time_var_channel)
+## The _us originals are kept next to the converted values, so the saved config shows what was asked for
 def convert_time_vars(soccfg, meas_class, verbose=False):
         print("converting time variables from us to clock ticks")
-        if ("adc_trig_offset_us" not in meas_class.meas_cfg):
-                if(verbose): print('adc_trig_offset not in meas_cfg')
-        else:
-                meas_class.meas_cfg["adc_trig_offset"] = soccfg.us2cycles(meas_class.meas_cfg["adc_trig_offset_us"],gen_ch=meas_class.hw_cfg["res_ch"])
-                del meas_class.meas_cfg["adc_trig_offset_us"]
-        #-----------------------------------------------------
-        if ("readout_length_us" not in meas_class.meas_cfg):
-                if(verbose): print('readout length is not in meas_cfg')
-        else:
-                meas_class.meas_cfg["readout_length"] = soccfg.us2cycles(meas_class.meas_cfg["readout_length_us"],gen_ch=meas_class.hw_cfg["res_ch"])
-                del meas_class.meas_cfg["readout_length_us"]        
-        #-----------------------------------------------------
-        if ("res_length_us" not in meas_class.meas_cfg):
-                if(verbose): print('res_length is not in meas_cfg')
-        else:
-                meas_class.meas_cfg["res_length"] = soccfg.us2cycles(meas_class.meas_cfg["res_length_us"],gen_ch=meas_class.hw_cfg["res_ch"])
-                del meas_class.meas_cfg["res_length_us"]                
-        #-----------------------------------------------------
-        if ("qu_length_us" not in meas_class.meas_cfg):
-                if(verbose): print('qu_length is not in meas_cfg')
-        else:
-                meas_class.meas_cfg["qu_length"] = soccfg.us2cycles(meas_class.meas_cfg["qu_length_us"],gen_ch=meas_class.hw_cfg["qu_ch"]) 
-                del meas_class.meas_cfg["qu_length_us"]                
-        #-----------------------------------------------------
-        if ("relax_delay_us" not in meas_class.meas_cfg):
-                if(verbose): print('relax delay us is not in meas_cfg')
-        else:
-                meas_class.meas_cfg["relax_delay"] = soccfg.us2cycles(meas_class.meas_cfg["relax_delay_us"],gen_ch=meas_class.hw_cfg["res_ch"])
-                del meas_class.meas_cfg["relax_delay_us"]
-        #-----------------------------------------------------                
-        if ("delay_us" not in meas_class.meas_cfg):
-                if(verbose): print('delay us is not in meas_cfg')
-        else:
-                meas_class.meas_cfg["delay"] = soccfg.us2cycles(meas_class.meas_cfg["delay_us"],gen_ch=meas_class.hw_cfg["res_ch"])
-                del meas_class.meas_cfg["delay_us"]
-        #-----------------------------------------------------                
-        if ("qu_sigma_us" not in meas_class.meas_cfg):
-                if(verbose): print('qu_sigma_us is not in meas_cfg')
-        else:
-                meas_class.meas_cfg["qu_sigma"] = soccfg.us2cycles(meas_class.meas_cfg["qu_sigma_us"],gen_ch=meas_class.hw_cfg["qu_ch"])
-                del meas_class.meas_cfg["qu_sigma_us"]
-        #-----------------------------------------------------                                
-        if ("res_sigma_us" not in meas_class.meas_cfg):
-                if(verbose): print('res_sigma_us is not in meas_cfg')
-        else:
-                meas_class.meas_cfg["res_sigma"] = soccfg.us2cycles(meas_class.meas_cfg["res_sigma_us"],gen_ch=meas_class.hw_cfg["res_ch"])
-                del meas_class.meas_cfg["res_sigma_us"]
-        #-----------------------------------------------------                
-        if ("laser_length_us" not in meas_class.meas_cfg):
-                if(verbose): print('laser length is not in meas_cfg')
+        for key in [key for key in meas_class.meas_cfg if key[-3:] == "_us" and meas_class.meas_cfg[key] is not None]:
+                ch_key = time_var_channel(key)
+                if ch_key is not None and ch_key not in meas_class.hw_cfg:
+                        print("Warning:", ch_key, "is not in hw_cfg, converting", key, "with the tProc clock")
+                gen_ch = meas_class.hw_cfg.get(ch_key)
+                meas_class.meas_cfg[key[:-3]] = us2cycles_vec(soccfg, meas_class.meas_cfg[key], gen_ch)
+                if(verbose): print(key, "->", key[:-3], "=", meas_class.meas_cfg[key[:-3]], "on channel", gen_ch)
+        return meas_class
+
+
+
+#----------------------------------------------------------------------
+# Compiled program cache
+#----------------------------------------------------------------------
+import hashlib
+from collections import OrderedDict
+
+## Config keys that can be swept by patching one register of an already-built program
+## key -> (hw_cfg channel key, register name)
+patchable_regs = {
+        "res_freq"  : ("res_ch", "freq"),
+        "res_gain"  : ("res_ch", "gain"),
+        "res_phase" : ("res_ch", "phase"),
+        "qu_freq"   : ("qu_ch", "freq"),
+        "qu_gain"   : ("qu_ch", "gain"),
+        "qu_phase"  : ("qu_ch", "phase"),
+}
+
+## Stable hash of a config dict, ignoring the keys in exclude
+def config_hash(config, exclude=()):
+        items = []
+        for key in sorted(config):
+                if key in exclude:
+                        continue
+                val = config[key]
+                if isinstance(val, np.ndarray):
+                        val = val.tolist()
+                items.append((key, repr(val)))
+        return hashlib.sha1(repr(items).encode("utf-8")).hexdigest()
+
+## Holds one compiled program per unique (program class, non-swept config)
+## Later points with the same skeleton only get their swept registers rewritten
+## max_progs = most programs kept; the least recently used one is dropped to make room for a new one
+class programCache:
+        def __init__(self, max_progs=64):
+                self.progs     = OrderedDict()
+                self.max_progs = max_progs
+                self.hits      = 0
+                self.misses    = 0
+
+        def __str__(self):
+                return "programCache: %d programs, %d hits, %d misses" % (len(self.progs), self.hits, self.misses)
+
+        def clear(self):
+                self.progs.clear()
+                self.hits   = 0
+                self.misses = 0
+
+        ## Returns a program for this config, building it only if the skeleton hasn't been seen before
+        ## patch_keys = swept config keys that should be patched instead of triggering a rebuild
+        ## Sweeps of keys that can't be patched change the skeleton on every point, so those programs aren't kept
+        def get(self, prog_class, soccfg, config, patch_keys=()):
+                swept = len(patch_keys) > 0
+                patch_keys = [key for key in patch_keys if key in patchable_regs and config.get(patchable_regs[key][0]) is not None]
+                key = (prog_class.__name__, config_hash(config, exclude=patch_keys))
+                prog = self.progs.get(key)
+                if prog is None:
+                        self.misses += 1
+                        ## programs keep a reference to their config, so give them their own copy
+                        prog = prog_class(soccfg, dict(config))
+                        if swept and len(patch_keys) == 0:
+                                return prog
+                        self.progs[key] = prog
+                        while len(self.progs) > self.max_progs:
+                                self.progs.popitem(last=False)
+                        return prog
+                self.hits += 1
+                self.progs.move_to_end(key)
+                for patch_key in patch_keys:
+                        if prog.cfg[patch_key] != config[patch_key]:
+                                patch_register(prog, patch_key, config[patch_key])
+                return prog
+
+## Rewrites the initial value of a swept register in a built program
+def patch_register(prog, key, val):
+        ch_key, reg_name = patchable_regs[key]
+        cfg    = prog.cfg
+        gen_ch = cfg[ch_key]
+        if reg_name == "freq":
+                regval = prog.freq2reg(val, gen_ch=gen_ch, ro_ch=cfg["ro_ch"])
+                ## PYNQ-configured readouts pick their frequency up from ro_chs when the program is loaded
+                if key == "res_freq" and cfg["ro_ch"] in prog.ro_chs and "freq" in prog.ro_chs[cfg["ro_ch"]]:
+                        prog.ro_chs[cfg["ro_ch"]]["freq"] = val
+        elif reg_name == "phase":
+                regval = prog.deg2reg(val, gen_ch=gen_ch)
         else:
-                meas_class.meas_cfg["laser_length"] = soccfg.us2cycles(meas_class.meas_cfg["laser_length_us"],gen_ch=meas_class.hw_cfg["laser_ch"])
-                del meas_class.meas_cfg["laser_length_us"]
+                regval = int(val)
+        rp = prog.ch_page(gen_ch)
+        r  = prog.sreg(gen_ch, reg_name)
 
-        return meas_class
+        ## Find the regwi (+ bitwi/mathi for >30 bit values) block that first loads this register
+        start = None
+        for i, inst in enumerate(prog.prog_list):
+                if inst["name"] == "regwi" and inst["args"][0] == rp and inst["args"][1] == r:
+                        start = i
+                        break
+        if start is None:
+                raise RuntimeError("couldn't find where %s is loaded in %s" % (key, type(prog).__name__))
+        stop = start + 1
+        while (stop < len(prog.prog_list) and prog.prog_list[stop]["name"] in ["bitwi", "mathi"]
+                        and prog.prog_list[stop]["args"][0] == rp and prog.prog_list[stop]["args"][1] == r):
+                stop += 1
+
+        ## Let safe_regwi generate the replacement instructions, then splice them in
+        prog_list = prog.prog_list
+        prog.prog_list = []
+        prog.safe_regwi(rp, r, regval, "%s = %d" % (reg_name, regval))
+        new_insts = prog.prog_list
+        if "label" in prog_list[start]:
+                new_insts[0]["label"] = prog_list[start]["label"]
+        prog.prog_list = prog_list[:start] + new_insts + prog_list[stop:]
 
+        ## Force a recompile on the next load
+        prog.binprog = None
+        cfg[key] = val
+        return prog
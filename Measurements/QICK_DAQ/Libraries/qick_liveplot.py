@@ -0,0 +1,206 @@
+import numpy as np
+import threading
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+#----------------------------------------------------------------------
+#
+# qick_liveplot.py
+# Oct 2024
+#
+# Live view of a oneToneSweep while it runs: the trace (1D) or the
+# amplitude/phase heatmap (2D) fills in as points come in.
+#
+#    live = liveView(meas)
+#    live.run(meas.do_soft_2D_measurement, soc, soccfg, datapath=datapath, use_cache=True)
+#
+# run() takes data on a worker thread and draws on the calling thread,
+# so drawing never holds up the board.  The sweep only copies each
+# point into the view's buffer; the figure is redrawn at most once per
+# interval, and only if something new came in.  Window backends that
+# can blit (Qt, Tk) only re-render the trace/image and title, with a
+# full redraw only when the data outgrows the axis or colour limits;
+# other interactive ones (ipympl's %matplotlib widget) redraw the
+# figure.  With the inline backend the figure is re-sent to the
+# notebook cell, and without a display (agg) it's just kept up to date.
+# Remote (executor) sweeps fill in a row at a time as rows arrive from
+# the board; firmware (hard_sweep) sweeps only return at the end, so
+# they show up in one go.
+#
+#----------------------------------------------------------------------
+
+## Notebook backends without a live canvas, where the figure gets re-displayed in the cell instead
+inline_backends = ["module://matplotlib_inline.backend_inline", "inline"]
+
+## Live trace or heatmap of a measurement's x (and y) sweep
+## interval = seconds between redraws (at most)
+## quantity = "amp" or "phase", for 2D maps
+class liveView:
+    def __init__(self, meas, interval=0.5, quantity="amp"):
+        meas_data = meas.meas_data
+        if "x_sweepVals" not in meas_data.keys():
+            print("Error: x sweep values not found, set them before making the live view")
+            return
+        self.x        = np.asarray(meas_data["x_sweepVals"])
+        self.xname    = meas_data["x_sweepVarName"]
+        self.y        = np.asarray(meas_data["y_sweepVals"]) if "y_sweepVals" in meas_data.keys() else None
+        self.yname    = meas_data.get("y_sweepVarName")
+        self.shape    = (len(self.x),) if self.y is None else (len(self.y), len(self.x))
+        self.title    = meas.meta.get("meas_type", "") + "\n" + meas.meta.get("series", "")
+        self.interval = interval
+        self.quantity = quantity
+
+        self.data     = np.full(self.shape, np.nan, dtype=complex)
+        self.lock     = threading.Lock()
+        self.dirty    = False
+        self.npoints  = 0
+        self.fig      = None
+
+    ## Acquisition side: these only copy into the buffer, so they're safe (and cheap) to call from the sweep thread
+
+    ## One point; index is an int (1D) or a (y, x) tuple (2D).  I and Q can also be arrays, for a row of points at once
+    ## (index is then an array of positions, or a tuple with a slice in it)
+    def add_point(self, index, I, Q):
+        with self.lock:
+            self.data[index] = np.asarray(I) + 1j*np.asarray(Q)
+            self.npoints += np.size(I)
+            self.dirty = True
+
+    ## All the data at once, NaN where there's none yet (e.g. what a resumed file already had)
+    def set_data(self, xi, xq):
+        with self.lock:
+            self.data = np.asarray(xi) + 1j*np.asarray(xq)
+            self.npoints = np.count_nonzero(~np.isnan(self.data))
+            self.dirty = True
+
+    ## Drawing side: only call these from the thread that owns the figure
+
+    ## Runs func(*args, live_view=self, **kwargs) on a worker thread, redrawing here until it's done
+    ## Returns what func returns, or raises what it raised.  Pyro4 proxies passed as arguments are handed over to the
+    ## worker and taken back afterwards.  ctrl-c stops the drawing, but the sweep runs on until it finishes
+    def run(self, func, *args, **kwargs):
+        kwargs["live_view"] = self
+        proxies = [arg for arg in args if hasattr(arg, "_pyroClaimOwnership")]
+        result = {}
+        def work():
+            for proxy in proxies:
+                proxy._pyroClaimOwnership()
+            try:
+                result["value"] = func(*args, **kwargs)
+            except BaseException as error:
+                result["error"] = error
+        self.show()
+        worker = threading.Thread(target=work, name="sweep", daemon=True)
+        worker.start()
+        try:
+            while worker.is_alive():
+                self.fig.canvas.start_event_loop(self.interval)
+                self.render()
+        except KeyboardInterrupt:
+            print("Warning: stopped the live view.  The sweep keeps running in the background until it finishes")
+            raise
+        worker.join()
+        for proxy in proxies:
+            proxy._pyroClaimOwnership()
+        self.render(force=True)
+        if self.inline:
+            plt.close(self.fig)    ## it's already in the cell, don't show it twice
+        if "error" in result:
+            raise result["error"]
+        return result.get("value")
+
+    ## Makes the figure, with the same axes and labels as plot_1D_measurement / plot_2D_heatmap
+    def show(self):
+        self.inline = matplotlib.get_backend() in inline_backends
+        self.fig, self.ax = plt.subplots()
+        self.window = type(self.fig.canvas) is not FigureCanvasAgg
+        self.blit = self.window and self.fig.canvas.supports_blit
+        if self.y is None:
+            self.lines = [self.ax.plot(self.x, np.full(len(self.x), np.nan), label=label, animated=self.blit)[0] for label in ["Amplitude", "I", "Q"]]
+            self.ax.set_xlim(min(self.x), max(self.x))
+            self.ax.set_ylim(-1, 1)
+            self.ax.set_ylabel("adc units")
+            self.ax.legend(loc="upper right")
+            self.artists = list(self.lines)
+        else:
+            bounds = [min(self.x), max(self.x), min(self.y), max(self.y)]
+            self.image = self.ax.imshow(np.full(self.shape, np.nan), origin='lower', extent=bounds, aspect='auto', animated=self.blit)
+            self.image.set_clim(0, 1)
+            self.fig.colorbar(self.image, label="Amplitude" if self.quantity == "amp" else "Phase")
+            self.ax.set_ylabel(self.yname)
+            self.artists = [self.image]
+        self.ax.set_xlabel(self.xname)
+        self.status = self.ax.set_title(self.title, animated=self.blit)
+        self.artists.append(self.status)
+        self.background = None
+        self.fitted = False
+        if self.blit:
+            self.fig.canvas.mpl_connect("draw_event", self.on_draw)
+        if self.window:
+            plt.show(block=False)
+        if self.inline:
+            from IPython.display import display
+            self.handle = display(self.fig, display_id=True)
+            self.inline = self.handle is not None    ## None outside a notebook
+        self.render(force=True)
+
+    ## After every full redraw (ours, or a resize), keep the empty figure to blit onto
+    def on_draw(self, event):
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        for artist in self.artists:
+            self.fig.draw_artist(artist)
+
+    ## Redraws the figure if new data came in (or force=True)
+    def render(self, force=False):
+        if self.fig is None:
+            return
+        with self.lock:
+            if not (self.dirty or force):
+                return
+            data = self.data.copy()
+            npoints = self.npoints
+            self.dirty = False
+        self.status.set_text(self.title + "  (%d of %d points)" % (npoints, data.size))
+
+        ## Put the new data in, and only redraw everything if it no longer fits the limits
+        full = force or self.background is None
+        if self.y is None:
+            traces = [np.abs(data), data.real, data.imag]
+            for line, trace in zip(self.lines, traces):
+                line.set_ydata(trace)
+            full = self.fit_limits(self.ax.get_ylim(), np.concatenate(traces), self.ax.set_ylim) or full
+        else:
+            values = np.abs(data) if self.quantity == "amp" else np.angle(data)
+            self.image.set_data(values)
+            full = self.fit_limits(self.image.get_clim(), values, self.image.set_clim) or full
+
+        if self.inline:
+            self.fig.canvas.draw()
+            self.handle.update(self.fig)
+        elif not self.blit or full:
+            self.fig.canvas.draw_idle()
+            self.fig.canvas.flush_events()
+        else:
+            self.fig.canvas.restore_region(self.background)
+            for artist in self.artists:
+                self.fig.draw_artist(artist)
+            self.fig.canvas.blit(self.fig.bbox)
+            self.fig.canvas.flush_events()
+
+    ## Widens the limits (with some margin) if the finite values fall outside them.  Returns True if it had to
+    ## The placeholder limits the figure starts with are dropped as soon as there's data
+    def fit_limits(self, limits, values, set_limits):
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return False
+        [low, high] = [values.min(), values.max()]
+        if self.fitted and low >= limits[0] and high <= limits[1]:
+            return False
+        margin = 0.1*(high - low) if high > low else 1
+        if self.fitted:
+            set_limits(min(low - margin, limits[0]), max(high + margin, limits[1]))
+        else:
+            set_limits(low - margin, high + margin)
+        self.fitted = True
+        return True
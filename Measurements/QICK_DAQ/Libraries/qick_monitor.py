@@ -0,0 +1,238 @@
+import numpy as np
+import os, time, datetime
+import h5py
+from qick import *
+from qick_data import *
+from qick_helpers import *
+from qick_oneToneSweep import oneTone_oneSoftSweep, oneTone_oneHardSweep, can_hard_sweep
+
+#----------------------------------------------------------------------
+#
+# qick_monitor.py
+# Oct 2024
+#
+# Monitor mode: runs the same set of 1D sweeps (e.g. a transmission
+# line "TL" and a charge bias line "CB" frequency scan) over and over
+# on a fixed cadence, appending every scan as a row of one
+# time x sweep dataset per channel, all in a single h5 file.
+#
+#    mon = sweepMonitor(datapath, period=600)
+#    mon.add_channel("TL", measTL)      ## oneToneSweeps with x sweeps set
+#    mon.add_channel("CB", measCB)
+#    mon.run(soc, soccfg, duration=16*3600)
+#
+#    data = read_monitor(filepath)       ## one open, can be done while it runs
+#    TL = data["TL"]["meas_data"]
+#    plt.pcolormesh(TL["x_sweepVals"], data["TL"]["t_hours"], np.abs(TL["xi"] + 1j*TL["xq"]))
+#
+# File layout:  meta/                    series, meas_type="monitor", period ...
+#               <channel>/hw_cfg, meas_cfg
+#               <channel>/meas_data/     x_sweepVals (static), and per scan:
+#                   xi, xq       (time, npts)
+#                   timestamps   (time,)  unix time the scan started
+#                   t_planned    (time,)  when it was scheduled to start
+#                   scan_time    (time,)  seconds the scan took
+#
+# Cycles are scheduled at t0 + k*period, so lateness never builds up.
+# A cycle that can't start within max_late of its slot (because the
+# previous one overran) is skipped, and the schedule picks up at the
+# next slot.
+#
+#----------------------------------------------------------------------
+
+## Runs a set of measurement channels on a fixed cadence, streaming every scan into one file
+## period    = seconds between the starts of consecutive cycles
+## max_late  = seconds a cycle may start after its slot before it's skipped (default: a tenth of a period)
+## alternate = reverse the channel order every other cycle, so no channel is always measured first
+## hard_sweep, use_cache = as in do_soft_1D_measurement
+class sweepMonitor:
+    def __init__(self, datapath, period=600, max_late=None, alternate=False, hard_sweep=False, use_cache=True, series=None):
+        self.datapath   = datapath
+        self.period     = period
+        self.max_late   = period/10 if max_late is None else max_late
+        self.alternate  = alternate
+        self.hard_sweep = hard_sweep
+        self.use_cache  = use_cache
+        self.series     = series if series is not None else str(datetime.datetime.now().strftime('%Y%m%d_%H%M%S'))
+        self.channels   = {}
+        self.f          = None
+        self.nscans     = 0
+        self.nskipped   = 0
+        self.lateness   = []
+
+    ## Adds a channel.  meas is a oneToneSweep (or subclass) with its x sweep values set, and its own cfgs
+    ## forceInt = cast the sweep values to int, as in do_soft_1D_measurement (default: if the swept key is an integer
+    ##            in the converted config, like res_gain or a length in clock ticks)
+    def add_channel(self, name, meas, forceInt=None):
+        if name in self.channels:
+            print("Error: channel", name, "was already added")
+            return
+        if "x_sweepVals" not in meas.meas_data.keys() or "y_sweepVals" in meas.meas_data.keys():
+            print("Error: monitor channels need a 1D sweep (x sweep values only)")
+            return
+        self.channels[name] = {"meas" : meas, "config" : None, "hard" : False, "forceInt" : forceInt}
+        return
+
+    def filepath(self):
+        return os.path.join(self.datapath, self.series+"_monitor.h5")
+
+    ## Runs cycles until n_cycles are done or duration [s] has passed (whichever is given; neither = until ctrl-c)
+    ## The file is closed properly on ctrl-c, keeping every finished scan
+    def run(self, soc, soccfg, n_cycles=None, duration=None):
+        if len(self.channels) == 0:
+            print("Error: no channels.  Add some with add_channel")
+            return
+        self.setup(soc, soccfg)
+        self.open_file()
+        print("Monitoring", list(self.channels.keys()), "every", self.period, "s into", os.path.basename(self.filepath()))
+        t0 = time.time()
+        slot = 0
+        ncycles = 0
+        try:
+            while (n_cycles is None or ncycles < n_cycles) and (duration is None or time.time() - t0 < duration):
+                ## Wait for the slot, then check we're not too late for it
+                t_planned = t0 + slot*self.period
+                while time.time() < t_planned:
+                    time.sleep(min(t_planned - time.time(), 1.0))
+                late = time.time() - t_planned
+                if late > self.max_late:
+                    next_slot = int(np.ceil((time.time() - t0)/self.period))
+                    print("Warning: skipping", next_slot - slot, "cycle(s), the last one overran by %.1f s" % late)
+                    self.nskipped += next_slot - slot
+                    slot = next_slot
+                    continue
+                self.lateness.append(late)
+
+                names = list(self.channels.keys())
+                if self.alternate and ncycles % 2 == 1:
+                    names = names[::-1]
+                for name in names:
+                    self.scan(soc, soccfg, name, t_planned)
+                ncycles += 1
+                slot += 1
+                print("Cycle", ncycles, "done at %.1f h" % ((time.time() - t0)/3600), end="\r")
+        finally:
+            self.close_file()
+            self.summary()
+        return
+
+    ## Converts each channel's config once, and works out which ones can run as firmware sweeps
+    def setup(self, soc, soccfg):
+        for name, channel in self.channels.items():
+            meas = channel["meas"]
+            channel["config"] = meas.setup_meas(soc, soccfg)
+            if channel["forceInt"] is None:
+                value = channel["config"].get(meas.meas_data["x_sweepVarName"])
+                channel["forceInt"] = isinstance(value, (int, np.integer)) and not isinstance(value, bool)
+            channel["hard"] = self.hard_sweep and can_hard_sweep(soccfg, channel["config"], meas.meas_data["x_sweepVarName"], meas.meas_data["x_sweepVals"])
+            meas.meta["sweep_type"] = "1D"
+            meas.meta["sweep_mode"] = "hard" if channel["hard"] else "soft"
+        return
+
+    ## One scan of one channel, appended as the next row of its datasets
+    def scan(self, soc, soccfg, name, t_planned):
+        channel = self.channels[name]
+        meas = channel["meas"]
+        config = dict(channel["config"])
+        sweepVarName = meas.meas_data["x_sweepVarName"]
+        sweepVals = meas.meas_data["x_sweepVals"]
+        t_start = time.time()
+        if channel["hard"]:
+            [xi, xq, output_decimated, played_vals] = oneTone_oneHardSweep(soc, soccfg, config, sweepVarName, sweepVals, progress=False)
+        else:
+            [xi, xq, output_decimated] = oneTone_oneSoftSweep(soc, soccfg, config, sweepVarName, sweepVals, forceInt=channel["forceInt"], progress=False, cache=meas.get_prog_cache(self.use_cache))
+        self.append(name, xi=xi, xq=xq, timestamps=t_start, t_planned=t_planned, scan_time=time.time() - t_start)
+        self.nscans += 1
+        return
+
+    ## Makes the file: meta, then per channel its cfgs, static sweep values and empty extendable datasets
+    def open_file(self):
+        if not os.path.exists(self.datapath):
+            print("Datapath doesn't exist yet. Making new datapath")
+            os.makedirs(self.datapath)
+        self.f = h5py.File(self.filepath(), "w", libver="latest")
+        write_dict_to_group(self.f.create_group("meta"), {"series" : self.series, "meas_type" : "monitor", "period" : self.period,
+                                                         "max_late" : self.max_late, "channels" : list(self.channels.keys())})
+        for name, channel in self.channels.items():
+            meas = channel["meas"]
+            group = self.f.create_group(name)
+            write_dict_to_group(group.create_group("meta"), meas.meta)
+            write_dict_to_group(group.create_group("hw_cfg"), meas.hw_cfg)
+            write_dict_to_group(group.create_group("meas_cfg"), meas.meas_cfg)
+            G_meas_data = group.create_group("meas_data")
+            write_dict_to_group(G_meas_data, meas.meas_data, skip=["xi", "xq"])
+            npts = len(meas.meas_data["x_sweepVals"])
+            for key in ["xi", "xq"]:
+                G_meas_data.create_dataset(key, shape=(0, npts), maxshape=(None, npts), chunks=(1, npts), dtype=float)
+            for key in ["timestamps", "t_planned", "scan_time"]:
+                G_meas_data.create_dataset(key, shape=(0,), maxshape=(None,), chunks=(256,), dtype=float)
+        ## Readers can follow along with h5py.File(fn, "r", swmr=True) (or read_monitor)
+        self.f.swmr_mode = True
+        self.f.flush()
+        return
+
+    ## Appends one row to each of a channel's datasets and flushes it to disk
+    def append(self, name, **rows):
+        group = self.f[name]["meas_data"]
+        for key in rows:
+            dset = group[key]
+            n = dset.shape[0]
+            dset.resize(n+1, axis=0)
+            dset[n] = rows[key]
+            dset.flush()
+        return
+
+    def close_file(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            print("\nSaved monitor data as:", os.path.basename(self.filepath()))
+        return
+
+    ## Prints how many scans ran and how well the cadence was kept
+    def summary(self):
+        print("====---------------------------====")
+        print("  %d scans, %d cycles skipped" % (self.nscans, self.nskipped))
+        if len(self.lateness) > 0:
+            print("  cycle start lateness: median %.3f s, max %.3f s" % (np.median(self.lateness), np.max(self.lateness)))
+        print("====---------------------------====")
+        return
+
+
+## Reads a monitor file in one go (works while the monitor is still writing to it)
+## Returns {"meta": {...}, channel: {"hw_cfg", "meas_cfg", "meas_data": {...}, "t_hours": hours since the first scan}}
+## Every meas_data entry is loaded, so a channel's map is data[channel]["meas_data"]["xi"] (time x npts)
+def read_monitor(filepath):
+    try:
+        f = h5py.File(filepath, "r", libver="latest", swmr=True)
+    except OSError:
+        f = h5py.File(filepath, "r")
+    with f:
+        data = {"meta" : read_group(f["meta"])}
+        channels = data["meta"]["channels"]
+        if isinstance(channels, str):
+            channels = [channels]
+        t_first = None
+        for name in channels:
+            data[name] = {key : read_group(f[name][key]) for key in ["meta", "hw_cfg", "meas_cfg", "meas_data"]}
+            t = data[name]["meas_data"]["timestamps"]
+            if len(t) > 0:
+                t_first = t[0] if t_first is None else min(t_first, t[0])
+        for name in channels:
+            data[name]["t_hours"] = (data[name]["meas_data"]["timestamps"] - (t_first or 0))/3600
+    return data
+
+## Reads every dataset in an h5 group into a dict, unpacking scalars and strings the way read_H5 does
+## (the extendable per-scan datasets always stay arrays, even with one scan in them)
+def read_group(group):
+    values = {}
+    for item in group:
+        readin = group[item][()]
+        if isinstance(readin, np.ndarray) and readin.ndim == 1 and len(readin) == 1 and item != "qubits" and group[item].maxshape[0] is not None:
+            [readin] = readin
+        if type(readin) == np.bytes_:
+            readin = readin.decode("utf-8")
+        elif isinstance(readin, np.ndarray) and readin.dtype.kind == 'S':
+            readin = [name.decode("utf-8") for name in readin]
+        values[item] = readin
+    return values
@@ -0,0 +1,204 @@
+import numpy as np
+import time, threading, collections, traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+from qick import *
+from qick_helpers import *
+
+#----------------------------------------------------------------------
+#
+# qick_multiBoard.py
+# Oct 2024
+#
+# Runs independent sweeps on several boards at once from one process,
+# e.g. two feedlines in two cooldown channels.  Every board gets its
+# own queue, worked through in order by its own thread, and the
+# scheduler prints one combined progress table while they run.
+#
+#    boards = connect_boards("192.168.137.93", 8883, ["DMQIS_qick", "DMQIS_qick2"])
+#    sched  = multiBoardScheduler(boards)
+#    sched.submit("DMQIS_qick",  measA.do_soft_1D_measurement, datapath=pathA, label="FL1 freq scan")
+#    sched.submit("DMQIS_qick2", measB.do_soft_2D_measurement, datapath=pathB, label="FL2 power scan")
+#    sched.submit("DMQIS_qick",  measC.do_T1_measurement, 70, 0.01, 0.5, datapath=pathA)
+#    jobs = sched.run()
+#
+# Jobs are called as func(soc, soccfg, *args, **kwargs), so any do_*
+# method of a measurement class works as is.  Use a separate
+# measurement object per job.  Sweeps still print their own progress,
+# so their lines get interleaved; the table is the thing to watch.
+#
+#----------------------------------------------------------------------
+
+## Soc calls that mark one acquisition (round) on a real board, and the simSoc calls that stand in for a whole acquire
+board_acquire_calls = ["start_tproc", "acquire", "acquire_decimated", "stream_shots"]
+
+## Connects to boards registered in a Pyro4 nameserver, like the DAQ notebooks do for one
+## Returns {proxy name: (soc, soccfg)}
+def connect_boards(ns_host, ns_port, proxy_names):
+    import Pyro4
+    Pyro4.config.SERIALIZER = "pickle"
+    Pyro4.config.PICKLE_PROTOCOL_VERSION=4
+    ns = Pyro4.locateNS(host=ns_host, port=ns_port)
+    boards = {}
+    for name in proxy_names:
+        soc = Pyro4.Proxy(ns.lookup(name))
+        boards[name] = (soc, QickConfig(soc.get_cfg()))
+        print("connected to", name)
+    return boards
+
+
+## Hands every soc call through, counting acquisitions for the progress table
+class countedSoc:
+    def __init__(self, soc):
+        self._soc      = soc
+        self.acquires  = 0
+
+    def __getitem__(self, key):
+        return self._soc[key]
+
+    def __getattr__(self, name):
+        attr = getattr(self._soc, name)
+        if name not in board_acquire_calls or not callable(attr):
+            return attr
+        def counted_call(*args, **kwargs):
+            self.acquires += 1
+            return attr(*args, **kwargs)
+        return counted_call
+
+
+## One queued call on a board
+## status is "queued", "running", "done" or "failed"; result/error are filled in when it finishes
+class boardJob:
+    def __init__(self, board, func, args, kwargs, label=None):
+        self.board  = board
+        self.func   = func
+        self.args   = args
+        self.kwargs = kwargs
+        self.label  = label if label is not None else getattr(func, "__name__", "job")
+        self.status = "queued"
+        self.result = None
+        self.error  = None
+        self.t_start = None
+        self.t_stop  = None
+
+    def __repr__(self):
+        return "boardJob(%s on %s, %s)" % (self.label, self.board, self.status)
+
+    ## Seconds spent running so far (or in total, once it's finished)
+    def elapsed(self):
+        if self.t_start is None:
+            return 0.0
+        return (time.time() if self.t_stop is None else self.t_stop) - self.t_start
+
+
+## Runs a queue of jobs per board, all boards in parallel on a thread pool (one thread per board,
+## since a board can only run one program at a time)
+## boards = optional {name: (soc, soccfg)}, e.g. from connect_boards; more can be added with add_board
+class multiBoardScheduler:
+    def __init__(self, boards=None):
+        self.boards = collections.OrderedDict()
+        self.lock   = threading.Lock()
+        self.abort  = threading.Event()
+        if boards is not None:
+            for name in boards:
+                self.add_board(name, *boards[name])
+
+    def add_board(self, name, soc, soccfg):
+        if name in self.boards:
+            print("Error: board", name, "was already added")
+            return
+        self.boards[name] = {"soc" : countedSoc(soc), "soccfg" : soccfg, "queue" : collections.deque(), "jobs" : []}
+        return
+
+    ## Queues func(soc, soccfg, *args, **kwargs) on a board, behind whatever is already queued there
+    ## label = name shown in the progress table (defaults to the function's name)
+    def submit(self, board, func, *args, label=None, **kwargs):
+        if board not in self.boards:
+            print("Error: unknown board", board, "- options are", list(self.boards.keys()))
+            return None
+        job = boardJob(board, func, args, kwargs, label=label)
+        with self.lock:
+            self.boards[board]["queue"].append(job)
+            self.boards[board]["jobs"].append(job)
+        return job
+
+    ## Works through every board's queue at once, printing the progress table every report_every seconds
+    ## stop_on_error=True stops every board (after its current job) as soon as one job fails;
+    ## otherwise a failed job is reported and its board moves on to the next one
+    ## Returns {board: [jobs]} with their results
+    def run(self, report_every=30, stop_on_error=False):
+        self.abort.clear()
+        names = [name for name in self.boards if len(self.boards[name]["queue"]) > 0]
+        if len(names) == 0:
+            print("Nothing queued")
+            return self.jobs()
+        t_start = time.time()
+        with ThreadPoolExecutor(max_workers=len(names), thread_name_prefix="board") as pool:
+            futures = [pool.submit(self._run_board, name, stop_on_error) for name in names]
+            while True:
+                [done, pending] = wait(futures, timeout=report_every)
+                if len(pending) == 0:
+                    break
+                self.print_progress()
+        for future in futures:
+            future.result()
+        self.print_progress()
+        print("All boards finished in %.1f s" % (time.time() - t_start))
+        return self.jobs()
+
+    ## Worker: runs one board's jobs in order
+    def _run_board(self, name, stop_on_error):
+        board = self.boards[name]
+        soc = board["soc"]
+        ## A Pyro4 proxy can only be used by one thread at a time, and this one is now it
+        if hasattr(soc._soc, "_pyroClaimOwnership"):
+            soc._soc._pyroClaimOwnership()
+        while not self.abort.is_set():
+            with self.lock:
+                if len(board["queue"]) == 0:
+                    break
+                job = board["queue"].popleft()
+                job.status  = "running"
+                job.t_start = time.time()
+            try:
+                job.result = job.func(soc, board["soccfg"], *job.args, **job.kwargs)
+                job.status = "done"
+            except Exception as error:
+                job.error  = error
+                job.status = "failed"
+                print("Error: job", job.label, "on", name, "failed:")
+                traceback.print_exc()
+                if stop_on_error:
+                    self.abort.set()
+            finally:
+                job.t_stop = time.time()
+        return
+
+    ## {board: [jobs]}, in the order they were submitted
+    def jobs(self):
+        return {name : list(self.boards[name]["jobs"]) for name in self.boards}
+
+    ## Per board: jobs done/failed/total, the running job and how long it's been going, and acquisitions so far
+    def progress(self):
+        report = {}
+        with self.lock:
+            for name, board in self.boards.items():
+                jobs = board["jobs"]
+                running = [job for job in jobs if job.status == "running"]
+                report[name] = {"done"     : sum(job.status == "done" for job in jobs),
+                                "failed"   : sum(job.status == "failed" for job in jobs),
+                                "total"    : len(jobs),
+                                "running"  : running[0].label if running else None,
+                                "elapsed"  : running[0].elapsed() if running else 0.0,
+                                "acquires" : board["soc"].acquires}
+        return report
+
+    def print_progress(self):
+        report = self.progress()
+        print("====---------------------------====")
+        print("  %-16s %9s %9s  %s" % ("board", "jobs", "acquires", "running"))
+        for name, r in report.items():
+            jobs = "%d/%d" % (r["done"] + r["failed"], r["total"]) + ("!" if r["failed"] else "")
+            running = "-" if r["running"] is None else "%s (%.0f s)" % (r["running"], r["elapsed"])
+            print("  %-16s %9s %9d  %s" % (name, jobs, r["acquires"], running))
+        print("====---------------------------====")
+        return
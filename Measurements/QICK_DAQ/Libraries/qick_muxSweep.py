@@ -0,0 +1,307 @@
+import numpy as np
+from qick import *
+from qick_data import *
+from qick_helpers import *
+from qick_oneToneSweep import oneToneSweep
+
+#----------------------------------------------------------------------
+#
+# qick_muxSweep.py
+# Oct 2024
+#
+# Frequency-multiplexed one tone sweeps: every resonator on a feedline
+# is probed in the same shot, each on its own readout channel.
+#
+# meas_cfg needs (see muxOneToneSweep.set_resonators):
+#    res_freqs  = list of resonator frequencies [MHz]
+#    res_gains  = list of relative tone amplitudes, summing to <= 1
+#    ro_chs     = list of readout channels, one per resonator
+# plus the usual one tone keys (res_gain, res_length, readout_length ...).
+# res_gain sets the total amplitude, so a power scan still sweeps res_gain.
+# Frequency sweeps step res_freq_offset [MHz], which moves every tone together.
+#
+#----------------------------------------------------------------------
+
+## Config keys muxOneTonePulse reads, so the only ones worth sweeping (times can be swept in _us too)
+mux_sweep_keys = ["res_freq_offset", "res_gain", "res_phase", "res_length", "readout_length", "adc_trig_offset", "relax_delay"]
+
+## Same as oneToneSweep, but xi/xq carry a leading resonator axis:
+## (nres, npts) for 1D sweeps and (nres, ny, nx) for 2D sweeps
+class muxOneToneSweep(oneToneSweep):
+
+    ## Sets up the tones.  res_gains defaults to an equal split, ro_chs to readouts 0..N-1
+    def set_resonators(self, res_freqs, res_gains=None, ro_chs=None):
+        nres = len(res_freqs)
+        if res_gains is None:
+            res_gains = [1/nres]*nres
+        if ro_chs is None:
+            ro_chs = list(range(nres))
+        if len(res_gains) != nres or len(ro_chs) != nres:
+            print("Error: res_freqs, res_gains and ro_chs need one entry per resonator")
+            return
+        if np.sum(np.abs(res_gains)) > 1:
+            print("Error: res_gains add up to more than 1, the summed tone would clip")
+            return
+        self.meas_cfg["res_freqs"] = list(res_freqs)
+        self.meas_cfg["res_gains"] = list(res_gains)
+        self.meas_cfg["ro_chs"]    = list(ro_chs)
+        self.meas_cfg.setdefault("res_freq_offset", 0)
+        return
+
+    ## Checks that the board can play and read back every tone at once
+    def check_mux_params(self, soccfg):
+        for key in ["res_freqs", "res_gains", "ro_chs"]:
+            if key not in self.meas_cfg:
+                print("Error:", key, "not found.  Run set_resonators first")
+                return False
+        nro = len(soccfg['readouts'])
+        for ro_ch in self.meas_cfg["ro_chs"]:
+            if ro_ch >= nro:
+                print("Error: readout", ro_ch, "doesn't exist, this firmware has", nro, "readouts")
+                return False
+        gencfg = soccfg['gens'][self.hw_cfg["res_ch"]]
+        if 'n_tones' in gencfg:
+            if len(self.meas_cfg["res_freqs"]) > gencfg['n_tones']:
+                print("Error: mux generator", self.hw_cfg["res_ch"], "only has", gencfg['n_tones'], "tones")
+                return False
+        elif not gencfg['complex_env']:
+            print("Error: generator", self.hw_cfg["res_ch"], "can't play a summed tone (no complex envelope)")
+            return False
+
+        ## Settings the mux program would silently ignore
+        if "res_freq" in self.meas_cfg:
+            print("Error: res_freq is set, but mux sweeps play res_freqs.  Remove it (sweep res_freq_offset to move every tone)")
+            return False
+        style = self.meas_cfg.get("res_pulse_style", "const")
+        if style not in (["const"] if 'n_tones' in gencfg else ["const", "gauss"]):
+            print("Error: res_pulse_style", style, "can't be played on generator", self.hw_cfg["res_ch"], "- mux generators only play const pulses, others const or gauss")
+            return False
+        for axis in ["x", "y"]:
+            name = self.meas_data.get(axis+"_sweepVarName")
+            if name is not None and (name[:-3] if name[-3:] == "_us" else name) not in mux_sweep_keys:
+                print("Error: mux sweeps can't sweep", name, "- options are", mux_sweep_keys)
+                return False
+        return True
+
+    ## Sweeps one variable in software, measuring every resonator at each point
+    ## Sweep res_freq_offset to scan all resonators in frequency at once
+    def do_mux_1D_measurement(self, soc, soccfg, datapath=None, forceInt=False, overwrite_existing_data=False, save_data=True):
+        ## Sanity check inputs
+        if save_data and datapath==None:
+            print("Error: no datapath provided.  Either provide a datapath argument, or rerun the function with save_data=False")
+            return
+        elif datapath is not None:
+            if datapath[0:1] == "./":
+                print("Error: you provided a relative datapath.  Rerun with a total datapath")
+                return        
+        if "x_sweepVals" not in self.meas_data.keys():
+            print("Error: x sweep values not found")
+            return
+        elif "y_sweepVals" in self.meas_data.keys():
+            print("Error: y sweep values were provided, but you are running a 1D sweep")
+            print("measurement cancelled to prevent future confusion")
+            return
+        elif "xi" in self.meas_data.keys() and not overwrite_existing_data:
+            print("Error: data already exists in this measurement object.")
+            print("to run acquisition, either initialize a new object")
+            print("or rerun this function with argument overwrite_existing_data=True")
+            return
+        elif (self.check_for_qubit_params())== True:
+            print("Error: you are setting qubit parameters for a one tone sweep")
+            print("Measurement cancelled")
+            return
+        elif not self.check_mux_params(soccfg):
+            print("Measurement cancelled")
+            return
+
+        ## Prepare for measurement
+        print("Starting measurement setup")
+        config = self.setup_meas(soc,soccfg)
+
+        ## Actually do the measurement
+        print("Starting measurement")
+        [xi, xq] = mux_softSweep(soc, soccfg, config, [(self.meas_data["x_sweepVarName"], self.meas_data["x_sweepVals"], forceInt)])
+        print("Measurement complete")
+
+        ## Store data in class
+        self.meta["sweep_type"] = "1D"
+        self.meta["sweep_mode"] = "mux"
+        self.meas_data["xi"] = xi
+        self.meas_data["xq"] = xq
+
+        ## Save data
+        if save_data:
+            self.write_H5(datapath)
+        return
+
+    ## Sweeps two variables in software, measuring every resonator at each point
+    ## Stored maps are (nres, y, x), like the (y, x) maps of oneToneSweep
+    def do_mux_2D_measurement(self, soc, soccfg, datapath=None, x_forceInt=False, y_forceInt=False, overwrite_existing_data=False, save_data=True):
+        ## Sanity check inputs
+        if save_data and datapath==None:
+            print("Error: no datapath provided.  Either provide a datapath argument, or rerun the function with save_data=False")
+            return
+        elif datapath is not None:
+            if datapath[0:1] == "./":
+                print("Error: you provided a relative datapath.  Rerun with a total datapath")
+                return        
+        if "x_sweepVals" not in self.meas_data.keys():
+            print("Error: x sweep values not found")
+            return
+        elif "y_sweepVals" not in self.meas_data.keys():
+            print("Error: y sweep values not found")
+            return
+        elif "xi" in self.meas_data.keys() and not overwrite_existing_data:
+            print("Error: data already exists in this measurement object.")
+            print("to run acquisition, either initialize a new object")
+            print("or rerun this function with argument overwrite_existing_data=True")
+            return
+        elif (self.check_for_qubit_params())== True:
+            print("Error: you are setting qubit parameters for a one tone sweep")
+            print("Measurement cancelled")
+            return
+        elif not self.check_mux_params(soccfg):
+            print("Measurement cancelled")
+            return
+
+        ## Prepare for measurement
+        print("Starting measurement setup")
+        config = self.setup_meas(soc,soccfg)
+
+        ## Actually do the measurement
+        print("Starting measurement")
+        axes = [(self.meas_data["y_sweepVarName"], self.meas_data["y_sweepVals"], y_forceInt), (self.meas_data["x_sweepVarName"], self.meas_data["x_sweepVals"], x_forceInt)]
+        [xi, xq] = mux_softSweep(soc, soccfg, config, axes)
+        print("Measurement complete")
+
+        ## Store data in class
+        self.meta["sweep_type"] = "2D"
+        self.meta["sweep_mode"] = "mux"
+        self.meas_data["xi"] = xi
+        self.meas_data["xq"] = xq
+
+        ## Save data
+        if save_data:
+            self.write_H5(datapath)
+        return
+
+    ## Plots the amplitude of every resonator from a 1D sweep
+    ## Frequency offset sweeps are plotted against each resonator's own frequency
+    def plot_mux_1D_measurement(self, title=None):
+        if "xi" not in self.meas_data.keys():
+            print("Error: data not found")
+            return
+        elif "y_sweepVals" in self.meas_data.keys():
+            print("Error: data is 2D, not 1D")
+            return
+        var = self.meas_data["x_sweepVarName"]
+        amps = np.abs(self.meas_data["xi"] + 1j*self.meas_data["xq"])
+        nres = amps.shape[0]
+        fig, axs = plt.subplots(1, nres, figsize=(4*nres, 3.5), squeeze=False)
+        for i in range(nres):
+            values = self.meas_data["x_sweepVals"]
+            xlabel = var
+            if var == "res_freq_offset":
+                values = values + self.meas_cfg["res_freqs"][i]
+                xlabel = "res_freq [MHz]"
+            axs[0][i].plot(values, amps[i])
+            axs[0][i].set_xlabel(xlabel)
+            axs[0][i].set_title("ro_ch %d" % self.meas_cfg["ro_chs"][i])
+        axs[0][0].set_ylabel("adc units")
+        if title is not None:
+            title_string = title + "\n" + self.meta["series"]
+        else:
+            title_string = self.meta["meas_type"] + "\n" + self.meta["series"]
+        fig.suptitle(title_string)
+        plt.tight_layout()
+        plt.show()
+        return
+
+
+#----------------------------------------------------------------------------------------------------------------------
+# Helper Functions
+#----------------------------------------------------------------------------------------------------------------------
+
+## Arguments:
+## sweep_axes = list of (sweepVarName, sweepVals, forceInt), outermost axis first
+## Sweeps any number of variables in software with muxOneTonePulse.  Returns [xi, xq], each shaped (nres, *sweep shape)
+def mux_softSweep(soc, soccfg, config, sweep_axes):
+    shape = [len(axis[1]) for axis in sweep_axes]
+    nres  = len(config["res_freqs"])
+    xi = np.zeros([nres] + shape)
+    xq = np.zeros([nres] + shape)
+    npts = int(np.prod(shape))
+    for n, index in enumerate(np.ndindex(*shape)):
+        for axis, i in enumerate(index):
+            [name, vals, forceInt] = sweep_axes[axis]
+            config[name] = int(vals[i]) if forceInt else vals[i]
+        prog = muxOneTonePulse(soccfg, config)
+        avgi, avgq = acquire_prog(prog, soc, load_pulses=True, progress=False)
+        for r in range(nres):
+            xi[(r,) + index] = avgi[r][0]
+            xq[(r,) + index] = avgq[r][0]
+        print("Point", (n+1), "of", npts, end="\r")
+    return [xi, xq]
+
+
+#----------------------------------------------------------------------------------------------------------------------
+# QICK Programs
+#----------------------------------------------------------------------------------------------------------------------
+
+## Plays every resonator tone on one generator and reads each back on its own readout
+## On a mux generator the tones are the generator's own mux tones.  On a regular generator the DDS sits in the
+## middle of the tones and they're played as one summed-tone arbitrary waveform, so res_gains must add up to <= 1.
+## Each readout listens at its resonator's frequency, so they all need to see the feedline output (e.g. through a splitter)
+class muxOneTonePulse(AveragerProgram):
+    def initialize(self):
+        cfg=self.cfg
+        res_ch = cfg["res_ch"]
+        ro_chs = cfg["ro_chs"]
+        freqs  = np.array(cfg["res_freqs"]) + cfg.get("res_freq_offset", 0)
+        gains  = np.array(cfg["res_gains"])
+        gencfg = self.soccfg['gens'][res_ch]
+        self.is_mux = ('n_tones' in gencfg)
+
+        ## Declare generators
+        if self.is_mux:
+            self.declare_gen(ch=res_ch, nqz=1, mux_freqs=list(freqs), mux_gains=list(gains*cfg["res_gain"]/32766), ro_ch=ro_chs[0])
+        else:
+            self.declare_gen(ch=res_ch, nqz=1)
+
+        ## Declare readouts, one per tone
+        self.tproc_ros = [ro_ch for ro_ch in ro_chs if "tproc_ctrl" in self.soccfg['readouts'][ro_ch]]
+        for ro_ch, freq in zip(ro_chs, freqs):
+            if ro_ch in self.tproc_ros:
+                self.declare_readout(ch=ro_ch, length=cfg["readout_length"])
+                self.set_readout_registers(ch=ro_ch, freq=self.freq2reg_adc(freq, ro_ch=ro_ch, gen_ch=res_ch), length=3)
+            else:
+                self.declare_readout(ch=ro_ch, length=cfg["readout_length"], freq=freq, gen_ch=res_ch)
+
+        if self.is_mux:
+            self.set_pulse_registers(ch=res_ch, style="const", length=cfg["res_length"], mask=list(range(len(freqs))))
+        else:
+            ## DDS in the middle of the tones, each tone is an offset baked into the waveform
+            center = self.freq2reg(np.mean(freqs), gen_ch=res_ch, ro_ch=ro_chs[0])
+            offsets = freqs - self.reg2freq(center, gen_ch=res_ch)
+            nsamps = cfg["res_length"]*gencfg['samps_per_clk']
+            t = np.arange(nsamps)/(gencfg['f_fabric']*gencfg['samps_per_clk'])   ## us, so MHz*t is in cycles
+            wave = np.sum([g*np.exp(2j*np.pi*df*t) for g, df in zip(gains, offsets)], axis=0)
+            if cfg.get("res_pulse_style", "const") == "gauss":
+                sigma = nsamps/5
+                wave = wave*np.exp(-(np.arange(nsamps) - nsamps/2)**2/(2*sigma**2))
+            maxv = gencfg['maxv']*gencfg['maxv_scale']
+            self.add_pulse(ch=res_ch, name="mux", idata=maxv*wave.real, qdata=maxv*wave.imag)
+            resphase = self.deg2reg(cfg["res_phase"], gen_ch=res_ch)
+            self.set_pulse_registers(ch=res_ch, style="arb", freq=center, phase=resphase, gain=cfg["res_gain"], waveform="mux")
+
+        self.synci(200)  # give processor some time to configure pulses
+
+    def body(self):
+        cfg=self.cfg
+        for ro_ch in self.tproc_ros:
+            self.readout(ch=ro_ch, t=0)
+        self.measure(pulse_ch=cfg["res_ch"],
+             adcs=cfg["ro_chs"],
+             adc_trig_offset=cfg["adc_trig_offset"],
+             wait=True,
+             syncdelay=self.us2cycles(cfg["relax_delay"]))   ## same units as oneTonePulse
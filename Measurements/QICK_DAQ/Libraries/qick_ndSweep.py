@@ -0,0 +1,312 @@
+import numpy as np
+import sys, time
+from qick import *
+from qick_data import *
+from qick_helpers import *
+from qick_programs import twoTonePulse, twoToneNDAverager, two_tone_hard_sweeps
+from qick_oneToneSweep import oneTonePulse, oneToneHardSweep, hard_sweep_regs, can_hard_sweep, make_prog, pointTimer, change_cost, nesting_weight, sweep_indices
+from qick_twoToneSweep import twoToneSweep, hard_sweep_steps
+
+#----------------------------------------------------------------------
+#
+# qick_ndSweep.py
+# Oct 2024
+#
+# N-dimensional sweeps with any mix of hardware and software axes.
+# Hardware axes are stepped in a firmware loop inside one program,
+# software axes rebuild (or patch) the program, or set an instrument.
+#
+#    meas = ndSweep()
+#    meas.set_hw_cfg(res_ch=transmission_ch, qu_ch=chargebias_ch, ro_ch=ro_ch)
+#    meas.meas_cfg = {...}
+#    meas.add_sweep_axis(400, 7340, 7365, "res_freq")
+#    meas.add_sweep_axis(15, 500, 30000, "res_gain")
+#    meas.add_sweep_axis(41, -30000, 30000, "qu_gain", hard=True)     ## charge bias
+#    meas.do_ND_measurement(soc, soccfg, datapath=datapath, use_cache=True)
+#
+# xi/xq come out with one dimension per axis, in the order the axes
+# were added.  The software axes are nested in whichever order changes
+# expensive axes least often (see nd_sweep_order); hardware axes are
+# always innermost, since they run inside the program.  With
+# serpentine=True every software axis runs back and forth instead of
+# jumping back to its start, so a slow axis is never swept end to end
+# in one step, and an axis given a settle time is waited on after every
+# change.
+#
+# Hardware axes: res_freq or res_gain (one of them) for one tone
+# measurements (oneToneHardSweep), any of delay, qu_gain, qu_length for
+# two tone ones (twoToneNDAverager).
+#
+#----------------------------------------------------------------------
+
+## One axis of an N-D sweep
+## name     = config key to sweep.  A _us name gets converted to clock ticks, like set_soft_sweep_vals sweeps
+## vals     = values, in the order they're stored
+## hard     = step it in a firmware loop instead of rebuilding the program (see nd_hard_sweeps)
+## forceInt = cast software values to int
+## cost     = how expensive one change of this axis is, relative to patching a register (1).  Defaults to 1 for
+##            registers the program cache can patch and 10 for anything that needs a rebuild.  Raise it for slow
+##            axes, e.g. a bias source that has to settle
+## setter   = optional function(val) that applies the value (an instrument) instead of putting it in the config
+## settle   = seconds to wait after every change of this axis, before measuring (also raises its default cost)
+class sweepAxis:
+    def __init__(self, name, vals, hard=False, forceInt=False, cost=None, setter=None, settle=0):
+        self.name     = name
+        self.vals     = np.asarray(vals)
+        self.vals_us  = None
+        self.hard     = hard
+        self.forceInt = forceInt
+        self.cost     = cost
+        self.setter   = setter
+        self.settle   = settle
+
+    def __repr__(self):
+        return "sweepAxis(%s, %d points%s)" % (self.name, len(self.vals), ", hard" if self.hard else "")
+
+
+## Firmware loop program of each base program, and the config keys it can step
+nd_hard_sweeps = {oneTonePulse : (oneToneHardSweep, list(hard_sweep_regs.keys())),
+                  twoTonePulse : (twoToneNDAverager, list(two_tone_hard_sweeps.keys()))}
+
+## Default cost of changing a software axis once (see sweepAxis)
+def axis_cost(axis, config, cache=None):
+    return change_cost(axis.name, config, cache, cost=axis.cost, settle=axis.settle, setter=axis.setter)
+
+## Nesting order of the axes (indices, outermost first) that makes the fewest expensive changes: the software axes
+## sorted on nesting_weight, largest outside.  Hardware axes go innermost, in the order they were given
+def nd_sweep_order(axes, config, cache=None):
+    soft = [k for k, axis in enumerate(axes) if not axis.hard]
+    hard = [k for k, axis in enumerate(axes) if axis.hard]
+    return sorted(soft, key=lambda k : nesting_weight(axis_cost(axes[k], config, cache), len(axes[k].vals)), reverse=True) + hard
+
+## Converts _us axes to clock ticks, in the clock of the channel that plays them (see time_var_channel)
+def convert_axis_time_vars(soccfg, config, axes):
+    for axis in axes:
+        if axis.name[-3:] == "_us":
+            gen_ch = config.get(time_var_channel(axis.name))
+            axis.vals_us = axis.vals
+            axis.vals = us2cycles_vec(soccfg, axis.vals, gen_ch)
+            axis.name = axis.name[:-3]
+    return axes
+
+## Demotes hardware axes that prog_class (or this board) can't loop over to software axes, with a warning
+def check_hard_axes(soccfg, config, axes, prog_class):
+    hard = [axis for axis in axes if axis.hard]
+    if len(hard) == 0:
+        return axes
+    if prog_class not in nd_hard_sweeps:
+        print("Warning:", prog_class.__name__, "has no firmware loop version, running every axis in software")
+        for axis in hard:
+            axis.hard = False
+        return axes
+    [hard_class, names] = nd_hard_sweeps[prog_class]
+    for axis in hard:
+        if axis.name not in names:
+            print("Warning:", axis.name, "can't be swept in firmware. Options are", names)
+            axis.hard = False
+        elif axis.setter is not None:
+            print("Warning:", axis.name, "is set by an instrument, so it can't be swept in firmware")
+            axis.hard = False
+        elif hard_class is oneToneHardSweep and not can_hard_sweep(soccfg, config, axis.name, axis.vals):
+            axis.hard = False
+    hard = [axis for axis in axes if axis.hard]
+    if hard_class is oneToneHardSweep and len(hard) > 1:
+        print("Warning: one tone firmware sweeps only loop over one variable, running", [axis.name for axis in hard[1:]], "in software")
+        for axis in hard[1:]:
+            axis.hard = False
+    return axes
+
+## Puts the hardware axes into config and returns the program class that loops over them (None if there aren't any)
+## Integer register sweeps are rounded to whole steps, and axis.vals is replaced by what will be played
+def setup_hard_axes(config, axes, prog_class):
+    hard = [axis for axis in axes if axis.hard]
+    if len(hard) == 0:
+        return None
+    hard_class = nd_hard_sweeps[prog_class][0]
+    if hard_class is oneToneHardSweep:
+        axis = hard[0]
+        config["hard_sweep_reg"] = hard_sweep_regs[axis.name]
+        config["start"] = axis.vals[0]
+        config["step"]  = axis.vals[1] - axis.vals[0]
+        config["expts"] = len(axis.vals)
+    else:
+        ## twoToneNDAverager takes the innermost axis first
+        sweeps = []
+        for axis in hard[::-1]:
+            [start, step, axis.vals] = hard_sweep_steps(axis.name, axis.vals)
+            sweeps.append([axis.name, start, step, len(axis.vals)])
+            config.setdefault(axis.name, start)    ## the program sets its other registers from this
+        config["hard_sweeps"] = sweeps
+    return hard_class
+
+
+## Arguments:
+## prog_class = AveragerProgram for a single point (oneTonePulse, twoTonePulse, ...)
+## axes       = list of sweepAxis, in the order the result's dimensions should be in
+## cache      = optional programCache, to patch software axes instead of rebuilding (see patchable_regs)
+## reorder    = nest the software axes in the cheapest order (nd_sweep_order); False keeps the given order, outermost first
+## serpentine = run every software axis back and forth inside the ones outside it (see sweep_indices)
+## timer      = optional pointTimer(number of programs run); one "point" per program, in the order they run
+## Runs the sweep, one program per combination of software values, each filling in every hardware axis at once.
+## Returns [xi, xq, order], with xi/xq shaped like the axes and order the nesting that was used (outermost first).
+## The axes are updated in place: _us names converted, vals set to what was played, demoted hard axes marked soft
+def run_nd_sweep(soc, soccfg, config, axes, prog_class=oneTonePulse, cache=None, reorder=True, serpentine=False, progress=True, timer=None):
+    if timer is None:
+        timer = pointTimer()
+    convert_axis_time_vars(soccfg, config, axes)
+    check_hard_axes(soccfg, config, axes, prog_class)
+    ## Programs with a firmware loop get rebuilt for every block, so the cache can't make any axis cheaper
+    plan_cache = None if any(axis.hard for axis in axes) else cache
+    order = nd_sweep_order(axes, config, plan_cache) if reorder else [k for k, axis in enumerate(axes) if not axis.hard] + [k for k, axis in enumerate(axes) if axis.hard]
+    soft_order = [k for k in order if not axes[k].hard]
+    hard_class = setup_hard_axes(config, axes, prog_class)
+    for axis in axes:
+        if axis.hard and axis.vals_us is not None:
+            axis.vals_us = axis.vals/get_gen_clocks(soccfg)[config.get(time_var_channel(axis.name+"_us"))]
+    patch_keys = [axes[k].name for k in soft_order if axes[k].setter is None]
+
+    ## Preallocate the whole map, in the axes' own order
+    shape = tuple(len(axis.vals) for axis in axes)
+    xi = np.full(shape, np.nan)
+    xq = np.full(shape, np.nan)
+
+    ## Software axes are only touched when their value changes, so outer axes change rarely
+    blocks = list(sweep_indices([len(axes[k].vals) for k in soft_order], serpentine))
+    current = {}
+    for n, index in enumerate(blocks):
+        if progress:
+            print("Program", (n+1), "of", len(blocks), end="\r")
+            sys.stdout.flush()
+        for k, i in zip(soft_order, index):
+            if current.get(k) == i:
+                continue
+            current[k] = i
+            axis = axes[k]
+            val = int(axis.vals[i]) if axis.forceInt else axis.vals[i]
+            if axis.setter is not None:
+                axis.setter(val)
+            else:
+                config[axis.name] = val
+            if axis.settle > 0:
+                time.sleep(axis.settle)
+        timer.start()
+        if hard_class is None:
+            prog = make_prog(prog_class, soccfg, config, cache, patch_keys)
+        else:
+            prog = hard_class(soccfg, config)
+        timer.lap(n, "build")
+        output = acquire_prog(prog, soc, load_pulses=True, progress=False)
+        timer.lap(n, "acquire")
+
+        ## Firmware frequency sweeps get rounded to register steps, so keep what was actually played
+        if n == 0 and hard_class is oneToneHardSweep:
+            [axis] = [axis for axis in axes if axis.hard]
+            axis.vals = np.array(output[0])
+
+        ## Software indices pick the block, the hardware axes fill it (the program returns them outermost first)
+        loc = [slice(None)]*len(axes)
+        for k, i in zip(soft_order, index):
+            loc[k] = i
+        [avgi, avgq] = output[-2:]
+        xi[tuple(loc)] = np.asarray(avgi[0][0])
+        xq[tuple(loc)] = np.asarray(avgq[0][0])
+        timer.lap(n, "transfer")
+        timer.stamp(n)
+
+    ## Hardware sweep keys shouldn't leak into the next program
+    for key in ["hard_sweep_reg", "start", "step", "expts", "hard_sweeps"]:
+        config.pop(key, None)
+    return [xi, xq, order]
+
+
+## oneToneSweep/twoToneSweep with any number of axes, each run in software or in firmware
+## Two tone measurements (hw_cfg qu_ch set) run twoTonePulse, one tone measurements oneTonePulse
+class ndSweep(twoToneSweep):
+
+    def __init__(self, series=None):
+        super().__init__(series)
+        self.sweep_axes = []
+
+    ## Adds an axis from valStart to valStop.  Axes are stored in the order they're added
+    ## See sweepAxis for hard, forceInt, cost, setter and settle
+    def add_sweep_axis(self, npts, valStart, valStop, sweepVarName, hard=False, forceInt=False, cost=None, setter=None, settle=0):
+        if sweepVarName in [axis.name for axis in self.sweep_axes]:
+            print("Error:", sweepVarName, "is already being swept")
+            return
+        self.sweep_axes.append(sweepAxis(sweepVarName, np.linspace(valStart, valStop, npts, endpoint=True), hard=hard, forceInt=forceInt, cost=cost, setter=setter, settle=settle))
+        return
+
+    ## Runs the sweep over every axis added with add_sweep_axis (see run_nd_sweep)
+    ## Set use_cache=True to patch patchable software axes instead of rebuilding, and reorder=False to nest the
+    ## software axes in the order they were added.  serpentine=True runs them back and forth (see sweep_indices).
+    ## instrument=True saves per-program timings (see pointTimer)
+    def do_ND_measurement(self, soc, soccfg, datapath=None, overwrite_existing_data=False, save_data=True, use_cache=False, reorder=True, serpentine=False, instrument=False):
+        ## Sanity check inputs
+        if save_data and datapath==None:
+            print("Error: no datapath provided.  Either provide a datapath argument, or rerun the function with save_data=False")
+            return
+        if len(self.sweep_axes) == 0:
+            print("Error: no sweep axes.  Add some with add_sweep_axis")
+            return
+        elif "x_sweepVals" in self.meas_data.keys() or "y_sweepVals" in self.meas_data.keys():
+            print("Error: x/y sweep values were set.  N-D sweeps only use the axes from add_sweep_axis")
+            return
+        elif "xi" in self.meas_data.keys() and not overwrite_existing_data:
+            print("Error: data already exists in this measurement object.")
+            print("to run acquisition, either initialize a new object")
+            print("or rerun this function with argument overwrite_existing_data=True")
+            return
+        two_tone = self.hw_cfg.get("qu_ch") is not None
+        if not two_tone and self.check_for_qubit_params():
+            print("Error: you are setting qubit parameters for a one tone sweep")
+            print("Measurement cancelled")
+            return
+
+        ## Prepare for measurement
+        print("Starting measurement setup")
+        config = self.setup_meas(soc,soccfg)
+        cache = self.get_prog_cache(use_cache)
+
+        ## Actually do the measurement
+        print("Starting measurement")
+        ## The timer needs a point per program, so demote the hard axes that can't run in firmware first
+        ## (run_nd_sweep does the same, which is a no-op by then)
+        prog_class = twoTonePulse if two_tone else oneTonePulse
+        convert_axis_time_vars(soccfg, config, self.sweep_axes)
+        check_hard_axes(soccfg, config, self.sweep_axes, prog_class)
+        nprogs = int(np.prod([len(axis.vals) for axis in self.sweep_axes if not axis.hard]))
+        timer = pointTimer(nprogs if instrument else 0)
+        [xi, xq, order] = run_nd_sweep(soc, soccfg, config, self.sweep_axes, prog_class=prog_class, cache=cache, reorder=reorder, serpentine=serpentine, timer=timer)
+        print("Measurement complete")
+        print("Nesting order (outermost first):", [self.sweep_axes[k].name for k in order])
+        if use_cache:
+            print(cache)
+
+        ## Store data in class
+        nhard = sum(axis.hard for axis in self.sweep_axes)
+        self.meta["sweep_type"] = "%dD" % len(self.sweep_axes)
+        self.meta["sweep_mode"] = "hard" if nhard == len(self.sweep_axes) else ("mixed" if nhard > 0 else "soft")
+        self.meta["sweep_serpentine"] = int(serpentine)
+        self.meta["config_hash"] = config_hash({**config, **{"sweepVals_"+axis.name : axis.vals for axis in self.sweep_axes}})
+        self.store_sweep_axes(order)
+        self.meas_data["xi"] = xi
+        self.meas_data["xq"] = xq
+        timer.store(self.meas_data)
+        timer.summary()
+
+        ## Save data
+        if save_data:
+            self.write_H5(datapath)
+        return
+
+    ## Saves the axes into meas_data: sweep_axes (names, one per dimension of xi/xq), sweepVals_<name> (and
+    ## sweepVals_<name>_us for time axes), sweep_hard (1 for firmware axes) and sweep_order (nesting, outermost first)
+    def store_sweep_axes(self, order):
+        self.meas_data["sweep_axes"] = [axis.name for axis in self.sweep_axes]
+        for axis in self.sweep_axes:
+            self.meas_data["sweepVals_"+axis.name] = axis.vals
+            if axis.vals_us is not None:
+                self.meas_data["sweepVals_"+axis.name+"_us"] = axis.vals_us
+        self.meas_data["sweep_hard"] = np.array([int(axis.hard) for axis in self.sweep_axes])
+        self.meas_data["sweep_order"] = np.array(order)
+        return
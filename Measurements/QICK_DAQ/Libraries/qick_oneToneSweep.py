@@ -1,7 +1,10 @@
 import numpy as np
+import sys, os, itertools, collections, time, threading, importlib.util
+from concurrent.futures import ThreadPoolExecutor
 from qick import *
 from qick_data import *
 from qick_helpers import *
+from qick_singleShot import *
 
 #----------------------------------------------------------------------
 #
@@ -49,6 +52,22 @@ class oneToneSweep(QICKdata):
         return
       
 
+    ## Returns the compiled-program cache kept on this measurement (None if not in use)
+    ## Hit/miss counters are on self.prog_cache.hits and self.prog_cache.misses
+    def get_prog_cache(self, use_cache=True):
+        if not use_cache:
+            return None
+        if getattr(self, "prog_cache", None) is None:
+            self.prog_cache = programCache()
+        return self.prog_cache
+
+    ## Hash of everything that decides what a sweep measures: the full config plus the sweep values
+    ## A partially written file can only be resumed by a measurement with the same hash
+    def get_config_hash(self, config):
+        sweepVals = {key : self.meas_data[key] for key in ["x_sweepVals", "y_sweepVals"] if key in self.meas_data}
+        sweepVarNames = [self.meas_data[key] for key in ["x_sweepVarName", "y_sweepVarName"] if key in self.meas_data]
+        return config_hash({**config, **sweepVals}, exclude=sweepVarNames)
+
     ## Prepares to run a measurement
     def setup_meas(self, soc,soccfg):   
         self.check_time_params()
@@ -59,7 +78,25 @@ class oneToneSweep(QICKdata):
     
     
     ## Calls the acquisition function to sweep across 1 value in software
-    def do_soft_1D_measurement(self, soc, soccfg, datapath=None, forceInt=False, overwrite_existing_data=False, save_data=True, do_decimated=True):   
+    ## Set hard_sweep=True to sweep res_freq or res_gain in a single firmware loop instead
+    ## Set use_cache=True to reuse compiled programs and only patch the swept register (see self.prog_cache)
+    ## Pass executor (a proxy to a board-side sweepExecutor) to run the whole sweep on the board in one call
+    ## Set prefetch > 0 to build the next programs while the current one acquires (for sweeps that can't be cached; it
+    ## doesn't mix with use_cache, see prefetch_with_cache)
+    ## Set stream_data=True to write points into the h5 file as they come in, flushing every checkpoint_every points
+    ## Pass resume_file (full path to the .h5 of an interrupted run of this same measurement) to only measure the missing points
+    ## Decimated traces are only taken when asked for: do_decimated=True for one after the last point, snapshot_every=N for
+    ## one every N points, each averaged snapshot_avgs times.  They're saved in decimated_snapshots (see decimatedSnapshots)
+    ## Set instrument=True to save per-point timestamps and build/acquire/transfer/save durations (see pointTimer)
+    ## live_view = optional qick_liveplot.liveView that gets every point as it comes in (use its run() to draw while it sweeps)
+    ##             Remote sweeps come back in one piece, and firmware sweeps only return at the end, so those show up all at once
+    def do_soft_1D_measurement(self, soc, soccfg, datapath=None, forceInt=False, overwrite_existing_data=False, save_data=True, do_decimated=False, snapshot_every=0, snapshot_avgs=2000, hard_sweep=False, use_cache=False, executor=None, prefetch=0, stream_data=False, checkpoint_every=1, resume_file=None, instrument=False, live_view=None):   
+        ## Resuming always streams back into the old file
+        if resume_file is not None:
+            stream_data = True
+            if datapath is None:
+                datapath = os.path.dirname(resume_file)
+
         ## Sanity check inputs
         if save_data and datapath==None:
             print("Error: no datapath provided.  Either provide a datapath argument, or rerun the function with save_data=False")
@@ -87,21 +124,232 @@ class oneToneSweep(QICKdata):
         elif (self.meas_data["x_sweepVarName"][0:1] == "qu"):
             print("Error: This is a single tone sweep.  You are trying to sweep over a qubit pulse variable")
             return
+        elif stream_data and not save_data:
+            print("Error: stream_data=True writes to disk as it goes. Rerun with save_data=True")
+            return
+        elif stream_data and hard_sweep:
+            print("Error: a firmware sweep is a single acquisition, so there is nothing to stream or resume")
+            print("Rerun with hard_sweep=False")
+            return
         
         ## Prepare for measurement
         print("Starting measurement setup")
         config = self.setup_meas(soc,soccfg)
 
+        ## Fall back to a software sweep if the board can't loop over this variable
+        if hard_sweep and not can_hard_sweep(soccfg, config, self.meas_data["x_sweepVarName"], self.meas_data["x_sweepVals"]):
+            print("Running as a software sweep instead")
+            hard_sweep = False
+        self.meta["sweep_type"] = "1D"
+        self.meta["sweep_mode"] = "hard" if hard_sweep else ("remote" if executor is not None else "soft")
+        self.meta["config_hash"] = self.get_config_hash(config)
+
+        ## Open the output file, and work out which points are still left to take
+        npts = len(self.meas_data["x_sweepVals"])
+        stream_shapes = {"xi" : (npts,), "xq" : (npts,), "timestamps" : (npts,)}
+        writer = None
+        point_callback = None
+        previous = {key : np.full(npts, np.nan) for key in stream_shapes}
+        if resume_file is not None:
+            [writer, previous] = self.resume_H5_stream(resume_file, stream_shapes)
+            if writer is None:
+                return
+        elif stream_data:
+            writer = self.open_H5_stream(datapath, stream_shapes)
+        todo = np.flatnonzero(np.isnan(previous["timestamps"]))
+        if resume_file is not None:
+            print("Resuming with", len(todo), "of", npts, "points left")
+        if live_view is not None:
+            live_view.set_data(previous["xi"], previous["xq"])
+        if stream_data or live_view is not None:
+            def point_callback(i, I, Q, t):
+                if writer is not None:
+                    writer.write(todo[i], flush=((i+1) % checkpoint_every == 0), xi=I, xq=Q, timestamps=t)
+                if live_view is not None:
+                    live_view.add_point(todo[i], I, Q)
+
         ## Actually do the measurement
         print("Starting measurement")
-        [xi, xq, output_decimated] = oneTone_oneSoftSweep(soc, soccfg, config, sweepVarName=self.meas_data["x_sweepVarName"],sweepVals=self.meas_data["x_sweepVals"], forceInt=forceInt, progress=False, do_decimated=do_decimated)
+        snapshots = decimatedSnapshots(every=snapshot_every, at_end=do_decimated, soft_avgs=snapshot_avgs)
+        timer = pointTimer(len(todo) if instrument else 0)
+        try:
+            if hard_sweep:
+                [xi, xq, output_decimated, played_vals] = oneTone_oneHardSweep(soc, soccfg, config, sweepVarName=self.meas_data["x_sweepVarName"], sweepVals=self.meas_data["x_sweepVals"], progress=False, snapshots=snapshots, timer=timer)
+                self.meas_data["x_sweepVals_requested"] = self.meas_data["x_sweepVals"]
+                self.meas_data["x_sweepVals"] = played_vals
+            elif executor is not None:
+                ## The board sends the whole sweep back as one row
+                def row_callback(index, xi_row, xq_row, t_row):
+                    if writer is not None:
+                        writer.write(todo, xi=xi_row, xq=xq_row, timestamps=t_row)
+                    if live_view is not None:
+                        live_view.add_point(todo, xi_row, xq_row)
+                [xi, xq, output_decimated] = remote_sweep(executor, "oneTonePulse", config, [(self.meas_data["x_sweepVarName"], self.meas_data["x_sweepVals"][todo], forceInt)], use_cache=use_cache, row_callback=row_callback, snapshots=snapshots, timer=timer)
+            else:
+                [xi, xq, output_decimated] = oneTone_oneSoftSweep(soc, soccfg, config, sweepVarName=self.meas_data["x_sweepVarName"],sweepVals=self.meas_data["x_sweepVals"][todo], forceInt=forceInt, progress=False, cache=self.get_prog_cache(use_cache), prefetch=prefetch, point_callback=point_callback, snapshots=snapshots, timer=timer)
+        except BaseException:
+            ## Whatever was streamed before the crash (or ctrl-c) stays on disk
+            if writer is not None:
+                writer.close()
+            raise
         print("Measurement complete")
+        if use_cache and executor is None:
+            print(self.get_prog_cache())
+
+        ## Put the new points in with the ones from before the resume
+        if not hard_sweep:
+            [new_xi, new_xq] = [xi, xq]
+            [xi, xq] = [previous["xi"], previous["xq"]]
+            xi[todo] = new_xi
+            xq[todo] = new_xq
         
         ## Store data in class
+        self.meas_data["xi"]    = xi
+        self.meas_data["xq"]    = xq
+        if live_view is not None:
+            live_view.set_data(xi, xq)
+        snapshots.store(self.meas_data)
+        timer.store(self.meas_data, shape=(npts,), columns=todo, previous=previous)
+        timer.summary()
+        
+        ## Save data
+        t_save = time.perf_counter()
+        if writer is not None:
+            writer.close()
+        elif save_data:
+            self.write_H5(datapath)        
+        if instrument and save_data:
+            print("Saving took %.2f s" % (time.perf_counter() - t_save))
+        return
+    
+    
+    ## Software sweep in single-shot mode: every point's reps*soft_avgs shots are streamed off the board and reduced
+    ## on the fly (see qick_singleShot.shotReducer).  Only the reductions go into meas_data: IQ histograms (bins x bins,
+    ## on iq_range or a window picked from the first shots), running mean/variance/covariance, excited populations
+    ## if a threshold (and angle, in rad) is given, and up to raw_shots raw shots for each point in raw_points.
+    ## xi/xq are the shot means, so the usual plots still work.  Memory per round is reps shots.
+    ## prog_class = program run at each point: oneTonePulse (default), or a two tone one like twoTonePulse, which needs qu_ch
+    ## set instead of rejecting qubit parameters (twoToneSweep's version defaults to twoTonePulse)
+    def do_single_shot_1D_measurement(self, soc, soccfg, datapath=None, forceInt=False, overwrite_existing_data=False, save_data=True, bins=64, iq_range=None, threshold=None, angle=0, raw_points=(), raw_shots=1000, use_cache=False, prog_class=None):
+        if prog_class is None:
+            prog_class = oneTonePulse
+        one_tone = prog_class is oneTonePulse
+        ## Sanity check inputs
+        if save_data and datapath==None:
+            print("Error: no datapath provided.  Either provide a datapath argument, or rerun the function with save_data=False")
+            return
+        elif datapath is not None:
+            if datapath[0:1] == "./":
+                print("Error: you provided a relative datapath.  Rerun with a total datapath")
+                return        
+        if "x_sweepVals" not in self.meas_data.keys():
+            print("Error: x sweep values not found")
+            return
+        elif "y_sweepVals" in self.meas_data.keys():
+            print("Error: y sweep values were provided, but you are running a 1D sweep")
+            print("measurement cancelled to prevent future confusion")
+            return
+        elif "xi" in self.meas_data.keys() and not overwrite_existing_data:
+            print("Error: data already exists in this measurement object.")
+            print("to run acquisition, either initialize a new object")
+            print("or rerun this function with argument overwrite_existing_data=True")
+            return
+        elif one_tone and (self.check_for_qubit_params())== True:
+            print("Error: you are setting qubit parameters for a one tone sweep")
+            print("Measurement cancelled")
+            return
+        elif not one_tone and self.hw_cfg.get("qu_ch") is None:
+            print("Error: qubit channel is set to None in hw_cfg dict, but this is a two tone measurement")
+            return
+        elif any([(i < 0) or (i >= len(self.meas_data["x_sweepVals"])) for i in raw_points]):
+            print("Error: raw_points has to be indices into x_sweepVals")
+            return
+
+        ## Prepare for measurement
+        print("Starting measurement setup")
+        config = self.setup_meas(soc,soccfg)
         self.meta["sweep_type"] = "1D"
+        self.meta["sweep_mode"] = "single_shot"
+
+        ## Actually do the measurement
+        print("Starting measurement")
+        reducer = shotReducer(len(self.meas_data["x_sweepVals"]), bins=bins, iq_range=iq_range, threshold=threshold, angle=angle, raw_points=raw_points, raw_shots=raw_shots)
+        singleShot_softSweep(soc, soccfg, prog_class, config, self.meas_data["x_sweepVarName"], self.meas_data["x_sweepVals"], forceInt=forceInt, reducer=reducer, cache=self.get_prog_cache(use_cache))
+        print("Measurement complete")
+
+        ## Store data in class
+        reducer.store(self.meas_data)
+
+        ## Save data
+        if save_data:
+            self.write_H5(datapath)        
+        return
+    
+    
+    ## Frequency sweep that starts from the coarse grid in x_sweepVals and adds points where the resonance is
+    ## Each round fits a Lorentzian (lorentz_fits.py) to every dip, up to max_dips, in its own window, then bisects the
+    ## intervals where the data or the fits change the most.  Stops once every fit settles (tol_f0 in MHz, tol_gamma as
+    ## a fraction) and matches its data (see oneTone_adaptiveSweep), or at max_points.
+    ## The grid ends up irregular: x_sweepVals/xi/xq are stored sorted by frequency, x_acquire_order has the order
+    ## the points were taken in.  The final fits go in fit_f0, fit_amp, fit_gamma, fit_offset, fit_rms (one entry per
+    ## dip) and fit_err (dip x 4), and fit_history has a (round, npts, dip, f0, gamma, rms) row per dip per round
+    def do_adaptive_1D_measurement(self, soc, soccfg, datapath=None, tol_f0=0.005, tol_gamma=0.02, points_per_round=8, max_points=200, min_step=0.001, max_dips=4, overwrite_existing_data=False, save_data=True, do_decimated=False, snapshot_avgs=2000, use_cache=False):
+        ## Sanity check inputs
+        if save_data and datapath==None:
+            print("Error: no datapath provided.  Either provide a datapath argument, or rerun the function with save_data=False")
+            return
+        elif datapath is not None:
+            if datapath[0:1] == "./":
+                print("Error: you provided a relative datapath.  Rerun with a total datapath")
+                return        
+        if "x_sweepVals" not in self.meas_data.keys():
+            print("Error: x sweep values not found")
+            return
+        elif "y_sweepVals" in self.meas_data.keys():
+            print("Error: y sweep values were provided, but you are running a 1D sweep")
+            print("measurement cancelled to prevent future confusion")
+            return
+        elif "xi" in self.meas_data.keys() and not overwrite_existing_data:
+            print("Error: data already exists in this measurement object.")
+            print("to run acquisition, either initialize a new object")
+            print("or rerun this function with argument overwrite_existing_data=True")
+            return
+        elif (self.check_for_qubit_params())== True:
+            print("Error: you are setting qubit parameters for a one tone sweep")
+            print("Measurement cancelled")
+            return
+        elif self.meas_data["x_sweepVarName"] != "res_freq":
+            print("Error: adaptive sweeps only work over res_freq")
+            return
+        elif len(self.meas_data["x_sweepVals"]) < 16:
+            print("Error: the coarse grid needs at least 16 points to guess a fit from")
+            return
+        
+        ## Prepare for measurement
+        print("Starting measurement setup")
+        config = self.setup_meas(soc,soccfg)
+
+        ## Actually do the measurement
+        print("Starting measurement")
+        snapshots = decimatedSnapshots(at_end=do_decimated, soft_avgs=snapshot_avgs)
+        [freqs, xi, xq, order, fits, fit_history, output_decimated] = oneTone_adaptiveSweep(soc, soccfg, config, self.meas_data["x_sweepVals"], tol_f0=tol_f0, tol_gamma=tol_gamma, points_per_round=points_per_round, max_points=max_points, min_step=min_step, max_dips=max_dips, cache=self.get_prog_cache(use_cache), snapshots=snapshots)
+        print("Measurement complete")
+        if use_cache:
+            print(self.get_prog_cache())
+        
+        ## Store data in class
+        self.meta["sweep_type"] = "1D"
+        self.meta["sweep_mode"] = "adaptive"
+        self.meas_data["x_sweepVals_coarse"] = self.meas_data["x_sweepVals"]
+        self.meas_data["x_sweepVals"] = freqs
+        self.meas_data["x_acquire_order"] = order
         self.meas_data["xi"]    = xi
         self.meas_data["xq"]    = xq
-        self.meas_data["output_decimated"] = output_decimated[0]
+        snapshots.store(self.meas_data)
+        self.meas_data["fit_history"] = fit_history
+        if len(fits) > 0:
+            for key in ["f_f0", "f_amp", "f_gamma", "f_offset", "f_err", "rms"]:
+                self.meas_data["fit"+key[1:] if key[:2] == "f_" else "fit_"+key] = np.array([fit[key] for fit in fits])
         
         ## Save data
         if save_data:
@@ -110,7 +358,28 @@ class oneToneSweep(QICKdata):
     
     
     ## Sweeps any two variables in software
-    def do_soft_2D_measurement(self, soc, soccfg, datapath=None, x_forceInt=False, y_forceInt=False, overwrite_existing_data=False, save_data=True, do_decimated=True):        
+    ## Set use_cache=True to reuse compiled programs and only patch the swept registers (see self.prog_cache)
+    ## Pass executor (a proxy to a board-side sweepExecutor) to run the whole sweep on the board in one call
+    ## Set prefetch > 0 to build the next programs while the current one acquires (for sweeps that can't be cached; it
+    ## doesn't mix with use_cache, see prefetch_with_cache)
+    ## With stream_data=True each finished row goes straight into the h5 file (see qick_data.H5streamWriter),
+    ## so a crash part way through a long map keeps everything measured so far.  Unmeasured points are NaN.
+    ## keep_in_memory=False only holds one row at a time, and leaves xi/xq out of meas_data (read them back from the file)
+    ## Pass resume_file (full path to the .h5 of an interrupted run of this same measurement) to only measure the missing rows
+    ## Decimated traces work as in do_soft_1D_measurement, with snapshot_every counted in rows
+    ## Set instrument=True to save per-point timestamps and stage durations, stored (y, x) like xi (see pointTimer)
+    ## x/y_cost and x/y_settle say how expensive changing each axis is (see change_cost) and how long to wait after it
+    ## changes.  With reorder=True the more expensive axis is put in the outer loop (streamed and remote sweeps always
+    ## have x outermost), and serpentine=True runs the inner axis back and forth.  The stored maps are (y, x) either way
+    ## live_view = optional qick_liveplot.liveView that gets every point as it comes in (use its run() to draw while it sweeps)
+    ##             Remote sweeps update it a row at a time, as the rows arrive from the board
+    def do_soft_2D_measurement(self, soc, soccfg, datapath=None, x_forceInt=False, y_forceInt=False, overwrite_existing_data=False, save_data=True, do_decimated=False, snapshot_every=0, snapshot_avgs=2000, use_cache=False, executor=None, prefetch=0, stream_data=False, keep_in_memory=True, resume_file=None, instrument=False, x_cost=None, y_cost=None, x_settle=0, y_settle=0, reorder=True, serpentine=False, live_view=None):        
+        ## Resuming always streams back into the old file
+        if resume_file is not None:
+            stream_data = True
+            if datapath is None:
+                datapath = os.path.dirname(resume_file)
+
         ## Sanity check inputs
         if save_data and datapath==None:
             print("Error: no datapath provided.  Either provide a datapath argument, or rerun the function with save_data=False")
@@ -137,25 +406,109 @@ class oneToneSweep(QICKdata):
         elif (self.meas_data["x_sweepVarName"][0:1] == "qu") or (self.meas_data["y_sweepVarName"][0:1] == "qu"):
             print("Error: This is a single tone sweep.  You are trying to sweep over a qubit pulse variable")
             return
+        elif stream_data and not save_data:
+            print("Error: stream_data=True writes to disk as it goes. Rerun with save_data=True")
+            return
+        elif not keep_in_memory and not stream_data:
+            print("Error: keep_in_memory=False needs stream_data=True, or the data would be thrown away")
+            return
         
         ## Prepare for measurement
         print("Starting measurement setup")
         config = self.setup_meas(soc,soccfg)
+        self.meta["sweep_type"] = "2D"
+        self.meta["sweep_mode"] = "remote" if executor is not None else "soft"
+        self.meta["config_hash"] = self.get_config_hash(config)
+
+        ## Put the axis whose changes cost the most outside (see nesting_weight).  Equal costs keep x outermost
+        outer = "x"
+        if reorder and executor is None and not stream_data:
+            costs = [change_cost(self.meas_data[axis+"_sweepVarName"], config, self.get_prog_cache(use_cache), cost, settle) for axis, cost, settle in [("x", x_cost, x_settle), ("y", y_cost, y_settle)]]
+            weights = [nesting_weight(cost, len(self.meas_data[axis+"_sweepVals"])) for axis, cost in zip(["x", "y"], costs)]
+            if costs[1] > costs[0] and weights[1] > weights[0]:
+                outer = "y"
+                print("Sweeping", self.meas_data["y_sweepVarName"], "in the outer loop, it's the more expensive axis to change")
+        if executor is not None and (serpentine or x_settle > 0 or y_settle > 0):
+            print("Warning: remote sweeps run in plain raster order on the board, ignoring serpentine and settle times")
+            serpentine = False
+        self.meta["sweep_outer"] = outer
+        self.meta["sweep_serpentine"] = int(serpentine)
+
+        ## Stored maps are (y, x), so each finished x value is one column
+        ## Open the output file, and work out which columns are still left to take
+        shape = (len(self.meas_data["y_sweepVals"]), len(self.meas_data["x_sweepVals"]))
+        stream_shapes = {"xi" : shape, "xq" : shape, "timestamps" : shape}
+        writer = None
+        row_callback = None
+        previous = {key : np.full(shape, np.nan) for key in stream_shapes}
+        if resume_file is not None:
+            [writer, previous] = self.resume_H5_stream(resume_file, stream_shapes)
+            if writer is None:
+                return
+        elif stream_data:
+            writer = self.open_H5_stream(datapath, stream_shapes)
+        todo = np.flatnonzero(np.isnan(previous["timestamps"]).any(axis=0))
+        if resume_file is not None:
+            print("Resuming with", len(todo), "of", shape[1], "rows left")
+        if stream_data:
+            def row_callback(i, xi_row, xq_row, t_row):
+                writer.write((slice(None), todo[i]), xi=xi_row, xq=xq_row, timestamps=t_row)
+        point_callback = None
+        if live_view is not None:
+            live_view.set_data(previous["xi"], previous["xq"])
+            def point_callback(i, j, I, Q, t):
+                live_view.add_point((j, todo[i]), I, Q)
 
         ## Actually do the measurement
         print("Starting measurement")
-        [xi, xq, output_decimated] = oneTone_twoSoftSweep(soc, soccfg, config, x_sweepVarName=self.meas_data["x_sweepVarName"], x_sweepVals=self.meas_data["x_sweepVals"], y_sweepVarName=self.meas_data["y_sweepVarName"], y_sweepVals=self.meas_data["y_sweepVals"], x_forceInt=x_forceInt, y_forceInt=y_forceInt, do_decimated=do_decimated)
+        snapshots = decimatedSnapshots(every=snapshot_every, at_end=do_decimated, soft_avgs=snapshot_avgs)
+        timer = pointTimer(len(todo)*shape[0] if instrument else 0)
+        try:
+            if executor is not None:
+                axes = [(self.meas_data["x_sweepVarName"], self.meas_data["x_sweepVals"][todo], x_forceInt), (self.meas_data["y_sweepVarName"], self.meas_data["y_sweepVals"], y_forceInt)]
+                ## Each block from the board is one x value, a column of the stored (y, x) map
+                def stream_callback(index, xi_row, xq_row, t_row):
+                    if row_callback is not None:
+                        row_callback(index[0], xi_row, xq_row, t_row)
+                    if live_view is not None:
+                        live_view.add_point((slice(None), todo[index[0]]), xi_row, xq_row)
+                [xi, xq, output_decimated] = remote_sweep(executor, "oneTonePulse", config, axes, use_cache=use_cache, row_callback=stream_callback, snapshots=snapshots, timer=timer, keep_data=keep_in_memory)
+                if keep_in_memory:
+                    xi = np.transpose(xi)
+                    xq = np.transpose(xq)
+            else:
+                [xi, xq, output_decimated] = oneTone_twoSoftSweep(soc, soccfg, config, x_sweepVarName=self.meas_data["x_sweepVarName"], x_sweepVals=self.meas_data["x_sweepVals"][todo], y_sweepVarName=self.meas_data["y_sweepVarName"], y_sweepVals=self.meas_data["y_sweepVals"], x_forceInt=x_forceInt, y_forceInt=y_forceInt, cache=self.get_prog_cache(use_cache), prefetch=prefetch, row_callback=row_callback, keep_data=keep_in_memory, snapshots=snapshots, timer=timer, outer=outer, serpentine=serpentine, x_settle=x_settle, y_settle=y_settle, point_callback=point_callback)
+        except BaseException:
+            ## Whatever was streamed before the crash (or ctrl-c) stays on disk
+            if writer is not None:
+                writer.close()
+            raise
         print("Measurement complete")
+        if use_cache and executor is None:
+            print(self.get_prog_cache())
     
-        ## Store data in class
-        self.meta["sweep_type"] = "2D"
-        self.meas_data["xi"] = xi
-        self.meas_data["xq"] = xq
-        self.meas_data["output_decimated"] = output_decimated[0]
+        ## Store data in class, along with the columns from before the resume
+        if keep_in_memory:
+            [new_xi, new_xq] = [xi, xq]
+            [xi, xq] = [previous["xi"], previous["xq"]]
+            xi[:, todo] = new_xi
+            xq[:, todo] = new_xq
+            self.meas_data["xi"] = xi
+            self.meas_data["xq"] = xq
+            if live_view is not None:
+                live_view.set_data(xi, xq)
+        snapshots.store(self.meas_data)
+        timer.store(self.meas_data, shape=shape, columns=todo, previous=previous)
+        timer.summary()
         
         ## Save data
-        if save_data:
+        t_save = time.perf_counter()
+        if writer is not None:
+            writer.close()
+        elif save_data:
             self.write_H5(datapath)        
+        if instrument and save_data:
+            print("Saving took %.2f s" % (time.perf_counter() - t_save))
         return
     
     
@@ -334,12 +687,32 @@ class oneToneSweep(QICKdata):
             plt.show()
         return
     
+    ## Takes a decimated trace right now, with the measurement's current config, and adds it to decimated_snapshots
+    ## index is stored with it in decimated_snapshot_index (-1 = not tied to a sweep point)
+    def take_decimated_snapshot(self, soc, soccfg, soft_avgs=2000, index=-1):
+        config = self.setup_meas(soc,soccfg)
+        snapshots = decimatedSnapshots(soft_avgs=soft_avgs)
+        if "decimated_snapshots" in self.meas_data:
+            for output, old_index in zip(self.meas_data["decimated_snapshots"], self.meas_data["decimated_snapshot_index"]):
+                snapshots.add([output], old_index)
+        snapshots.take(soc, soccfg, config, index)
+        snapshots.store(self.meas_data)
+        return
+
     ## Plots a decimated sweep
-    def plot_decimated(self):
+    ## snapshot picks one of decimated_snapshots; by default the latest one (output_decimated) is shown
+    def plot_decimated(self, snapshot=None):
+        if "output_decimated" not in self.meas_data.keys():
+            print("Error: no decimated output. Rerun with do_decimated=True or snapshot_every, or use take_decimated_snapshot")
+            return
         title_string = "Decimated Output" + "\n" + self.meta["series"]
-        plt.plot(np.abs(self.meas_data["output_decimated"][0]+1j*self.meas_data["output_decimated"][1]), label="amps")
-        plt.plot(self.meas_data["output_decimated"][0], label="I")
-        plt.plot(self.meas_data["output_decimated"][1], label="Q")
+        output = self.meas_data["output_decimated"]
+        if snapshot is not None:
+            output = self.meas_data["decimated_snapshots"][snapshot]
+            title_string = title_string + " (after point %d)" % self.meas_data["decimated_snapshot_index"][snapshot]
+        plt.plot(np.abs(output[0]+1j*output[1]), label="amps")
+        plt.plot(output[0], label="I")
+        plt.plot(output[1], label="Q")
 
         plt.legend()
         plt.ylabel("adc units")
@@ -471,15 +844,9 @@ class oneToneSweep(QICKdata):
             if(x_sweepVarName[-3:] == "_us"):
                 print("Converting x sweep from us to clock ticks")
 
-                ## Make an array to hold converted sweep vals
-                converted_sweep_vals = np.zeros(len(self.meas_data["x_sweepVals"]))
-
-                ## Iterate through, convert from us to clock ticks
-                for i, val in enumerate(self.meas_data["x_sweepVals"]):
-                    if (x_sweepVarName[:1] == "qu"):
-                        converted_sweep_vals[i] = soccfg.us2cycles(val,gen_ch=self.hw_cfg["qu_ch"])
-                    else:
-                        converted_sweep_vals[i] = soccfg.us2cycles(val,gen_ch=self.hw_cfg["res_ch"])
+                ## Convert the whole sweep from us to clock ticks, in the clock of the channel that plays it
+                gen_ch = self.hw_cfg.get(time_var_channel(x_sweepVarName))
+                converted_sweep_vals = us2cycles_vec(soccfg, self.meas_data["x_sweepVals"], gen_ch)
 
                 ## Overwrite sweep values with us version
                 print("Saving unconverted sweep as x_sweepVals_us")
@@ -497,15 +864,9 @@ class oneToneSweep(QICKdata):
             if(y_sweepVarName[-3:] == "_us"):
                 print("Converting y sweep from us to clock ticks")
 
-                ## Make an array to hold converted sweep vals
-                converted_sweep_vals = np.zeros(len(self.meas_data["y_sweepVals"]))
-
-                ## Iterate through, convert from us to clock ticks
-                for i, val in enumerate(self.meas_data["y_sweepVals"]):
-                    if (y_sweepVarName[:1] == "qu"):
-                        converted_sweep_vals[i] = soccfg.us2cycles(val,gen_ch=self.hw_cfg["qu_ch"])
-                    else:
-                        converted_sweep_vals[i] = soccfg.us2cycles(val,gen_ch=self.hw_cfg["res_ch"])
+                ## Convert the whole sweep from us to clock ticks, in the clock of the channel that plays it
+                gen_ch = self.hw_cfg.get(time_var_channel(y_sweepVarName))
+                converted_sweep_vals = us2cycles_vec(soccfg, self.meas_data["y_sweepVals"], gen_ch)
 
                 ## Overwrite sweep values with us version
                 print("Saving unconverted sweep as y_sweepVals_us")
@@ -521,87 +882,677 @@ class oneToneSweep(QICKdata):
 # Helper Functions
 #----------------------------------------------------------------------------------------------------------------------
 
+## Builds a program, or pulls it from the cache with the swept registers patched in
+def make_prog(prog_class, soccfg, config, cache=None, patch_keys=()):
+    if cache is None:
+        return prog_class(soccfg, config)
+    return cache.get(prog_class, soccfg, config, patch_keys=patch_keys)
+
+## Prefetching builds a fresh program per point in a worker thread, so it can't use the cache (which patches one
+## program in place, and that program may still be on the board).  If the cache can patch any of the swept keys
+## it's the faster of the two, so prefetch is turned off; otherwise the cache has nothing to offer and is skipped
+## Returns the prefetch depth to use
+def prefetch_with_cache(prefetch, cache, config, sweepVarNames):
+    if prefetch <= 0 or cache is None:
+        return prefetch
+    if any(change_cost(name, config, cache) == 1 for name in sweepVarNames):
+        print("Warning: prefetch and the program cache don't mix; patching cached programs is faster here, turning off prefetch")
+        return 0
+    print("Warning: prefetch and the program cache don't mix; none of", list(sweepVarNames), "can be patched, so prefetching without the cache")
+    return prefetch
+
+## Cost of changing a sweep variable once, relative to patching a register (1).  An explicit cost wins; otherwise
+## it's 1 for registers the program cache can patch and 10 for anything that needs a rebuild (or an instrument),
+## plus 1 per ms of settle time
+def change_cost(sweepVarName, config, cache=None, cost=None, settle=0, setter=None):
+    if cost is not None:
+        return cost
+    patchable = setter is None and cache is not None and sweepVarName in patchable_regs and config.get(patchable_regs[sweepVarName][0]) is not None
+    return (1 if patchable else 10) + 1e3*settle
+
+## How badly an axis of npts points with this change cost wants to be outside the others.  An axis at depth k changes
+## n_0*...*n_k times, so swapping two neighbours a, b only pays off if c_a*n_a/(n_a-1) < c_b*n_b/(n_b-1): sorting
+## on this, largest outside, is the cheapest nesting
+def nesting_weight(cost, npts):
+    return np.inf if npts < 2 else cost*npts/(npts-1)
+
+## Indices of every point of a sweep over axes of these sizes (outermost first), in the order they're taken
+## serpentine=True runs every inner axis back and forth (boustrophedon) instead of jumping back to its start,
+## so consecutive points only ever differ by one step of one axis
+def sweep_indices(sizes, serpentine=False):
+    for index in itertools.product(*[range(n) for n in sizes]):
+        if not serpentine:
+            yield index
+            continue
+        snake = []
+        passes = 0    ## how many full passes the axis has made so far = how often the axes outside it have stepped
+        for n, i in zip(sizes, index):
+            snake.append(n-1-i if passes % 2 else i)
+            passes = passes*n + i
+        yield tuple(snake)
+
+## Decides when a sweep takes decimated snapshots, and keeps the ones it took
+## every     = take one after every N points (1D) or rows (2D); 0 = never on a schedule
+## at_end    = take one after the last point, like do_decimated=True always did
+## soft_avgs = averaging budget of each snapshot (reps is always 1)
+## Call request() (e.g. from another thread or a live plot) to get one at the next point/row boundary.
+## Snapshots run on a copy of the config, so the sweep's own config is never touched.
+class decimatedSnapshots:
+    def __init__(self, every=0, at_end=False, soft_avgs=2000):
+        self.every     = every
+        self.at_end    = at_end
+        self.soft_avgs = soft_avgs
+        self.outputs   = []
+        self.indices   = []
+        self.requested = threading.Event()
+
+    def request(self):
+        self.requested.set()
+
+    ## Takes one snapshot now, tagged with the index of the point/row it follows
+    def take(self, soc, soccfg, config, index, prog_class=None):
+        self.requested.clear()
+        snap_cfg = dict(config)
+        snap_cfg["reps"] = 1
+        snap_cfg["soft_avgs"] = self.soft_avgs
+        prog = (prog_class or oneTonePulse)(soccfg, snap_cfg)
+        self.add(acquire_decimated_prog(prog, soc, load_pulses=True, progress=False), index)
+
+    ## Keeps a snapshot that was taken somewhere else (e.g. on the board by a sweepExecutor)
+    def add(self, output, index):
+        self.outputs.append(output)
+        self.indices.append(index)
+
+    ## Called after each point/row: takes a snapshot if one is due or was requested
+    def step(self, soc, soccfg, config, index, prog_class=None):
+        if (self.every > 0 and (index+1) % self.every == 0) or self.requested.is_set():
+            self.take(soc, soccfg, config, index, prog_class)
+
+    ## Called once the sweep is done
+    def finish(self, soc, soccfg, config, index, prog_class=None):
+        if (self.at_end or self.requested.is_set()) and (len(self.indices) == 0 or self.indices[-1] != index):
+            self.take(soc, soccfg, config, index, prog_class)
+
+    ## Latest snapshot in the same format as acquire_decimated (zeros if there isn't one)
+    def last(self):
+        if len(self.outputs) == 0:
+            return np.zeros((2,2))
+        return self.outputs[-1]
+
+    ## Saves what was taken into meas_data: every snapshot in decimated_snapshots (nsnap, 2, nsamples) with the
+    ## point/row each one followed in decimated_snapshot_index, and the latest one as output_decimated
+    def store(self, meas_data):
+        if len(self.outputs) == 0:
+            return
+        meas_data["decimated_snapshots"] = np.array([output[0] for output in self.outputs])
+        meas_data["decimated_snapshot_index"] = np.array(self.indices)
+        meas_data["output_decimated"] = self.outputs[-1][0]
+
+
+## Opt-in per-point timing for the sweep loops (instrument=True on the measurement functions)
+## Every point gets a unix timestamp (when its data came back) and how long it spent in each stage [s]:
+##     build    = making (or patching) the program.  With prefetch this runs in the worker, overlapping other points
+##     acquire  = the acquire call (on a real board this includes compile, pulse load and the Pyro round trip)
+##     transfer = getting the result into the output arrays; for remote sweeps, the row's time on the link
+##     save     = streaming to the h5 file.  Rows are saved as a whole, so that lands on the last point of the row
+## Points are numbered in the order they're taken.  npts=0 makes a timer that records nothing.
+class pointTimer:
+    stages = ["build", "acquire", "transfer", "save"]
+
+    def __init__(self, npts=0):
+        self.enabled    = npts > 0
+        self.timestamps = np.full(npts, np.nan)
+        self.durations  = {stage : np.full(npts, np.nan) for stage in self.stages}
+        self.t          = None
+
+    ## Starts the clock for the next lap
+    def start(self):
+        if self.enabled:
+            self.t = time.perf_counter()
+
+    ## Books the time since the last start/lap to one stage of point i
+    def lap(self, i, stage):
+        if self.enabled:
+            t = time.perf_counter()
+            self.book(i, stage, t - self.t)
+            self.t = t
+
+    ## Books a duration that was measured somewhere else (a worker thread, or the board)
+    def book(self, i, stage, dt):
+        if self.enabled:
+            self.durations[stage][i] = dt
+
+    def stamp(self, i, t=None):
+        if self.enabled:
+            self.timestamps[i] = time.time() if t is None else t
+
+    ## Renumbers points that were taken out of order: point k becomes point order[k]
+    def renumber(self, order):
+        if self.enabled:
+            self.timestamps[order] = self.timestamps.copy()
+            for stage in self.stages:
+                self.durations[stage][order] = self.durations[stage].copy()
+
+    ## Saves the timings into meas_data as timestamps, t_build, t_acquire, t_transfer and t_save
+    ## shape   = shape of the stored data, if it isn't one point per entry in acquisition order
+    ## columns = which columns (x values) of that shape this sweep took, for 2D maps stored as (y, x)
+    ## previous = {key: array} of what a resumed file already has (e.g. its timestamps), to fill in the rest from
+    def store(self, meas_data, shape=None, columns=None, previous={}):
+        if not self.enabled:
+            return
+        arrays = {"timestamps" : self.timestamps, **{"t_"+stage : self.durations[stage] for stage in self.stages}}
+        for key in arrays:
+            if shape is None:
+                meas_data[key] = arrays[key]
+                continue
+            full = np.array(previous[key], dtype=float) if key in previous else np.full(shape, np.nan)
+            if len(shape) == 1:
+                full[columns] = arrays[key]
+            else:
+                full[:, columns] = arrays[key].reshape(len(columns), shape[0]).T
+            meas_data[key] = full
+
+    ## Prints the rate and where the time went, and flags the slowest points
+    def summary(self, nslow=3):
+        if not self.enabled or np.all(np.isnan(self.timestamps)):
+            return
+        npts  = np.count_nonzero(~np.isnan(self.timestamps))
+        ts    = np.sort(self.timestamps[~np.isnan(self.timestamps)])
+        gaps  = np.diff(ts)
+        print("====---------------------------====")
+        print("  Timing of", npts, "points")
+        if len(gaps) > 0:
+            print("  %.2f points/sec, median gap %.2f ms, longest gap %.2f s" % ((npts-1)/(ts[-1]-ts[0]), 1e3*np.median(gaps), gaps.max()))
+        total = np.nansum([np.nansum(self.durations[stage]) for stage in self.stages])
+        for stage in self.stages:
+            dt = self.durations[stage]
+            if np.all(np.isnan(dt)):
+                continue
+            print("  %-9s total %8.2f s (%4.1f%%), median %8.3f ms, max %8.3f ms" % (stage, np.nansum(dt), 100*np.nansum(dt)/total, 1e3*np.nanmedian(dt), 1e3*np.nanmax(dt)))
+        point_total = np.nansum([self.durations[stage] for stage in self.stages], axis=0)
+        slowest = np.argsort(point_total)[::-1][:nslow]
+        print("  slowest points:", ", ".join("%d (%.1f ms)" % (i, 1e3*point_total[i]) for i in slowest))
+        print("====---------------------------====")
+
+
+## Acquires a stream of configs, building + compiling the next programs in a worker thread
+## while the current one runs on the board.  At most `prefetch` programs are built ahead.
+## configs can be a generator that mutates and re-yields one dict; each one is copied before it's handed off.
+## Yields (I, Q, config) per config, in order; config is the copy that point was built from
+## timer = optional pointTimer; gets the build time of each point and is left running from the end of its acquire
+def pipelined_acquire(soc, soccfg, prog_class, configs, prefetch=2, timer=None):
+    if timer is None:
+        timer = pointTimer()
+    def build(n, cfg):
+        t = time.perf_counter()
+        prog = prog_class(soccfg, cfg)
+        prog.compile()
+        timer.book(n, "build", time.perf_counter() - t)
+        return prog
+    configs = iter(configs)
+    pending = collections.deque()
+    nqueued = 0
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        for cfg in itertools.islice(configs, max(prefetch, 1)):
+            pending.append(pool.submit(build, nqueued, dict(cfg)))
+            nqueued += 1
+        n = 0
+        while pending:
+            prog = pending.popleft().result()
+            ## Queue up the next build before blocking on the board
+            cfg = next(configs, None)
+            if cfg is not None:
+                pending.append(pool.submit(build, nqueued, dict(cfg)))
+                nqueued += 1
+            timer.start()
+            [[I]], [[Q]] = acquire_prog(prog, soc, load_pulses=True, progress=False)
+            timer.lap(n, "acquire")
+            n += 1
+            yield I, Q, prog.cfg
+
 ## Arguments:
 ## sweepVarName    = dictionary key for the variable
 ## sweepVals       = array of values to sweep over
 ## forceInt        = true/false indicating whether your sweep var needs to be an int
 ## Sweeps a variable in software by updating the program config file.  Returns accumulated output
-def oneTone_oneSoftSweep(soc, soccfg, config, sweepVarName, sweepVals, forceInt=False, progress=True, do_decimated=True):
+## cache           = optional programCache; the program is then only rebuilt when the non-swept config changes
+## prefetch        = if > 0, build this many programs ahead in a worker thread while the board acquires (see pipelined_acquire
+##                   and prefetch_with_cache for what happens with a cache)
+## point_callback  = optional function (i, I, Q, t) called after each point, with a unix timestamp
+## snapshots       = optional decimatedSnapshots saying when to take decimated traces (overrides do_decimated)
+## timer           = optional pointTimer(len(sweepVals)) to record per-point timestamps and stage durations in
+def oneTone_oneSoftSweep(soc, soccfg, config, sweepVarName, sweepVals, forceInt=False, progress=True, do_decimated=False, cache=None, prefetch=0, point_callback=None, snapshots=None, timer=None):
+    if snapshots is None:
+        snapshots = decimatedSnapshots(at_end=do_decimated)
+    if timer is None:
+        timer = pointTimer()
+
     ## Make an output container
     xi = np.zeros(len(sweepVals))
     xq = np.zeros(len(sweepVals))
 
     ## Iterate over list of sweep values
     output = np.zeros(len(sweepVals)).astype(complex)
-    for i, val in enumerate(sweepVals):
+    prefetch = prefetch_with_cache(prefetch, cache, config, [sweepVarName])
+    if prefetch > 0:
+        def point_configs():
+            for val in sweepVals:
+                config[sweepVarName] = int(val) if forceInt else val
+                yield config
+        for i, (I, Q, point_config) in enumerate(pipelined_acquire(soc, soccfg, oneTonePulse, point_configs(), prefetch=prefetch, timer=timer)):
+            xi[i] = I
+            xq[i] = Q
+            t = time.time()
+            timer.lap(i, "transfer")
+            timer.stamp(i, t)
+            if point_callback is not None:
+                point_callback(i, I, Q, t)
+                timer.lap(i, "save")
+            snapshots.step(soc, soccfg, point_config, i)
+    else:
+        for i, val in enumerate(sweepVals):
+            timer.start()
             ## Convert to int if needed
             if(forceInt):
                 val = int(val)                
             config[sweepVarName] = val      ## update val
-            prog = oneTonePulse(soccfg, config)   ## remake program
-            [[I]], [[Q]] = prog.acquire(soc, progress=progress)
+            prog = make_prog(oneTonePulse, soccfg, config, cache, patch_keys=[sweepVarName])   ## remake (or patch) program
+            timer.lap(i, "build")
+            [[I]], [[Q]] = acquire_prog(prog, soc, progress=progress)
+            timer.lap(i, "acquire")
             xi[i] = I
             xq[i] = Q
+            t = time.time()
+            timer.lap(i, "transfer")
+            timer.stamp(i, t)
+            if point_callback is not None:
+                point_callback(i, I, Q, t)
+                timer.lap(i, "save")
+            snapshots.step(soc, soccfg, config, i)
+
+    #Get the decimated output for the last run, if it was asked for
+    snapshots.finish(soc, soccfg, config, len(sweepVals)-1)
+    fullOutput = [xi, xq, snapshots.last()]
+    return fullOutput
 
-    #Get the decimated output for the last run, just for a sample
-    if(do_decimated):
-        config["reps"] = 1
-        config["soft_avgs"] = 2000
-        prog = oneTonePulse(soccfg, config)
-        output_decimated = prog.acquire_decimated(soc, progress=False)
+
+## lorentz_fits.py lives up in Measurements/, with the analysis notebooks.  It's loaded from there by path (once),
+## since putting Measurements/ on sys.path would let its older qick_data.py shadow this one
+lorentz_fits_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "lorentz_fits.py")
+def lorentz_fits():
+    if "qick_lorentz_fits" not in sys.modules:
+        spec = importlib.util.spec_from_file_location("qick_lorentz_fits", lorentz_fits_path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules["qick_lorentz_fits"] = module
+    return sys.modules["qick_lorentz_fits"]
+
+## Fits a Lorentzian to the magnitude of a (sorted) frequency sweep, with lorentz_fits.py
+## The first fit starts from a guess centred on f0 (or the biggest deviation), with the offset from the outermost
+## points, so the sweep should be a window around one dip.  Later fits start from the previous one
+## Returns the fit_params dict, or None if the fit doesn't converge
+def fit_resonance(freqs, xi, xq, previous=None, f0=None):
+    curvefit_lorentz = lorentz_fits().curvefit_lorentz
+    if previous is None:
+        amps = np.sqrt(xi**2 + xq**2)
+        if len(amps) < 8:
+            return None
+        guess = {"g_offset" : 0.5*(np.mean(amps[:4]) + np.mean(amps[-4:]))}
+        dist = amps - guess["g_offset"]
+        peak = np.argmax(np.abs(dist)) if f0 is None else np.argmin(np.abs(freqs - f0))
+        ## Make the amplitude an area (that's what lorentzian() takes)
+        guess["g_f0"]    = freqs[peak]
+        guess["g_gamma"] = 2*np.median(np.diff(freqs))
+        guess["g_amp"]   = dist[peak]*np.pi*guess["g_gamma"]/2
     else:
-        output_decimated = np.zeros((2,2))
-    fullOutput = [xi, xq, output_decimated]
+        guess = {"g"+key[1:] : previous[key] for key in ["f_f0", "f_amp", "f_gamma", "f_offset"]}
+    try:
+        fit_params = curvefit_lorentz(freqs, xi, xq, guess, plot=False)
+    except (RuntimeError, ValueError, TypeError):
+        return None
+    if not np.all(np.isfinite(fit_params["f_err"])):
+        return None
+    fit_params["f_gamma"] = np.abs(fit_params["f_gamma"])
+    return fit_params
+
+## Noise of a magnitude trace, from the spread of its point-to-point steps (which a few dips hardly change)
+def magnitude_noise(amps):
+    return 1.4826*np.median(np.abs(np.diff(amps)))/np.sqrt(2)
+
+## Finds the separate dips (or peaks) in a sorted magnitude trace: runs of points further from the baseline than
+## 6 noise levels and a fifth of the biggest deviation.  Returns up to max_dips (the biggest) as [f0, lo, hi],
+## sorted by frequency, where lo/hi bound the window that belongs to the dip (halfway to its neighbours)
+def find_dips(freqs, amps, baseline, noise, max_dips=4):
+    dist = np.abs(amps - baseline)
+    above = dist > max(6*noise, 0.2*dist.max())
+    runs = np.split(np.arange(len(amps)), np.flatnonzero(np.diff(above.astype(int))) + 1)
+    peaks = [run[np.argmax(dist[run])] for run in runs if above[run[0]]]
+    peaks = sorted(sorted(peaks, key=lambda k: -dist[k])[:max_dips])
+    f0s = freqs[peaks]
+    edges = np.concatenate([[freqs[0]], 0.5*(f0s[1:] + f0s[:-1]), [freqs[-1]]])
+    return [[f0s[k], edges[k], edges[k+1]] for k in range(len(peaks))]
+
+## Arguments:
+## sweepVals        = coarse starting grid of res_freq values (at least 16 points)
+## tol_f0           = stop once every dip's fitted f0 moves less than this between rounds, and its fit error is below it (MHz)
+## tol_gamma        = ... and its fitted gamma changes by less than this fraction
+## points_per_round = number of intervals to bisect each round
+## max_points       = cap on the total number of acquisitions
+## min_step         = never bisect an interval narrower than 2*min_step (MHz)
+## max_dips         = most dips (or peaks) to fit separately, e.g. 2 for the HM01/HM02 window
+## Refines a frequency sweep around the resonances instead of taking a dense grid.  Each round finds the dips that
+## stand out from the coarse grid's baseline and fits a Lorentzian to each in its own window.  Intervals are scored by
+## how much the measured magnitude, and the fits, change across them; the top scorers get a new midpoint.
+## A dip only counts as converged if its fit is stable and also describes the data: the fit's rms residual in its
+## window has to be within 3 noise levels (plus 5% of the dip depth).  Otherwise points keep being added.
+## Returns points sorted by frequency: [freqs, xi, xq, acquire order, fits (one per dip), fit_history, output_decimated]
+def oneTone_adaptiveSweep(soc, soccfg, config, sweepVals, tol_f0=0.005, tol_gamma=0.02, points_per_round=8, max_points=200, min_step=0.001, max_dips=4, do_decimated=False, cache=None, snapshots=None):
+    lorentzian = lorentz_fits().lorentzian
+    freqs = np.array(sweepVals, dtype=float)
+    [xi, xq, _] = oneTone_oneSoftSweep(soc, soccfg, config, "res_freq", freqs, progress=False, do_decimated=False, cache=cache)
+    ## Baseline and noise come from the evenly spaced coarse grid, before the refinement piles points into the dips
+    coarse = np.sqrt(xi**2 + xq**2)[np.argsort(freqs)]
+    baseline = np.median(coarse)
+    noise = magnitude_noise(coarse)
+    fits = []
+    fit_history = []
+    nround = 0
+    while True:
+        nround += 1
+        order = np.argsort(freqs)
+        f = freqs[order]
+        amps = np.sqrt(xi**2 + xq**2)[order]
+
+        ## Fit every dip in its own window, and check whether each fit has stopped moving and matches the data
+        dips = find_dips(f, amps, baseline, noise, max_dips=max_dips)
+        new_fits = []
+        converged = len(dips) > 0
+        for k, [f0, lo, hi] in enumerate(dips):
+            window = (f >= lo) & (f <= hi)
+            previous = [fit for fit in fits if fit is not None and lo <= fit["f_f0"] <= hi]
+            previous = min(previous, key=lambda fit: abs(fit["f_f0"] - f0)) if len(previous) > 0 else None
+            fit = fit_resonance(f[window], xi[order][window], xq[order][window], previous=previous, f0=f0)
+            if fit is None or not (lo <= fit["f_f0"] <= hi):
+                fit = fit_resonance(f[window], xi[order][window], xq[order][window], f0=f0) if previous is not None else None
+            if fit is None or not (lo <= fit["f_f0"] <= hi):
+                new_fits.append(None)
+                converged = False
+                continue
+            fit["lo"] = lo
+            fit["hi"] = hi
+            fit["rms"] = np.sqrt(np.mean((lorentzian(f[window], fit["f_f0"], fit["f_amp"], fit["f_gamma"], fit["f_offset"]) - amps[window])**2))
+            depth = np.abs(2*fit["f_amp"]/(np.pi*fit["f_gamma"]))
+            good = fit["rms"] <= 3*noise + 0.05*depth
+            stable = previous is not None and (abs(fit["f_f0"] - previous["f_f0"]) < tol_f0) and (abs(fit["f_gamma"] - previous["f_gamma"]) < tol_gamma*previous["f_gamma"])
+            ## A fit to noise can sit still too, so the fit itself has to be good to tol_f0
+            converged = converged and good and stable and (fit["f_err"][0] < tol_f0)
+            fit_history.append([nround, len(f), k, fit["f_f0"], fit["f_gamma"], fit["rms"]])
+            print("Round", nround, ":", len(f), "points, dip", k, "f0 =", round(fit["f_f0"], 4), "MHz, gamma =", round(fit["f_gamma"], 4), "MHz", "" if good else "(poor fit)")
+            new_fits.append(fit)
+        fits = new_fits
+        if converged:
+            print("Fits converged after", len(f), "points")
+            break
+        if len(f) >= max_points:
+            print("Warning: reached max_points =", max_points, "before the fits converged")
+            break
+
+        ## Score each interval by how much the data, and the fit of its dip, change across it
+        mids = 0.5*(f[1:] + f[:-1])
+        score = np.abs(np.diff(amps))
+        for fit in fits:
+            if fit is None:
+                continue
+            model = lambda x : lorentzian(x, fit["f_f0"], fit["f_amp"], fit["f_gamma"], fit["f_offset"])
+            inside = (mids >= fit["lo"]) & (mids <= fit["hi"])
+            change = np.abs(model(mids) - model(f[:-1])) + np.abs(model(f[1:]) - model(mids))
+            score[inside] = np.maximum(score[inside], change[inside])
+        score[np.diff(f) < 2*min_step] = -1
+        nnew = min(points_per_round, max_points - len(f), np.count_nonzero(score >= 0))
+        if nnew == 0:
+            print("Warning: no intervals left wider than min_step before the fits converged")
+            break
+
+        ## Measure the midpoints of the best intervals
+        new_freqs = mids[np.argsort(score)[::-1][:nnew]]
+        [new_xi, new_xq, _] = oneTone_oneSoftSweep(soc, soccfg, config, "res_freq", new_freqs, progress=False, do_decimated=False, cache=cache)
+        freqs = np.concatenate([freqs, new_freqs])
+        xi = np.concatenate([xi, new_xi])
+        xq = np.concatenate([xq, new_xq])
+
+    #Get the decimated output for the last point, if it was asked for
+    if snapshots is None:
+        snapshots = decimatedSnapshots(at_end=do_decimated)
+    snapshots.finish(soc, soccfg, config, len(freqs)-1)
+    order = np.argsort(freqs)
+    return [freqs[order], xi[order], xq[order], order, [fit for fit in fits if fit is not None], np.array(fit_history), snapshots.last()]
+
+
+## Variables that oneToneHardSweep can step in tProc registers, and the register they live in
+hard_sweep_regs = {"res_freq" : "freq", "res_gain" : "gain"}
+
+## Returns True if this sweep can run as a single firmware loop on this board
+def can_hard_sweep(soccfg, config, sweepVarName, sweepVals):
+    if sweepVarName not in hard_sweep_regs:
+        print("Warning:", sweepVarName, "can't be swept in firmware. Options are", list(hard_sweep_regs.keys()))
+        return False
+    if len(sweepVals) < 2 or not np.allclose(np.diff(sweepVals), sweepVals[1]-sweepVals[0]):
+        print("Warning: firmware sweeps need evenly spaced sweep values")
+        return False
+    if hard_sweep_regs[sweepVarName] == "freq" and "tproc_ctrl" not in soccfg['readouts'][config["ro_ch"]]:
+        print("Warning: readout", config["ro_ch"], "is configured by PYNQ, so its frequency can't follow a firmware sweep")
+        return False
+    return True
+
+## Arguments:
+## sweepVarName    = "res_freq" or "res_gain"
+## sweepVals       = evenly spaced array of values to sweep over
+## Sweeps a variable in the tProc with one program and one acquire.  Returns the same output as oneTone_oneSoftSweep,
+## plus the values the firmware actually played (frequencies get rounded to register steps)
+## timer = optional pointTimer; the one build and acquire are shared out evenly over the points
+def oneTone_oneHardSweep(soc, soccfg, config, sweepVarName, sweepVals, progress=True, do_decimated=False, snapshots=None, timer=None):
+    if timer is None:
+        timer = pointTimer()
+    npts = len(sweepVals)
+    config["hard_sweep_reg"] = hard_sweep_regs[sweepVarName]
+    config["start"] = sweepVals[0]
+    config["step"]  = sweepVals[1] - sweepVals[0]
+    config["expts"] = npts
+    t_start = time.perf_counter()
+    prog = oneToneHardSweep(soccfg, config)
+    t_built = time.perf_counter()
+    expt_pts, avgi, avgq = acquire_prog(prog, soc, progress=progress)
+    t_acquired = time.perf_counter()
+    xi = np.array(avgi[0][0])
+    xq = np.array(avgq[0][0])
+    for i in range(npts):
+        timer.book(i, "build", (t_built - t_start)/npts)
+        timer.book(i, "acquire", (t_acquired - t_built)/npts)
+        timer.book(i, "transfer", (time.perf_counter() - t_acquired)/npts)
+        timer.stamp(i)
+
+    ## Hardware sweep keys shouldn't leak into the next program
+    for key in ["hard_sweep_reg", "start", "step", "expts"]:
+        del config[key]
+
+    #Get the decimated output for the last point, if it was asked for
+    if snapshots is None:
+        snapshots = decimatedSnapshots(at_end=do_decimated)
+    snapshots.finish(soc, soccfg, {**config, sweepVarName : sweepVals[-1]}, len(sweepVals)-1)
+    fullOutput = [xi, xq, snapshots.last(), np.array(expt_pts)]
     return fullOutput
 
-    
+
 ## Sweeps any two variables in software
-def oneTone_twoSoftSweep(soc, soccfg, config, x_sweepVarName, x_sweepVals, y_sweepVarName, y_sweepVals, x_forceInt=False, y_forceInt=False, do_decimated=True):    
+## Set prefetch > 0 to build programs ahead in a worker thread while the board acquires (see pipelined_acquire)
+## row_callback(i, xi_row, xq_row, t_row) is called after each x value is finished, with per-point unix timestamps
+## point_callback(i, j, I, Q, t) is called after every point (x index i, y index j)
+## With keep_data=False only one row is held in memory and xi/xq come back as None (use row_callback to save them)
+## snapshots = optional decimatedSnapshots saying when to take decimated traces, counted in outer rows (overrides do_decimated)
+## timer     = optional pointTimer(npts_x*npts_y); points are numbered x-major (i*npts_y + j), whatever order they were taken in
+## outer     = "x" or "y", the axis of the outer loop.  With "y" outermost no x row is finished until the end, so
+##             every row goes to row_callback then, and keep_data=False still holds the whole map
+## serpentine     = run the inner axis back and forth instead of jumping back to its first value every row
+## x/y_settle     = seconds to wait after changing that axis, before measuring (not with prefetch)
+## The output is always in canonical (y, x) order, however the points were taken
+def oneTone_twoSoftSweep(soc, soccfg, config, x_sweepVarName, x_sweepVals, y_sweepVarName, y_sweepVals, x_forceInt=False, y_forceInt=False, do_decimated=False, cache=None, prefetch=0, row_callback=None, keep_data=True, snapshots=None, timer=None, outer="x", serpentine=False, x_settle=0, y_settle=0, point_callback=None):    
+    if snapshots is None:
+        snapshots = decimatedSnapshots(at_end=do_decimated)
+    if timer is None:
+        timer = pointTimer()
     npts_x = len(x_sweepVals)
     npts_y = len(y_sweepVals)
+    if prefetch > 0 and (x_settle > 0 or y_settle > 0):
+        print("Warning: settle times need every program to run right after its values are set, turning off prefetch")
+        prefetch = 0
+    prefetch = prefetch_with_cache(prefetch, cache, config, [x_sweepVarName, y_sweepVarName])
+
+    ## Order the points are taken in, as (x index, y index)
+    if outer == "x":
+        points = list(sweep_indices([npts_x, npts_y], serpentine))
+    else:
+        points = [(i, j) for (j, i) in sweep_indices([npts_y, npts_x], serpentine)]
+    npts_outer = npts_x if outer == "x" else npts_y
+    row_last = {i : k for k, (i, j) in enumerate(points)}    ## when each x row gets finished
     
-    ## Make an output container
-    xi   = np.zeros((npts_x, npts_y))
-    xq   = np.zeros((npts_x, npts_y))
-
-    ## Iterate through first variable
-    for i, val in enumerate(x_sweepVals):
-        ## Print status text
-        print("Sweep", (i+1), "of", npts_x, end="\r")
-        sys.stdout.flush()
-        
-        ## Convert to int if needed
-        if(x_forceInt):
-            val = int(val)
-            
-        ## Set the variable   
-        config[x_sweepVarName] = val  
-        
-        ## Iterate through second variable, repeating same process
-        for j, val2 in enumerate(y_sweepVals):                
-            ## Set value
-            if(y_forceInt):
-                val2 = int(val2)    
-            config[y_sweepVarName] = val2
-            
-            ## Remake the program, do the measurement
-            prog = oneTonePulse(soccfg, config)
-            [[I]], [[Q]] = prog.acquire(soc, load_pulses=True, progress=False)
-            xi[i][j] = I
-            xq[i][j] = Q
-        
-    #Get the decimated output for the last run, just for a sample
-    if(do_decimated):
-        config["reps"] = 1
-        config["soft_avgs"] = 2000
-        prog = oneTonePulse(soccfg, config)
-        output_decimated = prog.acquire_decimated(soc, load_pulses=True, progress=False)
+    ## Make an output container.  With y outermost, rows are only finished at the very end, so keep all of them
+    keep_all = keep_data or outer == "y"
+    if keep_all:
+        xi   = np.zeros((npts_x, npts_y))
+        xq   = np.zeros((npts_x, npts_y))
+        t    = np.zeros((npts_x, npts_y))
+    xi_row = np.zeros(npts_y)
+    xq_row = np.zeros(npts_y)
+    t_row  = np.zeros(npts_y)
+
+    ## Files one point, and hands every row it finishes to the caller
+    def finish_point(k, I, Q, t_point, point_config):
+        [i, j] = points[k]
+        if keep_all:
+            [xi[i, j], xq[i, j], t[i, j]] = [I, Q, t_point]
+        else:
+            [xi_row[j], xq_row[j], t_row[j]] = [I, Q, t_point]
+        if point_callback is not None:
+            point_callback(i, j, I, Q, t_point)
+        last = (k == len(points)-1)
+        if outer == "x" and row_last[i] == k:
+            finish_row(i)
+        if outer == "y" and last:
+            for i in range(npts_x):
+                finish_row(i)
+        axis = 0 if outer == "x" else 1
+        if last or points[k+1][axis] != points[k][axis]:
+            snapshots.step(soc, soccfg, point_config, points[k][axis])
+
+    ## Rows are saved as a whole, so their save time lands on the last point taken in the row
+    def finish_row(i):
+        if row_callback is not None:
+            timer.start()
+            if keep_all:
+                row_callback(i, xi[i], xq[i], t[i])
+            else:
+                row_callback(i, xi_row, xq_row, t_row)
+            timer.lap(row_last[i], "save")
+
+    ## Puts point k's values in the config, only touching (and settling) the axes that changed
+    current = [None, None]
+    def set_point(k):
+        [i, j] = points[k]
+        if (outer == "x" and i != current[0]) or (outer == "y" and j != current[1]):
+            print("Sweep", (i if outer == "x" else j)+1, "of", npts_outer, end="\r")
+            sys.stdout.flush()
+        for axis, (name, vals, forceInt, settle, index) in enumerate([(x_sweepVarName, x_sweepVals, x_forceInt, x_settle, i), (y_sweepVarName, y_sweepVals, y_forceInt, y_settle, j)]):
+            if current[axis] == index:
+                continue
+            current[axis] = index
+            config[name] = int(vals[index]) if forceInt else vals[index]
+            if settle > 0:
+                time.sleep(settle)
+        return config
+
+    ## Pipelined version of the loop below.  Timings are booked in the order points are taken, and renumbered at the end
+    if prefetch > 0:
+        for k, (I, Q, point_config) in enumerate(pipelined_acquire(soc, soccfg, oneTonePulse, (set_point(k) for k in range(len(points))), prefetch=prefetch, timer=timer)):
+            t_point = time.time()
+            timer.lap(k, "transfer")
+            timer.stamp(k, t_point)
+            finish_point(k, I, Q, t_point, point_config)
     else:
-        output_decimated = np.zeros((2,2))
+        for k in range(len(points)):
+            set_point(k)
+            timer.start()
+
+            ## Remake (or patch) the program, do the measurement
+            prog = make_prog(oneTonePulse, soccfg, config, cache, patch_keys=[x_sweepVarName, y_sweepVarName])
+            timer.lap(k, "build")
+            [[I]], [[Q]] = acquire_prog(prog, soc, load_pulses=True, progress=False)
+            timer.lap(k, "acquire")
+            t_point = time.time()
+            timer.lap(k, "transfer")
+            timer.stamp(k, t_point)
+            finish_point(k, I, Q, t_point, config)
+    timer.renumber([i*npts_y + j for (i, j) in points])
+        
+    #Get the decimated output for the last run, if it was asked for
+    snapshots.finish(soc, soccfg, config, npts_outer-1)
+    output_decimated = snapshots.last()
+    if not keep_data:
+        return [None, None, output_decimated]
     fullOutput = [np.transpose(xi), np.transpose(xq), output_decimated]
     return fullOutput
 
 
+## Runs a sweep through a board-side sweepExecutor (see qick_sweepServer.py), reassembles the streamed rows
+## sweep_axes = list of (sweepVarName, sweepVals, forceInt), outermost axis first
+## Returns [xi, xq, output_decimated] with shape (len(axis 0), ..., len(last axis))
+## row_callback(index, xi_row, xq_row, t_row) is called as each block arrives (t_row = board-side timestamps)
+## snapshots = optional decimatedSnapshots; its cadence and budget are run on the board (requests aren't forwarded)
+## timer     = optional pointTimer(total points), numbered in row order.  Timestamps and acquire times come from
+## the board's clock; each row's transfer is how much longer it took to arrive than to measure, on its last point
+## keep_data = False doesn't hold the map at all (rows only go to row_callback), and xi/xq come back as None
+def remote_sweep(executor, prog_name, config, sweep_axes, do_decimated=False, use_cache=True, row_callback=None, snapshots=None, timer=None, keep_data=True):
+    if snapshots is None:
+        snapshots = decimatedSnapshots(at_end=do_decimated)
+    if timer is None:
+        timer = pointTimer()
+    shape = [len(axis[1]) for axis in sweep_axes]
+    sweep_axes = [(name, np.asarray(vals).tolist(), forceInt) for [name, vals, forceInt] in sweep_axes]
+    [xi, xq] = [np.zeros(shape), np.zeros(shape)] if keep_data else [None, None]
+    nrows = int(np.prod(shape[:-1]))
+    nrow = 0
+    t_board = None
+    t_arrived = time.perf_counter()
+    blocks = executor.run_sweep(prog_name, config, sweep_axes, use_cache=use_cache, snapshot_every=snapshots.every, snapshot_at_end=snapshots.at_end, snapshot_avgs=snapshots.soft_avgs)
+    for n, block in enumerate(blocks):
+        if "output_decimated" in block:
+            snapshots.add(block["output_decimated"], block["snapshot_index"])
+            continue
+        index = tuple(block["index"])
+        if keep_data:
+            xi[index] = block["xi"]
+            xq[index] = block["xq"]
+
+        ## Board-side timings of this row
+        t_row = np.asarray(block["t"])
+        points = nrow*shape[-1] + np.arange(len(t_row))
+        acquire = np.diff(t_row, prepend=np.nan if t_board is None else t_board)
+        for k, i in enumerate(points):
+            timer.stamp(i, t_row[k])
+            timer.book(i, "acquire", acquire[k])
+        arrived = time.perf_counter()
+        if t_board is not None:
+            timer.book(points[-1], "transfer", max((arrived - t_arrived) - (t_row[-1] - t_board), 0))
+        [t_board, t_arrived] = [t_row[-1], arrived]
+
+        if row_callback is not None:
+            timer.start()
+            row_callback(index, block["xi"], block["xq"], block["t"])
+            timer.lap(points[-1], "save")
+        if nrows > 1:
+            print("Row", (n+1), "of", nrows, end="\r")
+        nrow += 1
+    return [xi, xq, snapshots.last()]
+
 
 #----------------------------------------------------------------------------------------------------------------------
 # QICK Programs (Averager, RAverager)
@@ -637,8 +1588,85 @@ class oneTonePulse(AveragerProgram):
              adcs=[self.cfg["ro_ch"]],
              adc_trig_offset=cfg["adc_trig_offset"],
              wait=True,
-             syncdelay=self.us2cycles(cfg["relax_delay"]))   
+             syncdelay=self.us2cycles(cfg["relax_delay"]))
+
+
+## Sweeps the resonator frequency or gain in the tProc, so a whole axis is one program + one acquire
+## Needs cfg["hard_sweep_reg"] ("freq" or "gain"), cfg["start"], cfg["step"], cfg["expts"]
+## Frequency sweeps need a tProc-configured readout so the downconversion follows the tone
+class oneToneHardSweep(RAveragerProgram):
+    def initialize(self):
+        cfg=self.cfg
+        res_ch = cfg["res_ch"]
+        ro_ch  = cfg["ro_ch"]
+        sweep_freq = (cfg["hard_sweep_reg"] == "freq")
+
+        ## Declare generators
+        self.declare_gen(ch=res_ch, nqz=1)
+
+        ## Grab the page + register that update() steps through
+        self.q_rp    = self.ch_page(res_ch)
+        self.r_sweep = self.sreg(res_ch, cfg["hard_sweep_reg"])
+
+        ## Convert start/step to register values
+        resphase = self.deg2reg(cfg["res_phase"], gen_ch=res_ch)
+        if sweep_freq:
+            ro_freq  = cfg["start"]
+            resgain  = cfg["res_gain"]
+            self.step_reg = self.freq2reg(cfg["step"], gen_ch=res_ch, ro_ch=ro_ch)
+        else:
+            ro_freq  = cfg["res_freq"]
+            resgain  = int(cfg["start"])
+            self.step_reg = int(cfg["step"])
+        resfreq = self.freq2reg(ro_freq, gen_ch=res_ch, ro_ch=ro_ch)
+
+        ## Declare readout
+        ## A tProc-configured readout keeps its frequency in a register, which a freq sweep steps alongside the generator
+        self.tproc_ro = ("tproc_ctrl" in self.soccfg['readouts'][ro_ch])
+        if self.tproc_ro:
+            self.declare_readout(ch=ro_ch, length=cfg["readout_length"])
+            self.set_readout_registers(ch=ro_ch, freq=self.freq2reg_adc(ro_freq, ro_ch=ro_ch, gen_ch=res_ch), length=3)
+            if sweep_freq:
+                self.ro_rp       = self.ch_page_ro(ro_ch)
+                self.r_ro_freq   = self.sreg_ro(ro_ch, "freq")
+                self.ro_step_reg = self.freq2reg_adc(cfg["step"], ro_ch=ro_ch, gen_ch=res_ch)
+        else:
+            self.declare_readout(ch=ro_ch, length=cfg["readout_length"],
+                                    freq=ro_freq, gen_ch=res_ch)
+
+        style=self.cfg["res_pulse_style"]
+        if style == "const":
+            self.set_pulse_registers(ch=res_ch, style="const", freq=resfreq, phase=resphase, gain=resgain,
+                                length=cfg["res_length"])
+        elif style == "gauss":
+                self.add_gauss(ch=res_ch, name="measure", sigma=(cfg['res_length'])/5, length=cfg['res_length'])
+                self.set_pulse_registers(ch=res_ch, style="arb", freq=resfreq, phase=resphase, gain=resgain, waveform="measure")
+
+        self.synci(200)  # give processor some time to configure pulses
+
+    def body(self):
+        cfg=self.cfg
+        if self.tproc_ro:
+            self.readout(ch=cfg["ro_ch"], t=0)
+        self.measure(pulse_ch=cfg["res_ch"],
+             adcs=[self.cfg["ro_ch"]],
+             adc_trig_offset=cfg["adc_trig_offset"],
+             wait=True,
+             syncdelay=self.us2cycles(cfg["relax_delay"]))
+
+    def update(self):
+        self.mathi(self.q_rp, self.r_sweep, self.r_sweep, '+', self.step_reg)
+        if self.cfg["hard_sweep_reg"] == "freq":
+            self.mathi(self.ro_rp, self.r_ro_freq, self.r_ro_freq, '+', self.ro_step_reg)
 
+    ## Returns the values the firmware actually plays (rounded to register steps)
+    def get_expt_pts(self):
+        cfg = self.cfg
+        steps = np.arange(cfg["expts"])
+        if cfg["hard_sweep_reg"] == "freq":
+            start_reg = self.freq2reg(cfg["start"], gen_ch=cfg["res_ch"], ro_ch=cfg["ro_ch"])
+            return self.reg2freq(start_reg + steps*self.step_reg, gen_ch=cfg["res_ch"])
+        return int(cfg["start"]) + steps*self.step_reg
 
 
 
@@ -1,5 +1,6 @@
 import numpy as np
 from qick import *
+from qick.averager_program import QickSweep
 from qick_data import *
 from qick_helpers import *
 
@@ -103,4 +104,170 @@ class twoTonePulse(AveragerProgram):
              adcs=[self.cfg["ro_ch"]],
              adc_trig_offset=self.cfg["adc_trig_offset"],
              wait=True,
-             syncdelay=self.cfg["relax_delay"])
\ No newline at end of file
+             syncdelay=self.cfg["relax_delay"])
+
+
+
+## Variables the two tone firmware sweeps can step, and the clock they're counted in (None = tProc clock)
+## delay     = wait between the end of the qubit pulse and the readout [tProc clock ticks]  (T1)
+## qu_gain   = qubit pulse gain [DAC units]                                                (Rabi)
+## qu_length = qubit pulse length [qubit generator clock ticks], const pulses only        (Rabi)
+two_tone_hard_sweeps = {"delay" : None, "qu_gain" : "qu_ch", "qu_length" : "qu_ch"}
+
+## A qubit length sweep plays the longest pulse's registers, with only the length bits of mode stepped,
+## so every point keeps its readout a fixed time after the start of the qubit pulse: max length + delay
+def two_tone_max_length(cfg, sweeps):
+    for [name, start, step, expts] in sweeps:
+        if name == "qu_length":
+            if cfg["qu_style"] != "const":
+                raise RuntimeError("qubit length sweeps need qu_style='const', got %s" % cfg["qu_style"])
+            return max(int(start), int(start) + int(step)*(expts-1))
+    return cfg["qu_length"]
+
+## Sets the qubit and resonator pulse registers like twoTonePulse, but with the qubit gain and length given
+def set_two_tone_registers(prog, qugain, qulength):
+    cfg = prog.cfg
+    resfreq  = prog.freq2reg(cfg["res_freq"], gen_ch=cfg["res_ch"], ro_ch=cfg["ro_ch"])
+    qufreq   = prog.freq2reg(cfg["qu_freq"], gen_ch=cfg["qu_ch"], ro_ch=cfg["ro_ch"])
+    resphase = prog.deg2reg(cfg["res_phase"], gen_ch=cfg["res_ch"])
+    quphase  = prog.deg2reg(cfg["qu_phase"], gen_ch=cfg["qu_ch"])
+
+    if cfg["qu_style"] == "const":
+        prog.set_pulse_registers(ch=cfg["qu_ch"], style="const", freq=qufreq, phase=quphase, gain=qugain, length=qulength)
+    elif cfg["qu_style"] == "gauss":
+        prog.add_gauss(ch=cfg["qu_ch"], name="probe", sigma=cfg["qu_sigma"], length=qulength)
+        prog.set_pulse_registers(ch=cfg["qu_ch"], style="arb", freq=qufreq, phase=quphase, gain=qugain, waveform="probe")
+    else:
+        raise RuntimeError("qubit pulse style %s not yet supported" % cfg["qu_style"])
+
+    if cfg["res_style"] == "const":
+        prog.set_pulse_registers(ch=cfg["res_ch"], style="const", freq=resfreq, phase=resphase, gain=cfg["res_gain"], length=cfg["res_length"])
+    elif cfg["res_style"] == "gauss":
+        prog.add_gauss(ch=cfg["res_ch"], name="measure", sigma=cfg["res_sigma"], length=cfg["res_length"])
+        prog.set_pulse_registers(ch=cfg["res_ch"], style="arb", freq=resfreq, phase=resphase, gain=cfg["res_gain"], waveform="measure")
+
+
+## twoTonePulse with the delay, qubit gain or qubit length stepped in the tProc, so a whole T1 or Rabi curve
+## is one program + one acquire
+## Needs cfg["hard_sweep_reg"] (a key of two_tone_hard_sweeps), cfg["start"], cfg["step"], cfg["expts"], in register units
+class twoToneRAverager(RAveragerProgram):
+    def initialize(self):
+        cfg = self.cfg
+        qu_ch = cfg["qu_ch"]
+        sweep = cfg["hard_sweep_reg"]
+        self.step_reg = int(cfg["step"])
+
+        ## set up DACs and ADCs
+        self.declare_gen(ch=cfg["res_ch"], nqz=1)
+        self.declare_gen(ch=qu_ch, nqz=1)
+        self.declare_readout(ch=cfg["ro_ch"], length=cfg["readout_length"], freq=cfg["res_freq"], gen_ch=cfg["res_ch"])
+
+        qugain   = int(cfg["start"]) if sweep == "qu_gain" else cfg["qu_gain"]
+        qulength = two_tone_max_length(cfg, [[sweep, cfg["start"], cfg["step"], cfg["expts"]]])
+        set_two_tone_registers(self, qugain, qulength)
+
+        ## Register that update() steps through, on the qubit channel's page
+        ## delay: a user register the body syncs on.  qu_length: an offset added to the shortest pulse's mode
+        self.q_rp = self.ch_page(qu_ch)
+        if sweep == "qu_gain":
+            self.r_sweep = self.sreg(qu_ch, "gain")
+        elif sweep == "delay":
+            self.r_sweep = 1
+            self.regwi(self.q_rp, self.r_sweep, int(cfg["start"]), "delay")
+        elif sweep == "qu_length":
+            self.r_sweep = 1
+            self.r_mode  = self.sreg(qu_ch, "mode")
+            self.r_mode0 = 2
+            self.mathi(self.q_rp, self.r_mode0, self.r_mode, "-", qulength - int(cfg["start"]), "mode of the first length")
+            self.regwi(self.q_rp, self.r_sweep, 0, "length offset")
+        else:
+            raise RuntimeError("%s can't be swept in firmware. Options are %s" % (sweep, list(two_tone_hard_sweeps.keys())))
+
+        self.synci(200)  ## give processor some time to configure pulses
+
+    def body(self):
+        cfg = self.cfg
+        sweep = cfg["hard_sweep_reg"]
+        if sweep == "qu_length":
+            self.math(self.q_rp, self.r_mode, self.r_mode0, "+", self.r_sweep)
+        self.pulse(ch=cfg["qu_ch"])
+        if sweep == "delay":
+            self.sync_all()
+            self.sync(self.q_rp, self.r_sweep)
+        else:
+            self.sync_all(cfg["delay"])
+
+        self.measure(pulse_ch=[cfg["res_ch"]],
+             adcs=[cfg["ro_ch"]],
+             adc_trig_offset=cfg["adc_trig_offset"],
+             wait=True,
+             syncdelay=cfg["relax_delay"])
+
+    def update(self):
+        self.mathi(self.q_rp, self.r_sweep, self.r_sweep, '+', self.step_reg)
+
+    ## Returns the values the firmware actually plays, in register units
+    def get_expt_pts(self):
+        return int(self.cfg["start"]) + np.arange(self.cfg["expts"])*self.step_reg
+
+
+## Same as twoToneRAverager, but steps several of delay / qu_gain / qu_length at once, e.g. a Rabi gain x length map
+## Needs cfg["hard_sweeps"] = [[name, start, step, expts], ...] in register units, innermost (x) axis first
+## acquire returns avgi[ro][0] with shape (..., y, x), and get_expt_pts gives the played values per axis in the same order
+class twoToneNDAverager(NDAveragerProgram):
+    def initialize(self):
+        cfg = self.cfg
+        qu_ch = cfg["qu_ch"]
+        sweeps = cfg["hard_sweeps"]
+        names = [sweep[0] for sweep in sweeps]
+        for name in names:
+            if name not in two_tone_hard_sweeps:
+                raise RuntimeError("%s can't be swept in firmware. Options are %s" % (name, list(two_tone_hard_sweeps.keys())))
+
+        ## set up DACs and ADCs
+        self.declare_gen(ch=cfg["res_ch"], nqz=1)
+        self.declare_gen(ch=qu_ch, nqz=1)
+        self.declare_readout(ch=cfg["ro_ch"], length=cfg["readout_length"], freq=cfg["res_freq"], gen_ch=cfg["res_ch"])
+
+        qulength = two_tone_max_length(cfg, sweeps)
+        set_two_tone_registers(self, cfg["qu_gain"], qulength)
+
+        ## One register per axis, all on the qubit channel's page (see twoToneRAverager)
+        self.regs = {}
+        for [name, start, step, expts] in sweeps:
+            start = int(start)
+            stop  = start + int(step)*(expts-1)
+            if name == "qu_gain":
+                reg = self.get_gen_reg(qu_ch, "gain")
+            elif name == "delay":
+                reg = self.new_gen_reg(qu_ch, name="delay", tproc_reg=True)
+            elif name == "qu_length":
+                reg = self.new_gen_reg(qu_ch, name="length_offset", tproc_reg=True)
+                mode0 = self.new_gen_reg(qu_ch, name="mode0", tproc_reg=True)
+                mode0.set_to(self.get_gen_reg(qu_ch, "mode"), "-", qulength - start)
+                [start, stop] = [0, stop - start]
+            self.regs[name] = reg
+            self.add_sweep(QickSweep(self, reg, start, stop, expts))
+
+        self.synci(200)  ## give processor some time to configure pulses
+
+    def body(self):
+        cfg = self.cfg
+        if "qu_length" in self.regs:
+            self.get_gen_reg(cfg["qu_ch"], "mode").set_to(self.user_reg_dict["mode0"], "+", self.regs["qu_length"])
+        self.pulse(ch=cfg["qu_ch"])
+        if "delay" in self.regs:
+            self.sync_all()
+            self.sync(self.regs["delay"].page, self.regs["delay"].addr)
+        else:
+            self.sync_all(cfg["delay"])
+
+        self.measure(pulse_ch=[cfg["res_ch"]],
+             adcs=[cfg["ro_ch"]],
+             adc_trig_offset=cfg["adc_trig_offset"],
+             wait=True,
+             syncdelay=cfg["relax_delay"])
+
+    ## Returns the values the firmware actually plays per axis, in register units (innermost axis first)
+    def get_expt_pts(self):
+        return [int(start) + np.arange(expts)*int(step) for [name, start, step, expts] in self.cfg["hard_sweeps"]]
@@ -0,0 +1,394 @@
+import numpy as np
+import os, json, time
+import h5py
+from qick_data import *
+from qick_catalog import series_time, to_unix_time, json_value, same_qubit
+from qick_bulkload import select_files
+
+#----------------------------------------------------------------------
+#
+# qick_scanstore.py
+# Oct 2024
+#
+# One h5 file for a run of repeated, identical scans (overnight TL/CB
+# frequency scans, VNA traces taken in a loop), instead of a file per
+# scan that repeats the frequency axis and every setting.
+#
+#    store = scanStore(os.path.join(datapath, "overnight_scans.h5"))
+#    store.append_meas("TL", measTL)           ## after each scan, a oneToneSweep / QICKdata
+#    store.append_dict("trace1", data)          ## or a VNA data dict, as passed to VNA_funcs.write_file
+#
+#    TL = store.read("TL", start="20240513_220000", stop="20240514_060000")
+#    plt.pcolormesh(TL["meas_data"]["x_sweepVals"], TL["t_hours"], np.abs(TL["meas_data"]["xi"] + 1j*TL["meas_data"]["xq"]))
+#
+#    convert_to_store(os.path.join(datapath, "*TL.h5"), os.path.join(datapath, "overnight_scans.h5"))
+#
+# File layout (the same as a qick_monitor file, which read() also reads):
+#     meta/                         meas_type="scan_store"
+#     <channel>/meta, hw_cfg, ...   settings of the first scan
+#     <channel>/meas_data/          axes (x_sweepVals, freqs...) stored once, and per scan:
+#         xi, xq / amps, phases...  (time, points...), chunked along time and compressed
+#         timestamps                (time,) unix time of each scan
+#         point_timestamps, t_build...  (time, points) per-point timings of instrumented sweeps
+#     <channel>/changes/<group>/<key>/
+#         rows, values              the scan each setting changed at, and its new value (json)
+#
+# Scans have to come in time order, so a time range is a binary search
+# on the timestamps and then one slice of each dataset.  The file is
+# only open while appending (unless it's used in a with block), so it
+# can be read between scans.
+#
+#----------------------------------------------------------------------
+
+## meas_data entries that are data of each scan (every other array is an axis, stored once), including the
+## per-point timings of instrumented sweeps (pointTimer)
+scan_keys = iq_keys + ["Ivals", "Qvals", "amps", "phases", "t_build", "t_acquire", "t_transfer", "t_save"]
+
+## A sweep's per-point "timestamps" is stored under this name, since "timestamps" is the store's time of each scan
+point_time_key = "point_timestamps"
+
+## Settings that change on every scan anyway (the timestamps cover them)
+untracked_settings = ["meta/series"]
+
+## Appends scans to a consolidated file, and reads time ranges back
+class scanStore:
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.f        = None
+        self.current  = {}       ## {channel: {"group/key": value in effect}}, filled as channels are first appended to
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    ## Keeps the file open for many appends/reads (e.g. a conversion), instead of opening it for each
+    def open(self):
+        if self.f is None:
+            datapath = os.path.dirname(os.path.abspath(self.filepath))
+            if not os.path.exists(datapath):
+                print("Datapath doesn't exist yet. Making new datapath")
+                os.makedirs(datapath)
+            self.f = h5py.File(self.filepath, "a")
+            if "meta" not in self.f:
+                write_dict_to_group(self.f.create_group("meta"), {"meas_type" : "scan_store"})
+        return self.f
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        return
+
+    ## Runs func(f) on the open file, opening and closing it around the call if it isn't open already
+    def _with_file(self, func):
+        if self.f is not None:
+            return func(self.f)
+        self.open()
+        try:
+            return func(self.f)
+        finally:
+            self.close()
+
+    def channels(self):
+        if not os.path.exists(self.filepath) and self.f is None:
+            return []
+        return self._with_file(lambda f: [name for name in f if name != "meta"])
+
+    ## Number of scans in a channel, and the time of the last one (None if it has none)
+    def last_scan(self, channel):
+        def last(f):
+            if channel not in f:
+                return 0, None
+            t = f[channel]["meas_data"]["timestamps"]
+            return t.shape[0], (float(t[-1]) if t.shape[0] > 0 else None)
+        return self._with_file(last)
+
+    ## Appends one scan from a measurement (QICKdata or subclass) after it's been taken
+    ## timestamp = unix time of the scan (default: from the measurement's series)
+    def append_meas(self, channel, meas, timestamp=None):
+        settings = {}
+        for group, values in [("meta", meas.meta), ("hw_cfg", meas.hw_cfg), ("meas_cfg", meas.meas_cfg), ("rfb_cfg", meas.rfb_cfg)]:
+            settings.update({group+"/"+key : value for key, value in values.items() if value is not None})
+        [data, axes] = split_scan(meas.meas_data, settings, "meas_data")
+        if timestamp is None:
+            timestamp = series_time(meas.meta.get("series"))
+        return self.append(channel, data, axes, settings, timestamp)
+
+    ## Appends one scan from a flat dict like the VNA notebook's (amps, phases, freqs, series, vna_power...)
+    ## Arrays in scan_keys are the scan, other arrays are axes, everything else is a setting (in the "settings" group)
+    def append_dict(self, channel, scan, timestamp=None):
+        settings = {}
+        [data, axes] = split_scan(scan, settings, "settings")
+        if timestamp is None:
+            timestamp = series_time(scan.get("series"))
+        settings.pop("settings/series", None)
+        return self.append(channel, data, axes, settings, timestamp)
+
+    ## Appends one scan: data = {name: array} (one row each), axes = {name: array} (written with the first scan, and
+    ## have to match after that), settings = {"group/key": value} (written with the first scan, then only changes)
+    ## Returns True if the scan was stored
+    def append(self, channel, data, axes, settings, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        return self._with_file(lambda f: self._append(f, channel, data, axes, settings, timestamp))
+
+    def _append(self, f, channel, data, axes, settings, timestamp):
+        ## Everything is checked before anything is written, so a bad scan can't leave a half-built channel behind
+        names = list(data) + list(axes) + [key.split("/", 1)[1] for key in settings if key.startswith("meas_data/")]
+        clashes = sorted(set(key for key in names if key == "timestamps" or names.count(key) > 1))
+        if len(clashes) > 0:
+            print("Error: scan entries", clashes, "clash with each other or the store's own datasets - not appending")
+            return False
+        if channel not in f:
+            try:
+                self.create_channel(f, channel, data, axes, settings)
+            except Exception as error:
+                print("Error: couldn't create channel", channel, "-", error)
+                if channel in f:
+                    del f[channel]
+                self.current.pop(channel, None)
+                return False
+        group = f[channel]
+        meas_data = group["meas_data"]
+        for key, value in axes.items():
+            if key not in meas_data or not np.array_equal(np.asarray(meas_data[key][()]).astype(np.asarray(value).dtype), np.asarray(value)):
+                print("Error: axis", key, "of this scan doesn't match channel", channel, "- not appending.  Use a new channel or store")
+                return False
+        times = meas_data["timestamps"]
+        n = times.shape[0]
+        if n > 0 and timestamp < times[-1]:
+            print("Error: scans have to be appended in time order, this one is older than the last one in", channel)
+            return False
+        for key, value in data.items():
+            if key in meas_data and meas_data[key].shape[1:] != np.shape(value):
+                print("Error: scan data", key, "has shape", np.shape(value), "but", channel, "stores", meas_data[key].shape[1:], "- not appending")
+                return False
+
+        ## One more row on every per-scan dataset (NaN for data this scan doesn't have)
+        for key, value in data.items():
+            if key not in meas_data:
+                self.create_scan_dataset(meas_data, key, np.asarray(value), n)
+        for key in self.scan_datasets(meas_data):
+            dset = meas_data[key]
+            dset.resize(n+1, axis=0)
+            if key == "timestamps":
+                dset[n] = timestamp
+            elif key in data:
+                dset[n] = data[key]
+            elif dset.dtype.kind in "fc":
+                dset[n] = np.nan
+
+        ## Log the settings that differ from the ones in effect
+        current = self.settings_state(f, channel)
+        for key, value in settings.items():
+            if key in untracked_settings or (key in current and same_setting(current[key], value)):
+                continue
+            log = group.require_group("changes/"+key)
+            if "rows" not in log:
+                log.create_dataset("rows", shape=(0,), maxshape=(None,), chunks=(256,), dtype=int)
+                log.create_dataset("values", shape=(0,), maxshape=(None,), chunks=(256,), dtype=h5py.string_dtype())
+            m = log["rows"].shape[0]
+            log["rows"].resize(m+1, axis=0)
+            log["values"].resize(m+1, axis=0)
+            log["rows"][m] = n
+            log["values"][m] = json.dumps(json_value(value.tolist() if isinstance(value, np.ndarray) else value))
+            current[key] = value
+        return True
+
+    ## Writes a new channel's first settings (like write_H5 would), its axes, and empty per-scan datasets
+    def create_channel(self, f, channel, data, axes, settings):
+        group = f.create_group(channel)
+        grouped = {}
+        for key, value in settings.items():
+            [name, item] = key.split("/", 1)
+            grouped.setdefault(name, {})[item] = value
+        for name, values in grouped.items():
+            write_dict_to_group(group.create_group(name), values)
+        meas_data = group.require_group("meas_data")
+        write_dict_to_group(meas_data, axes)
+        meas_data.create_dataset("timestamps", shape=(0,), maxshape=(None,), chunks=(4096,), dtype=float)
+        for key, value in data.items():
+            self.create_scan_dataset(meas_data, key, np.asarray(value), 0)
+        self.current[channel] = dict(settings)
+        return
+
+    ## An extendable (time, ...) dataset for one entry of the scans, chunked along time so time ranges read whole chunks,
+    ## and compressed like write_H5 does.  Scans before this one (if any) are NaN
+    def create_scan_dataset(self, meas_data, key, value, n):
+        dtype = value.dtype if value.dtype.kind in "biufc" else np.dtype(float)
+        shape = (n,) + value.shape
+        rows = max(1, chunk_bytes // max(value.size*dtype.itemsize, 1))
+        dset = meas_data.create_dataset(key, shape=shape, maxshape=(None,) + value.shape, dtype=dtype,
+                                        chunks=chunk_shape((rows,) + value.shape, dtype.itemsize), shuffle=True, compression="gzip", compression_opts=4,
+                                        fillvalue=np.nan if dtype.kind in "fc" else 0)
+        return dset
+
+    ## The per-scan datasets of a channel: the ones that grow with timestamps
+    def scan_datasets(self, meas_data):
+        return [key for key in meas_data if is_scan_dataset(meas_data[key])]
+
+    ## {"group/key": value} in effect after the last scan of a channel: its first settings, updated by its change log
+    def settings_state(self, f, channel):
+        if channel not in self.current:
+            state = {name+"/"+key : value for name, values in stored_settings(f[channel]).items() for key, value in values.items()}
+            for key, log in change_logs(f[channel]).items():
+                if log["values"].shape[0] > 0:
+                    state[key] = json.loads(log["values"][-1])
+            self.current[channel] = state
+        return self.current[channel]
+
+    ## Reads the scans of a channel between start and stop (datetimes, "YYYYMMDD_HHMMSS" or unix times; inclusive)
+    ## keys = per-scan datasets to read (default: all of them)
+    ## Returns {"meta", "hw_cfg", ... (first settings), "meas_data": axes and the scans' rows, "t_hours": hours since
+    ##          the first scan in the store, "rows": the slice read, "changes": {"group/key": {"timestamps", "values"}}}
+    def read(self, channel, start=None, stop=None, keys=None):
+        return self._with_file(lambda f: read_scans(f, channel, start, stop, keys))
+
+    ## The settings in effect for the scan at time t (nested like the measurement's dicts)
+    def settings_at(self, channel, t):
+        def settings(f):
+            times = f[channel]["meas_data"]["timestamps"][()]
+            row = max(int(np.searchsorted(times, to_unix_time(t), side="right")) - 1, 0)
+            state = stored_settings(f[channel])
+            for key, log in change_logs(f[channel]).items():
+                rows = log["rows"][()]
+                k = np.searchsorted(rows, row, side="right") - 1
+                if k >= 0:
+                    [name, item] = key.split("/", 1)
+                    state.setdefault(name, {})[item] = json.loads(log["values"][k])
+            return state
+        return self._with_file(settings)
+
+
+## Splits a meas_data-like dict into per-scan data and axes; scalars and strings go into settings under group/
+def split_scan(values, settings, group):
+    data = {}
+    axes = {}
+    for key, value in values.items():
+        if value is None:
+            continue
+        if key in scan_keys:
+            data[key] = value
+        elif key == "timestamps" and np.ndim(value) > 0:
+            data[point_time_key] = value
+        elif isinstance(value, str) or np.ndim(value) == 0:
+            settings[group+"/"+key] = value
+        else:
+            axes[key] = value
+    return [data, axes]
+
+## True if a stored setting and a new value are the same (file round trips turn ints into floats, and lists of
+## numeric strings like qubits=["1"] into float arrays)
+def same_setting(a, b):
+    if isinstance(a, (list, tuple, np.ndarray)) or isinstance(b, (list, tuple, np.ndarray)):
+        a = np.atleast_1d(a)
+        b = np.atleast_1d(b)
+        return len(a) == len(b) and all(same_qubit(x, y) for x, y in zip(a, b))
+    return same_qubit(a, b)
+
+## {group: {key: value}} of the settings a channel was created with (scalars and strings of meas_data included)
+def stored_settings(group):
+    settings = {}
+    for name in group:
+        if name == "changes":
+            continue
+        values = {key : read_item(group[name][key], key) for key in group[name]
+                  if isinstance(group[name][key], h5py.Dataset) and not is_scan_dataset(group[name][key])}
+        if name == "meas_data":
+            values = {key : value for key, value in values.items() if isinstance(value, str) or np.ndim(value) == 0}
+        settings[name] = values
+    return settings
+
+## True for the datasets that grow by a row per scan
+def is_scan_dataset(dset):
+    return isinstance(dset, h5py.Dataset) and dset.ndim > 0 and dset.maxshape[0] is None
+
+## {"group/key": h5 group with rows/values} for every logged setting of a channel
+def change_logs(group):
+    if "changes" not in group:
+        return {}
+    logs = {}
+    group["changes"].visititems(lambda name, obj: logs.update({name : obj}) if isinstance(obj, h5py.Group) and "rows" in obj else None)
+    return logs
+
+## read() on an open file; also reads the channels of a monitor file
+def read_scans(f, channel, start=None, stop=None, keys=None):
+    if channel not in f:
+        print("Error: no channel", channel, "in the store - options are", [name for name in f if name != "meta"])
+        return None
+    group = f[channel]
+    meas_data = group["meas_data"]
+    times = meas_data["timestamps"][()]
+    first = 0 if start is None else int(np.searchsorted(times, to_unix_time(start), side="left"))
+    last = len(times) if stop is None else int(np.searchsorted(times, to_unix_time(stop), side="right"))
+    rows = slice(first, max(first, last))
+
+    scan = {name : values for name, values in stored_settings(group).items() if name != "meas_data"}
+    scan["meas_data"] = {}
+    for key in meas_data:
+        dset = meas_data[key]
+        if not isinstance(dset, h5py.Dataset):
+            continue
+        if is_scan_dataset(dset):
+            if key == "timestamps" or keys is None or key in keys:
+                scan["meas_data"][key] = dset[rows]
+        else:
+            scan["meas_data"][key] = read_item(dset, key)
+    scan["t_hours"] = (scan["meas_data"]["timestamps"] - (times[0] if len(times) > 0 else 0))/3600
+    scan["rows"] = rows
+
+    ## Setting changes that took effect within the range
+    scan["changes"] = {}
+    for key, log in change_logs(group).items():
+        change_rows = log["rows"][()]
+        inside = (change_rows >= rows.start) & (change_rows < rows.stop)
+        scan["changes"][key] = {"timestamps" : times[change_rows[inside]],
+                                "values"     : [json.loads(value) for value in log["values"][()][inside]]}
+    return scan
+
+## Consolidates per-scan files (QICKdata .h5 or VNA .npz) into a store, oldest first, leaving the files as they are
+## files   = as for load_stack: filepaths, a glob pattern, dataCatalog.find results, or a dataCatalog with filters
+## channel = channel to put them in (default: each file's meas_type / label)
+## Files at or before the last scan already in their channel are skipped, so it can be rerun as more files come in
+## Returns (converted, skipped, failed)
+def convert_to_store(files, store_path, channel=None, **filters):
+    filepaths = select_files(files, **filters)
+    stamped = []
+    for filepath in filepaths:
+        t = series_time(os.path.basename(filepath)[:15])
+        stamped.append((t if t is not None else os.path.getmtime(filepath), filepath))
+    stamped.sort(key=lambda item: item[0])
+
+    [nconverted, nskipped, nfailed] = [0, 0, 0]
+    with scanStore(store_path) as store:
+        for t, filepath in stamped:
+            [datapath, filename] = os.path.split(filepath)
+            try:
+                if filepath.endswith(".npz"):
+                    with np.load(filepath, allow_pickle=True) as readin:
+                        scan = readin["data"].item()
+                    series = scan.get("series", "")
+                    name = os.path.splitext(filename)[0]
+                    scan_channel = channel or (name[len(series)+1:] if name.startswith(series+"_") else name)
+                    append = lambda: store.append_dict(scan_channel, scan, timestamp=t)
+                else:
+                    meas = read_H5(datapath, filename, QICKdata)
+                    scan_channel = channel or meas.meta.get("meas_type", "scans")
+                    append = lambda: store.append_meas(scan_channel, meas, timestamp=t)
+            except Exception as error:
+                print("Error: couldn't read", filename, "-", error)
+                nfailed += 1
+                continue
+            [nscans, t_last] = store.last_scan(scan_channel)
+            if t_last is not None and t <= t_last:
+                nskipped += 1
+                continue
+            if append():
+                nconverted += 1
+            else:
+                nfailed += 1
+    print("Converted", nconverted, "scans into", os.path.basename(store_path) + ",", nskipped, "skipped (not newer than the store's last scan),", nfailed, "failed")
+    return nconverted, nskipped, nfailed
@@ -0,0 +1,258 @@
+import numpy as np
+import time
+from qick import *
+from qick_helpers import *
+
+#----------------------------------------------------------------------
+#
+# qick_simulator.py
+# Oct 2024
+#
+# Simulated QICK board, so sweeps can be run, profiled and regression
+# tested without an RFSoC.
+#
+#    model  = resonatorModel([{"f0" : 7348.5, "gamma" : 0.08, "depth" : 0.8},
+#                             {"f0" : 7355.0, "gamma" : 0.10, "depth" : 0.6}], noise=2)
+#    soc    = simSoc(model, call_latency=0.005)
+#    soccfg = soc           ## or QickConfig(soc.get_cfg()), like make_proxy
+#    meas.do_soft_1D_measurement(soc, soccfg, ...)
+#
+# Programs are built and compiled for real against a ZCU216-like
+# config.  Acquisition is where the simulation takes over: simSoc looks
+# at the program's readout frequencies and config and returns the
+# resonator response plus noise.  Sweep code acquires through
+# acquire_prog/acquire_decimated_prog (qick_helpers.py), which hand
+# the program to the simulator.
+#
+#----------------------------------------------------------------------
+
+## Builds a ZCU216-style firmware config: n_gens full speed DACs and n_readouts ADC readouts
+## Set tproc_readouts=True to make the readouts tProc-configured (needed for firmware frequency sweeps)
+def make_sim_cfg(n_gens=7, n_readouts=2, tproc_readouts=False):
+    fs_dac = 9830.4
+    fs_adc = 2457.6
+    def gen(i):
+        return {"type" : "axis_signal_gen_v6", "dac" : "%d%d" % (2+i//4, i%4), "fs" : fs_dac, "f_fabric" : 614.4,
+                "samps_per_clk" : 16, "maxlen" : 65536, "complex_env" : True, "has_dds" : True, "has_mixer" : False,
+                "has_gain" : True, "has_phase" : True, "b_dds" : 32, "f_dds" : fs_dac, "b_phase" : 32, "b_gain" : 16,
+                "maxv" : 32766, "maxv_scale" : 1.0, "interpolation" : 1, "fs_mult" : 40, "fs_div" : 1,
+                "f_dds_mult" : 40, "f_dds_div" : 1, "fdds_div" : 1, "tproc_ch" : i+1, "switch_ch" : 0}
+    def readout(i):
+        ro = {"ro_type" : "axis_readout_v2", "adc" : "2%d" % i, "fs" : fs_adc, "f_output" : 307.2, "f_fabric" : 307.2,
+              "b_dds" : 32, "f_dds" : fs_adc, "b_phase" : 32, "avg_maxlen" : 16384, "buf_maxlen" : 16384,
+              "avgbuf_type" : "axis_avg_buffer", "avgbuf_version" : "1.0", "has_edge_counter" : False,
+              "has_weights" : False, "has_outsel" : True, "trigger_type" : "tproc", "trigger_port" : 0,
+              "trigger_bit" : i, "tproc_ch" : i, "decimation" : 8, "fs_mult" : 10, "fs_div" : 1,
+              "f_dds_mult" : 10, "f_dds_div" : 1, "fdds_div" : 1, "iq_offset" : 0, "ro_fullpath" : []}
+        if tproc_readouts:
+            ro["tproc_ctrl"] = n_gens+1+i
+        return ro
+    tiles = range(4)
+    return {"board" : "ZCU216", "sw_version" : get_version(), "fw_timestamp" : "simulated", "refclk_freq" : 245.76,
+            "rf" : {"clk_groups" : [], "dac_power" : 0,
+                    "dacs" : {"%d%d" % (t, b) : {"fs" : fs_dac, "f_fabric" : 614.4, "fs_mult" : 16, "fs_div" : 1} for t in tiles for b in tiles},
+                    "adcs" : {"%d%d" % (t, b) : {"fs" : fs_adc, "f_fabric" : 307.2, "coupling" : "AC", "fs_mult" : 8, "fs_div" : 1} for t in tiles for b in tiles}},
+            "gens" : [gen(i) for i in range(n_gens)],
+            "readouts" : [readout(i) for i in range(n_readouts)],
+            "tprocs" : [{"type" : "axis_tproc64x32_x8", "f_time" : 430.08, "pmem_size" : 65536, "dmem_size" : 4096,
+                         "output_pins" : [], "start_pin" : None}],
+            "iqs" : [], "time_taggers" : []}
+
+
+## Transmission of a feedline with Lorentzian dips, in adc units at full gain
+## resonators = list of {"f0": MHz, "gamma": FWHM in MHz, "depth": 0-1}; two entries make a double Lorentzian
+## amplitude  = off-resonance level at res_gain = 32766
+## noise      = I/Q noise of a single shot (gets divided by sqrt(reps*soft_avgs))
+## drift      = how fast every f0 moves [MHz/hour]
+## delay      = cable delay [us], winds the phase with frequency
+## qubit      = optional {"f0": MHz, "gamma": MHz, "chi": MHz}: a two tone drive near f0 shifts the resonators by up to chi
+##              (on average; single shots see either no shift or the full chi)
+##              Add "rabi_rate" [MHz at qu_gain=32766] for coherent Rabi oscillations in qu_gain/qu_length instead of a
+##              saturated line, and "T1" [us] for the excitation to decay over the delay before the readout
+## The qubit drive is passed around as qu_freq [MHz], qu_gain, qu_length [us] and delay [us]
+class resonatorModel:
+    def __init__(self, resonators, amplitude=1000, noise=0, drift=0, delay=0, qubit=None, seed=None):
+        self.resonators = [dict(res) for res in resonators]
+        self.amplitude  = amplitude
+        self.noise      = noise
+        self.drift      = drift
+        self.delay      = delay
+        self.qubit      = qubit
+        self.rng        = np.random.default_rng(seed)
+        self.t0         = time.time()
+
+    ## Probability that driving at qu_freq/qu_gain (for qu_length) leaves the qubit excited delay after the pulse
+    def excited_fraction(self, qu_freq=None, qu_gain=0, qu_length=None, delay=0):
+        if self.qubit is None or qu_freq is None:
+            return 0.0
+        detuning = qu_freq - self.qubit["f0"]
+        if "rabi_rate" in self.qubit and qu_length is not None:
+            rate = self.qubit["rabi_rate"]*qu_gain/32766
+            rate_eff = np.sqrt(rate**2 + detuning**2)
+            p = 0.0 if rate_eff == 0 else (rate/rate_eff)**2*np.sin(np.pi*rate_eff*qu_length)**2
+        else:
+            half = self.qubit["gamma"]/2
+            p = 0.5*(qu_gain/32766)**2*half**2/(half**2 + detuning**2)
+        if "T1" in self.qubit:
+            p = p*np.exp(-delay/self.qubit["T1"])
+        return p
+
+    ## Resonator frequency shift [MHz] from drift, and from driving the qubit
+    def shift(self, qu_freq=None, qu_gain=0, qu_length=None, delay=0):
+        df = self.drift*(time.time() - self.t0)/3600
+        if self.qubit is not None:
+            df = df + self.qubit["chi"]*self.excited_fraction(qu_freq, qu_gain, qu_length, delay)
+        return df
+
+    ## Noiseless complex response at freqs [MHz] for a drive gain
+    def s21(self, freqs, gain=32766, qu_freq=None, qu_gain=0, qu_length=None, delay=0):
+        freqs = np.asarray(freqs, dtype=float)
+        df = self.shift(qu_freq, qu_gain, qu_length, delay)
+        s = np.ones(freqs.shape, dtype=complex)
+        for res in self.resonators:
+            half = res["gamma"]/2
+            s = s - res["depth"]*half/(half + 1j*(freqs - res["f0"] - df))
+        return self.amplitude*(np.asarray(gain)/32766)*s*np.exp(-2j*np.pi*freqs*self.delay)
+
+    ## Response with shot noise averaged down over navg shots
+    def measure(self, freqs, gain=32766, navg=1, qu_freq=None, qu_gain=0, qu_length=None, delay=0):
+        s = self.s21(freqs, gain, qu_freq, qu_gain, qu_length, delay)
+        sigma = self.noise/np.sqrt(max(navg, 1))
+        return s + sigma*(self.rng.standard_normal(s.shape) + 1j*self.rng.standard_normal(s.shape))
+
+    ## nshots single shots at one frequency: each shot finds the qubit in ground or excited, then gets the full noise
+    def shots(self, freq, nshots, gain=32766, qu_freq=None, qu_gain=0, qu_length=None, delay=0):
+        df = self.drift*(time.time() - self.t0)/3600
+        ground = self._level(freq - df, gain)
+        excited = ground if self.qubit is None else self._level(freq - df - self.qubit["chi"], gain)
+        is_excited = self.rng.random(nshots) < self.excited_fraction(qu_freq, qu_gain, qu_length, delay)
+        s = np.where(is_excited, excited, ground)
+        return s + self.noise*(self.rng.standard_normal(nshots) + 1j*self.rng.standard_normal(nshots))
+
+    ## Noiseless response at freq with no drift or qubit shift
+    def _level(self, freq, gain):
+        s = 1.0
+        for res in self.resonators:
+            half = res["gamma"]/2
+            s = s - res["depth"]*half/(half + 1j*(freq - res["f0"]))
+        return self.amplitude*(gain/32766)*s*np.exp(-2j*np.pi*freq*self.delay)
+
+
+## Config key each firmware sweep register stands for, where the two differ (oneToneHardSweep)
+sim_sweep_keys = {"freq" : "res_freq", "gain" : "res_gain"}
+
+## Stand-in for a QickSoc (and its soccfg).  It's a QickConfig, so us2cycles, freq2reg, get_cfg etc. are the real ones
+## call_latency  = seconds added to every acquire (e.g. a Pyro round trip)
+## shot_time     = seconds added per shot (reps*soft_avgs*expts), to mimic the real acquisition time
+## load_time     = seconds added to every acquire with load_pulses=True (pulses, gens, readouts and program)
+## transfer_time = seconds added per value sent back (per point per readout, or per decimated sample)
+## The simulated time is added up per stage in stage_times (used by qick_benchmark.py)
+class simSoc(QickConfig):
+    is_simulated = True
+
+    def __init__(self, model, call_latency=0, shot_time=0, cfg=None, load_time=0, transfer_time=0):
+        super().__init__(make_sim_cfg() if cfg is None else cfg)
+        self.model         = model
+        self.call_latency  = call_latency
+        self.shot_time     = shot_time
+        self.load_time     = load_time
+        self.transfer_time = transfer_time
+        self.n_acquires    = 0
+        self.n_shots       = 0
+        self.stage_times   = {"remote" : 0.0, "load" : 0.0, "acquisition" : 0.0, "transfer" : 0.0}
+
+    ## Waits as long as the real board would, and counts the work
+    ## Programs get compiled here if they haven't been, like config_all does on a real board
+    def _run(self, prog, nshots, nvals, load_pulses=True):
+        if prog.binprog is None:
+            prog.compile()
+        self.n_acquires += 1
+        self.n_shots    += nshots
+        waits = {"remote"      : self.call_latency,
+                 "load"        : self.load_time if load_pulses else 0,
+                 "acquisition" : self.shot_time*nshots,
+                 "transfer"    : self.transfer_time*nvals}
+        for stage in waits:
+            self.stage_times[stage] += waits[stage]
+        time.sleep(sum(waits.values()))
+
+    ## Config of every point a program measures (its cfg with the swept values put in), and the shape acquire
+    ## returns them in: () for AveragerPrograms, (expts,) for RAveragerPrograms, (..., y, x) for twoToneNDAverager
+    def _points(self, prog):
+        cfg = prog.cfg
+        if isinstance(prog, NDAveragerProgram):
+            keys  = [sweep[0] for sweep in cfg["hard_sweeps"]][::-1]
+            grids = np.meshgrid(*prog.get_expt_pts()[::-1], indexing="ij")
+            vals  = zip(*[grid.ravel() for grid in grids])
+            return [{**cfg, **dict(zip(keys, val))} for val in vals], grids[0].shape
+        if isinstance(prog, RAveragerProgram):
+            key = sim_sweep_keys.get(cfg["hard_sweep_reg"], cfg["hard_sweep_reg"])
+            pts = prog.get_expt_pts()
+            return [{**cfg, key : val} for val in pts], (len(pts),)
+        return [cfg], ()
+
+    ## What each readout of a program is listening to at one point: [(ro_ch, freq, gain)]
+    def _probes(self, prog, point):
+        probes = []
+        for i, (ro_ch, ro) in enumerate(prog.ro_chs.items()):
+            freq = point["res_freq"] if point.get("hard_sweep_reg") == "freq" else ro.get("freq", point.get("res_freq"))
+            gain = point.get("res_gain", 32766)
+            if "res_gains" in point:
+                gain = gain*point["res_gains"][i]
+            probes.append((ro_ch, float(freq), float(gain)))
+        return probes
+
+    ## Qubit drive at one point, in the model's units (MHz and us)
+    def _drive(self, point):
+        drive = {"qu_freq" : point.get("qu_freq"), "qu_gain" : point.get("qu_gain", 0), "delay" : self.cycles2us(point.get("delay", 0))}
+        if point.get("qu_ch") is not None and "qu_length" in point:
+            drive["qu_length"] = self.cycles2us(point["qu_length"], gen_ch=point["qu_ch"])
+        return drive
+
+    ## Same return format as prog.acquire: [avgi, avgq] for AveragerPrograms, [expt_pts, avgi, avgq] for
+    ## RAveragerPrograms and NDAveragerPrograms
+    def acquire(self, prog, load_pulses=True, progress=False, **kwargs):
+        cfg = prog.cfg
+        navg = cfg.get("reps", 1)*cfg.get("soft_avgs", 1)
+        [points, shape] = self._points(prog)
+        npts = len(points)
+        self._run(prog, navg*npts, 2*npts*len(prog.ro_chs), load_pulses)
+        s = np.zeros((len(prog.ro_chs), npts), dtype=complex)
+        for j, point in enumerate(points):
+            drive = self._drive(point)
+            for k, (ro_ch, freq, gain) in enumerate(self._probes(prog, point)):
+                s[k, j] = self.model.measure(freq, gain, navg, **drive)
+        s = s.reshape((len(prog.ro_chs), 1) + shape)
+        if isinstance(prog, (RAveragerProgram, NDAveragerProgram)):
+            return prog.get_expt_pts(), s.real, s.imag
+        return s.real, s.imag
+
+    ## Same rounds as stream_shots_prog: one [(I, Q) per readout] of reps single shots per soft_avg
+    def stream_shots(self, prog, load_pulses=True):
+        cfg = prog.cfg
+        reps = cfg.get("reps", 1)
+        drive = self._drive(cfg)
+        for n in range(cfg.get("soft_avgs", 1)):
+            self._run(prog, reps, 2*reps*len(prog.ro_chs), load_pulses and n == 0)
+            shots = []
+            for ro_ch, freq, gain in self._probes(prog, cfg):
+                s = self.model.shots(freq, reps, gain, **drive)
+                shots.append((s.real, s.imag))
+            yield shots
+
+    ## One (2, readout_length) I/Q trace per readout, the format the sweep code stores as output_decimated
+    ## The pulse shows up after a fixed time of flight and lasts res_length
+    def acquire_decimated(self, prog, load_pulses=True, progress=False, tof=50, **kwargs):
+        cfg = prog.cfg
+        navg = cfg.get("soft_avgs", 1)
+        self._run(prog, navg, 2*sum(ro["length"] for ro in prog.ro_chs.values()), load_pulses)
+        point = self._points(prog)[0][-1]
+        output = []
+        for ro_ch, freq, gain in self._probes(prog, point):
+            length = prog.ro_chs[ro_ch]["length"]
+            n = np.arange(length) + cfg.get("adc_trig_offset", 0)
+            on = (n >= tof) & (n < tof + cfg.get("res_length", length))
+            level = self.model.s21(freq, gain, **self._drive(point))
+            trace = on*level + self.model.noise/np.sqrt(max(navg, 1))*(self.model.rng.standard_normal(length) + 1j*self.model.rng.standard_normal(length))
+            output.append(np.array([trace.real, trace.imag]))
+        return output
@@ -0,0 +1,169 @@
+import numpy as np
+import sys
+from qick import *
+from qick_helpers import *
+
+#----------------------------------------------------------------------
+#
+# qick_singleShot.py
+# Oct 2024
+#
+# Single-shot acquisition for oneTonePulse / twoTonePulse sweeps.
+# Shots are streamed off the board one round (soft_avg) at a time and
+# reduced on the fly, so a point can have 600000 shots without ever
+# holding them all:
+#     - a 2D IQ histogram per point
+#     - excited state population per point (if a threshold is given)
+#     - running mean / variance / IQ covariance per point
+#     - raw shots for a few chosen points, up to a fixed number each
+#
+#    reducer = shotReducer(len(freqs), threshold=12.5, angle=0.3, raw_points=[0, 300])
+#    singleShot_softSweep(soc, soccfg, oneTonePulse, config, "res_freq", freqs, reducer=reducer)
+#    reducer.store(meas.meas_data)
+#
+# Memory per round is reps shots, so keep reps moderate and make up the
+# total with soft_avgs.
+#
+#----------------------------------------------------------------------
+
+## Reduces the single shots of every point of a sweep as they come in
+## npts       = number of sweep points
+## n_ro       = number of readouts the program declares
+## bins       = histogram bins along I and along Q
+## iq_range   = ((Imin, Imax), (Qmin, Qmax)) of the histograms, the same for every point.  None gives each point
+##              its own square window, 6 sigma around its first round (the sweep usually moves the blob a long way)
+## threshold  = I threshold for the excited state, after rotating by angle [rad] (same convention as qick's acquire)
+## raw_points = sweep points whose raw shots are kept, raw_shots of them per point per readout
+class shotReducer:
+    def __init__(self, npts, n_ro=1, bins=64, iq_range=None, threshold=None, angle=0, raw_points=(), raw_shots=1000):
+        self.npts       = npts
+        self.n_ro       = n_ro
+        self.bins       = bins
+        self.iq_range   = iq_range
+        self.threshold  = threshold
+        self.angle      = angle
+        self.raw_points = list(raw_points)
+        self.raw_shots  = raw_shots
+
+        self.hist     = np.zeros((npts, n_ro, bins, bins), dtype=np.int64)
+        self.i_edges  = np.full((npts, n_ro, bins+1), np.nan)
+        self.q_edges  = np.full((npts, n_ro, bins+1), np.nan)
+        self.overflow = np.zeros((npts, n_ro), dtype=np.int64)
+        self.nshots   = np.zeros((npts, n_ro), dtype=np.int64)
+        self.nexcited = np.zeros((npts, n_ro), dtype=np.int64)
+        self.mean_i   = np.zeros((npts, n_ro))
+        self.mean_q   = np.zeros((npts, n_ro))
+        self.m2_i     = np.zeros((npts, n_ro))
+        self.m2_q     = np.zeros((npts, n_ro))
+        self.c_iq     = np.zeros((npts, n_ro))
+        self.raw_i    = np.full((len(self.raw_points), n_ro, raw_shots), np.nan)
+        self.raw_q    = np.full((len(self.raw_points), n_ro, raw_shots), np.nan)
+
+    ## Adds one round of shots of point i: [(I, Q) per readout]
+    def add(self, i, shots):
+        for ro, (I, Q) in enumerate(shots):
+            I = np.asarray(I, dtype=float)
+            Q = np.asarray(Q, dtype=float)
+            n = len(I)
+            if n == 0:
+                continue
+
+            ## Histogram, on a window set by the first round of the point if none was given
+            if np.isnan(self.i_edges[i, ro, 0]):
+                iq_range = self.iq_range
+                if iq_range is None:
+                    center = [np.median(I), np.median(Q)]
+                    half = 6*max(np.std(I), np.std(Q), 1e-9)
+                    iq_range = ((center[0]-half, center[0]+half), (center[1]-half, center[1]+half))
+                self.i_edges[i, ro] = np.linspace(*iq_range[0], self.bins+1)
+                self.q_edges[i, ro] = np.linspace(*iq_range[1], self.bins+1)
+            hist, _, _ = np.histogram2d(I, Q, bins=[self.i_edges[i, ro], self.q_edges[i, ro]])
+            self.hist[i, ro] += hist.astype(np.int64)
+            self.overflow[i, ro] += n - int(hist.sum())
+
+            ## Populations
+            if self.threshold is not None:
+                rotated = I*np.cos(self.angle) + Q*np.sin(self.angle)
+                self.nexcited[i, ro] += np.count_nonzero(rotated > self.threshold)
+
+            ## Moments, merging this batch into the running ones (Chan et al.)
+            n_old = self.nshots[i, ro]
+            n_new = n_old + n
+            mean_i = I.mean()
+            mean_q = Q.mean()
+            d_i = mean_i - self.mean_i[i, ro]
+            d_q = mean_q - self.mean_q[i, ro]
+            self.m2_i[i, ro] += ((I - mean_i)**2).sum() + d_i**2*n_old*n/n_new
+            self.m2_q[i, ro] += ((Q - mean_q)**2).sum() + d_q**2*n_old*n/n_new
+            self.c_iq[i, ro] += ((I - mean_i)*(Q - mean_q)).sum() + d_i*d_q*n_old*n/n_new
+            self.mean_i[i, ro] += d_i*n/n_new
+            self.mean_q[i, ro] += d_q*n/n_new
+            self.nshots[i, ro] = n_new
+
+            ## Raw shots, for the chosen points only
+            if i in self.raw_points:
+                k = self.raw_points.index(i)
+                nkept = min(n_old, self.raw_shots)
+                nkeep = min(self.raw_shots - nkept, n)
+                self.raw_i[k, ro, nkept:nkept+nkeep] = I[:nkeep]
+                self.raw_q[k, ro, nkept:nkept+nkeep] = Q[:nkeep]
+
+    ## Excited fraction per point and readout (NaN without a threshold)
+    def populations(self):
+        if self.threshold is None:
+            return np.full((self.npts, self.n_ro), np.nan)
+        return self.nexcited/np.maximum(self.nshots, 1)
+
+    ## Saves the reductions into meas_data.  xi/xq are the shot means, like an averaged acquire would give
+    ## for a single readout; everything else keeps a readout axis after the point axis
+    def store(self, meas_data):
+        nshots = np.maximum(self.nshots, 1)
+        meas_data["xi"]           = self.mean_i[:, 0]
+        meas_data["xq"]           = self.mean_q[:, 0]
+        meas_data["shot_count"]   = self.nshots
+        meas_data["shot_mean_i"]  = self.mean_i
+        meas_data["shot_mean_q"]  = self.mean_q
+        meas_data["shot_var_i"]   = self.m2_i/nshots
+        meas_data["shot_var_q"]   = self.m2_q/nshots
+        meas_data["shot_cov_iq"]  = self.c_iq/nshots
+        meas_data["iq_hist"]      = self.hist
+        meas_data["iq_hist_overflow"] = self.overflow
+        meas_data["iq_hist_i_edges"]  = self.i_edges
+        meas_data["iq_hist_q_edges"]  = self.q_edges
+        if self.threshold is not None:
+            meas_data["pop_excited"]     = self.populations()
+            meas_data["shot_threshold"]  = self.threshold
+            meas_data["shot_angle"]      = self.angle
+        if len(self.raw_points) > 0:
+            meas_data["raw_shot_points"] = np.array(self.raw_points)
+            meas_data["raw_shots_i"]     = self.raw_i
+            meas_data["raw_shots_q"]     = self.raw_q
+
+
+## Arguments:
+## prog_class      = AveragerProgram to run at each point (oneTonePulse, twoTonePulse, ...)
+## sweepVarName    = dictionary key for the variable
+## sweepVals       = array of values to sweep over
+## forceInt        = true/false indicating whether your sweep var needs to be an int
+## reducer         = shotReducer(len(sweepVals), ...) that takes the shots; a default one is made if not given
+## cache           = optional programCache, as in oneTone_oneSoftSweep
+## point_callback  = optional function (i, reducer) called after each point
+## Sweeps a variable in software, streaming the single shots of every point into the reducer.  Returns the reducer
+def singleShot_softSweep(soc, soccfg, prog_class, config, sweepVarName, sweepVals, forceInt=False, reducer=None, cache=None, point_callback=None):
+    if reducer is None:
+        reducer = shotReducer(len(sweepVals))
+    for i, val in enumerate(sweepVals):
+        print("Point", (i+1), "of", len(sweepVals), end="\r")
+        sys.stdout.flush()
+        if(forceInt):
+            val = int(val)
+        config[sweepVarName] = val
+        if cache is None:
+            prog = prog_class(soccfg, config)
+        else:
+            prog = cache.get(prog_class, soccfg, config, patch_keys=[sweepVarName])
+        for shots in stream_shots_prog(prog, soc):
+            reducer.add(i, shots)
+        if point_callback is not None:
+            point_callback(i, reducer)
+    return reducer
@@ -0,0 +1,121 @@
+import numpy as np
+import itertools, time
+from qick import *
+from qick_helpers import *
+from qick_programs import twoTonePulse
+from qick_oneToneSweep import oneTonePulse, oneToneHardSweep, decimatedSnapshots
+
+#----------------------------------------------------------------------
+#
+# qick_sweepServer.py
+# Oct 2024
+#
+# Board-side sweep executor.  Runs on the RFSoC next to the QickSoc
+# and takes a whole sweep in one Pyro4 call, so a 2D map costs one
+# round trip per row instead of one per point.
+#
+# On the board:   start_sweep_server(ns_host, ns_port, proxy_name="DMQIS_qick")
+# On the PC:      [soc, soccfg] = make_proxy(ns_host, ns_port, "DMQIS_qick")
+#                 executor = soc.get_sweep_executor()
+#                 meas.do_soft_2D_measurement(soc, soccfg, ..., executor=executor)
+# (client side is remote_sweep in qick_oneToneSweep.py)
+#
+#----------------------------------------------------------------------
+
+## Programs the executor knows how to build, by name
+## Classes are looked up by name so the client never has to pickle one
+sweep_programs = {
+    "oneTonePulse"     : oneTonePulse,
+    "oneToneHardSweep" : oneToneHardSweep,
+    "twoTonePulse"     : twoTonePulse,
+}
+
+
+class sweepExecutor:
+
+    def __init__(self, soc):
+        self.soc   = soc
+        self.cache = programCache()
+
+    def list_programs(self):
+        return list(sweep_programs.keys())
+
+    def get_cache_stats(self):
+        return {"programs" : len(self.cache.progs), "hits" : self.cache.hits, "misses" : self.cache.misses}
+
+    ## Runs a whole sweep on the board and streams back one block per innermost row
+    ## prog_name  = key in sweep_programs (or the program class itself)
+    ## base_cfg   = full config dict, as made by setup_meas
+    ## sweep_axes = list of (sweepVarName, sweepVals, forceInt), outermost axis first
+    ## Each block is {"index": outer indices, "xi": row, "xq": row, "t": per-point timestamps}.
+    ## Decimated snapshots (every snapshot_every rows, and/or after the last one) come as extra
+    ## {"output_decimated": ..., "snapshot_index": row number} blocks, right after the row they follow.
+    def run_sweep(self, prog_name, base_cfg, sweep_axes, use_cache=True, snapshot_every=0, snapshot_at_end=False, snapshot_avgs=2000):
+        if not isinstance(prog_name, str):
+            prog_name = prog_name.__name__
+        if prog_name not in sweep_programs:
+            raise KeyError("sweep executor doesn't know program %s. Options are %s" % (prog_name, self.list_programs()))
+        prog_class = sweep_programs[prog_name]
+        config = dict(base_cfg)
+        cache = self.cache if use_cache else None
+        sweep_keys = [axis[0] for axis in sweep_axes]
+
+        ## Outer axes are iterated here, the innermost one makes up a block
+        outer_axes = sweep_axes[:-1]
+        [inner_name, inner_vals, inner_forceInt] = sweep_axes[-1]
+        outer_ranges = [range(len(axis[1])) for axis in outer_axes]
+        snapshots = decimatedSnapshots(every=snapshot_every, at_end=snapshot_at_end, soft_avgs=snapshot_avgs)
+        for n, index in enumerate(itertools.product(*outer_ranges)):
+            for k, i in enumerate(index):
+                [name, vals, forceInt] = outer_axes[k]
+                config[name] = int(vals[i]) if forceInt else vals[i]
+            xi = np.zeros(len(inner_vals))
+            xq = np.zeros(len(inner_vals))
+            t  = np.zeros(len(inner_vals))
+            for j, val in enumerate(inner_vals):
+                config[inner_name] = int(val) if inner_forceInt else val
+                if cache is None:
+                    prog = prog_class(self.soc, config)
+                else:
+                    prog = cache.get(prog_class, self.soc, config, patch_keys=sweep_keys)
+                [[I]], [[Q]] = acquire_prog(prog, self.soc, load_pulses=True, progress=False)
+                xi[j] = I
+                xq[j] = Q
+                t[j]  = time.time()
+            yield {"index" : index, "xi" : xi, "xq" : xq, "t" : t}
+            nsnaps = len(snapshots.outputs)
+            snapshots.step(self.soc, self.soc, config, n, prog_class)
+            if len(snapshots.outputs) > nsnaps:
+                yield {"output_decimated" : snapshots.last(), "snapshot_index" : n}
+
+        #Get the decimated output for the last row, if it was asked for
+        nsnaps = len(snapshots.outputs)
+        snapshots.finish(self.soc, self.soc, config, n, prog_class)
+        if len(snapshots.outputs) > nsnaps:
+            yield {"output_decimated" : snapshots.last(), "snapshot_index" : n}
+
+
+## Starts the QickSoc and a sweepExecutor in one Pyro4 daemon, with qick.pyro.start_server
+## The soc gets a sweepExecutor that's registered on the daemon with the soc's other members (soc.autoproxy), so
+## clients get a proxy to it from soc.get_sweep_executor()
+## Same arguments as qick.pyro.start_server
+def start_sweep_server(ns_host, ns_port=8888, proxy_name='myqick', soc_class=None, iface='eth0', **kwargs):
+    from qick.pyro import start_server
+    if soc_class is None:
+        from qick import QickSoc
+        soc_class = QickSoc
+    start_server(ns_host, ns_port=ns_port, proxy_name=proxy_name, soc_class=sweep_soc_class(soc_class), iface=iface, **kwargs)
+
+## soc_class with a sweepExecutor of its own
+def sweep_soc_class(soc_class):
+    class sweepSoc(soc_class):
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self.sweep_executor = sweepExecutor(self)
+            self.autoproxy.append(self.sweep_executor)
+            print("made sweep executor")
+
+        def get_sweep_executor(self):
+            return self.sweep_executor
+    sweepSoc.__name__ = "sweep" + soc_class.__name__
+    return sweepSoc
@@ -0,0 +1,186 @@
+import numpy as np
+import time
+from qick import *
+from qick_data import *
+from qick_helpers import *
+from qick_programs import twoTonePulse, twoToneRAverager, twoToneNDAverager, two_tone_hard_sweeps
+from qick_oneToneSweep import oneToneSweep, pointTimer
+
+#----------------------------------------------------------------------
+#
+# qick_twoToneSweep.py
+# Oct 2024
+#
+# Two tone sweeps that loop in the tProc: a T1 curve (delay sweep) or a
+# Rabi scan (qubit gain and/or length) is one program and one acquire,
+# instead of a program per point like the HM05/HM07 notebooks.
+#
+#    meas = twoToneSweep()
+#    meas.set_hw_cfg(res_ch=transmission_ch, qu_ch=chargebias_ch, ro_ch=ro_ch)
+#    meas.meas_cfg = {...}          ## the twoTonePulse keys, times in _us
+#    meas.do_T1_measurement(soc, soccfg, 70, 0.01, 0.5, datapath=datapath)
+#
+#    meas.set_soft_sweep_vals(40, 100, 30000, "qu_gain")                 ## x
+#    meas.set_soft_sweep_vals(30, 0.05, 2, "qu_length_us", sweep_num=2)   ## y
+#    meas.do_hard_2D_measurement(soc, soccfg, datapath=datapath)
+#
+# Sweepable: delay(_us), qu_gain, qu_length(_us).  Time sweeps are
+# rounded to whole clock ticks (tProc clock for delay, the qubit
+# generator's for qu_length), and the values actually played are the
+# ones stored in x_sweepVals/y_sweepVals and their _us copies (the
+# asked-for ones are kept as x_sweepVals_requested/y_sweepVals_requested).
+#
+#----------------------------------------------------------------------
+
+## Same bookkeeping, plots and H5 layout as oneToneSweep, for twoTonePulse-style measurements
+class twoToneSweep(oneToneSweep):
+
+    ## Sweeps the delay between the qubit pulse and the readout from start_us to stop_us in one program
+    def do_T1_measurement(self, soc, soccfg, npts, start_us, stop_us, datapath=None, overwrite_existing_data=False, save_data=True):
+        self.set_soft_sweep_vals(npts, start_us, stop_us, "delay_us", sweep_num=1)
+        return self.do_hard_1D_measurement(soc, soccfg, datapath=datapath, overwrite_existing_data=overwrite_existing_data, save_data=save_data)
+
+    ## Single-shot soft sweep of x with twoTonePulse at every point (e.g. T1 parity, as in HM07)
+    ## Same arguments and meas_data as oneToneSweep.do_single_shot_1D_measurement
+    def do_single_shot_1D_measurement(self, soc, soccfg, datapath=None, prog_class=twoTonePulse, **kwargs):
+        return oneToneSweep.do_single_shot_1D_measurement(self, soc, soccfg, datapath=datapath, prog_class=prog_class, **kwargs)
+
+    ## Sweeps x (delay_us, qu_gain or qu_length_us) in the tProc: one program, one acquire
+    ## Set instrument=True to save timestamps and build/acquire/transfer durations, shared out over the points (see pointTimer)
+    def do_hard_1D_measurement(self, soc, soccfg, datapath=None, overwrite_existing_data=False, save_data=True, instrument=False):
+        if not self.check_hard_sweep_inputs(datapath, overwrite_existing_data, save_data, ["x"]):
+            return
+
+        ## Prepare for measurement
+        print("Starting measurement setup")
+        config = self.setup_meas(soc,soccfg)
+        [name, start, step, npts] = self.get_hard_sweep(soccfg, "x")
+        config["hard_sweep_reg"] = name
+        config["start"] = start
+        config["step"]  = step
+        config["expts"] = npts
+
+        ## Actually do the measurement
+        print("Starting measurement")
+        timer = pointTimer(npts if instrument else 0)
+        t_start = time.perf_counter()
+        prog = twoToneRAverager(soccfg, config)
+        t_built = time.perf_counter()
+        expt_pts, avgi, avgq = acquire_prog(prog, soc, progress=False)
+        t_acquired = time.perf_counter()
+        print("Measurement complete")
+        for i in range(npts):
+            timer.book(i, "build", (t_built - t_start)/npts)
+            timer.book(i, "acquire", (t_acquired - t_built)/npts)
+            timer.stamp(i)
+
+        ## Store data in class
+        self.meta["sweep_type"] = "1D"
+        self.meta["sweep_mode"] = "hard"
+        self.meas_data["xi"] = np.array(avgi[0][0])
+        self.meas_data["xq"] = np.array(avgq[0][0])
+        timer.store(self.meas_data)
+        timer.summary()
+
+        ## Save data
+        if save_data:
+            self.write_H5(datapath)
+        return
+
+    ## Sweeps x and y (any two of delay_us, qu_gain, qu_length_us) in the tProc: one program, one acquire
+    ## xi/xq are (y, x) maps, like oneToneSweep's 2D sweeps.  Timings are per point in acquisition order (x fastest)
+    def do_hard_2D_measurement(self, soc, soccfg, datapath=None, overwrite_existing_data=False, save_data=True, instrument=False):
+        if not self.check_hard_sweep_inputs(datapath, overwrite_existing_data, save_data, ["x", "y"]):
+            return
+
+        ## Prepare for measurement
+        print("Starting measurement setup")
+        config = self.setup_meas(soc,soccfg)
+        sweeps = [self.get_hard_sweep(soccfg, axis) for axis in ["x", "y"]]
+        if sweeps[0][0] == sweeps[1][0]:
+            print("Error: x and y both sweep", sweeps[0][0])
+            return
+        config["hard_sweeps"] = sweeps
+
+        ## Actually do the measurement
+        print("Starting measurement")
+        npts = sweeps[0][3]*sweeps[1][3]
+        timer = pointTimer(npts if instrument else 0)
+        t_start = time.perf_counter()
+        prog = twoToneNDAverager(soccfg, config)
+        t_built = time.perf_counter()
+        expt_pts, avgi, avgq = acquire_prog(prog, soc, progress=False)
+        t_acquired = time.perf_counter()
+        print("Measurement complete")
+        for i in range(npts):
+            timer.book(i, "build", (t_built - t_start)/npts)
+            timer.book(i, "acquire", (t_acquired - t_built)/npts)
+            timer.stamp(i)
+
+        ## Store data in class
+        self.meta["sweep_type"] = "2D"
+        self.meta["sweep_mode"] = "hard"
+        self.meas_data["xi"] = np.array(avgi[0][0])
+        self.meas_data["xq"] = np.array(avgq[0][0])
+        timer.store(self.meas_data)
+        timer.summary()
+
+        ## Save data
+        if save_data:
+            self.write_H5(datapath)
+        return
+
+    ## Returns False (after saying why) if a hardware sweep over these axes can't be run as set up
+    def check_hard_sweep_inputs(self, datapath, overwrite_existing_data, save_data, axes):
+        if save_data and datapath==None:
+            print("Error: no datapath provided.  Either provide a datapath argument, or rerun the function with save_data=False")
+            return False
+        for axis in ["x", "y"]:
+            if (axis in axes) and (axis+"_sweepVals" not in self.meas_data.keys()):
+                print("Error:", axis, "sweep values not found")
+                return False
+            if (axis not in axes) and (axis+"_sweepVals" in self.meas_data.keys()):
+                print("Error:", axis, "sweep values were provided, but you are running a", str(len(axes))+"D sweep")
+                return False
+            if axis in axes:
+                name = self.meas_data[axis+"_sweepVarName"]
+                if name[-3:] == "_us":
+                    name = name[:-3]
+                if name not in two_tone_hard_sweeps:
+                    print("Error:", name, "can't be swept in firmware. Options are", list(two_tone_hard_sweeps.keys()))
+                    return False
+        if "xi" in self.meas_data.keys() and not overwrite_existing_data:
+            print("Error: data already exists in this measurement object.")
+            print("to run acquisition, either initialize a new object")
+            print("or rerun this function with argument overwrite_existing_data=True")
+            return False
+        if self.hw_cfg.get("qu_ch") is None:
+            print("Error: qubit channel is set to None in hw_cfg dict, but this is a two tone measurement")
+            return False
+        return True
+
+    ## Turns the (already converted to clock ticks) sweep values of an axis into [name, start, step, npts] register units
+    ## The sweep values are replaced by the ones that will actually be played (the _us copy too), and the
+    ## asked-for ones are kept as <axis>_sweepVals_requested
+    def get_hard_sweep(self, soccfg, axis):
+        name = self.meas_data[axis+"_sweepVarName"]
+        vals = np.asarray(self.meas_data[axis+"_sweepVals"])
+        [start, step, played] = hard_sweep_steps(name, vals)
+        self.meas_data[axis+"_sweepVals_requested"] = vals
+        self.meas_data[axis+"_sweepVals"] = played
+        if self.meas_data.get("is_"+axis+"_sweep_in_us"):
+            gen_ch = self.hw_cfg.get(time_var_channel(name+"_us"))
+            self.meas_data[axis+"_sweepVals_us"] = played/get_gen_clocks(soccfg)[gen_ch]
+        return [name, start, step, len(played)]
+
+
+## Integer start and step of a firmware sweep over vals (in register units), and the values it will play
+## Steps get rounded to whole register units, so the played values can differ a little from the asked-for ones
+def hard_sweep_steps(name, vals):
+    vals = np.asarray(vals)
+    npts = len(vals)
+    start = int(np.round(vals[0]))
+    step  = int(np.round((vals[-1] - vals[0])/(npts - 1))) if npts > 1 else 0
+    if npts > 1 and step == 0:
+        print("Warning:", name, "steps by less than one clock tick, every point will play the same value")
+    return [start, step, start + step*np.arange(npts)]